@@ -0,0 +1,243 @@
+# Import nessessary packages
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+# The mock backend has to be selected before the models are built
+os.environ.setdefault("SYN_TREES_BACKEND", "mock")
+import models
+from ledger import read_jsonl
+
+#CONSTANTS
+# Intents and domains the synthetic inputs are drawn from
+INTENTS = ["General-purpose Coding Queries", "Text Summarization", "Data Analysis", "Creative Writing", "Math Tutoring"]
+DOMAINS = ["Loops", "News Articles", "Sales Reports", "Short Stories", "Algebra", "Recursion", "Emails"]
+
+def synthetic_inputs(n_trees: int, seed: int) -> list:
+    """
+    Build a synthetic input list in the format the engines take.
+
+    Args:
+        n_trees (int): Number of trees to generate.
+        seed (int): Seed of the intent and domain draws.
+
+    Returns:
+        list: List of (doc_id, (intent, domain)) tuples.
+    """
+    rng = random.Random(seed)
+    return [(index, (rng.choice(INTENTS), rng.choice(DOMAINS))) for index in range(n_trees)]
+
+def count_lines(path: str, field: str) -> int:
+    """
+    Count the JSONL entries of a file that contain a field.
+
+    Args:
+        path (str): Path of the JSONL file.
+        field (str): Field the counted entries contain.
+
+    Returns:
+        int: Number of matching entries, 0 when the file does not exist.
+    """
+    if not os.path.exists(path):
+        return 0
+    return sum(field in entry for entry in read_jsonl(path))
+
+def sum_field(path: str, field: str) -> int:
+    """
+    Sum a numeric field over the JSONL entries of a file.
+
+    Args:
+        path (str): Path of the JSONL file.
+        field (str): Field to sum, missing values count as 0.
+
+    Returns:
+        int: The sum, 0 when the file does not exist.
+    """
+    if not os.path.exists(path):
+        return 0
+    return sum(entry.get(field) or 0 for entry in read_jsonl(path))
+
+def count_files(path: str, skip: set) -> tuple:
+    """
+    Count the output files written under a directory.
+
+    Args:
+        path (str): The output directory.
+        skip (set): Names of bookkeeping files not counted as output.
+
+    Returns:
+        files (int): Number of files.
+        size (int): Total size of the files in bytes.
+    """
+    files, size = 0, 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            if name in skip:
+                continue
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+def queue_worker(turns: int, max_concurrent_requests: int, max_open_trees: int):
+    """
+    Run one worker of the queue engine in a forked process, as a worker on another host would.
+
+    Args:
+        turns (int): The number of turns for the conversation.
+        max_concurrent_requests (int): Requests in flight of the worker.
+        max_open_trees (int): Trees generated at once by the worker.
+    """
+    import main
+    asyncio.run(main.arun_queue_worker(main.open_queue(), turns=turns, max_concurrent_requests=max_concurrent_requests,
+                                       max_open_trees=max_open_trees, settings=main.QUEUE_SETTINGS))
+    main.close_writer()
+
+def run(args) -> dict:
+    """
+    Generate the synthetic trees with the selected engine and measure the run.
+
+    Args:
+        args: Parsed command line arguments.
+
+    Returns:
+        dict: The benchmark configuration and its measurements.
+    """
+    out_dir = args.out or tempfile.mkdtemp(prefix="syn_trees_bench_")
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Configure the models before main builds the roles
+    models.MOCK_LLM_SETTINGS.update({
+        "latency": args.latency,
+        "latency_sigma": args.latency_sigma,
+        "error_rate": args.error_rate,
+        "rate_limit_rate": args.rate_limit_rate,
+        "prefix_cache": args.prefix_cache,
+        "seed": args.seed,
+    })
+    models.MOCK_ENDPOINTS = args.endpoints
+    models.RETRY_POLICY = models.RetryPolicy(max_attempts=models.RETRY_POLICY.max_attempts, base_delay=args.retry_delay, max_delay=models.RETRY_POLICY.max_delay)
+    models.CONTEXT_POLICY = {"max_turns": args.context_turns, "max_tokens": args.context_tokens, "summary": True}
+    if args.rate_limit:
+        # Keep the token buckets of this run apart from other runs on the host
+        models.RATE_LIMIT_STATE_DIR = os.path.join(out_dir, "rate_limits")
+    else:
+        models.RATE_LIMITS = {}
+    if args.cache:
+        models.RESPONSE_CACHE_PATH = os.path.join(out_dir, "cache.sqlite")
+
+    import main
+    main.DATA_GEN_FILE_PATH = out_dir
+    main.STORAGE_MODE = args.storage
+    main.OUTPUT_FORMAT = args.output_format
+    main.SHARD_SETTINGS = {**main.SHARD_SETTINGS, "compression": args.compression}
+    main.DEDUPE_SCOPE = None if args.dedupe == "off" else args.dedupe
+    main.RUN_SEED = args.seed
+    main.BUDGET_LIMITS = {"run_tokens": args.run_tokens, "run_dollars": None, "tree_tokens": args.tree_tokens, "tree_dollars": None}
+    random.seed(args.seed)
+
+    input_list = synthetic_inputs(args.trees, args.seed)
+    start_time = time.time()
+    if args.engine == "sync":
+        for index, (intent, domain) in input_list:
+            main.start(turns=args.turns, intent=intent, domain=domain, doc_id=index)
+    elif args.engine == "async":
+        asyncio.run(main.arun(input_list, turns=args.turns, max_concurrent_requests=args.concurrency or main.MAX_CONCURRENT_REQUESTS, max_open_trees=args.max_open_trees or main.MAX_OPEN_TREES))
+    elif args.engine == "frontier":
+        asyncio.run(main.arun_frontier(input_list, turns=args.turns, max_concurrent_requests=args.concurrency or main.MAX_CONCURRENT_REQUESTS, priority=args.priority, max_open_trees=args.max_open_trees or main.MAX_OPEN_TREES))
+    elif args.engine == "queue":
+        # Idle workers poll often, the trees of a benchmark take seconds
+        main.QUEUE_SETTINGS = {**main.QUEUE_SETTINGS, "poll_seconds": 0.5}
+        main.open_queue().enqueue(input_list)
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=queue_worker, args=(args.turns, args.concurrency or main.MAX_CONCURRENT_REQUESTS, args.max_open_trees or main.MAX_OPEN_TREES))
+                   for _ in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        main.run_nodes(input_list, turns=args.turns, n_workers=args.workers, priority=args.priority, max_open_trees=args.max_open_trees)
+    # Pending shard writes are part of the run
+    main.close_writer()
+    elapsed = time.time() - start_time
+    main.export_metrics()
+
+    # Every completed node is recorded once in the checkpoint and every call once in the ledger
+    nodes = count_lines(f"{out_dir}/{main.CHECKPOINT_FILE_NAME}", "node")
+    calls = count_lines(f"{out_dir}/@-ledger.jsonl", "role")
+    errors = count_lines(f"{out_dir}/@-ledger.jsonl", "error")
+    prompt_tokens = sum_field(f"{out_dir}/@-ledger.jsonl", "prompt_tokens")
+    cached_tokens = sum_field(f"{out_dir}/@-ledger.jsonl", "cached_tokens")
+    files, size = count_files(out_dir, {main.CHECKPOINT_FILE_NAME, main.BUDGET_FILE_NAME, main.SPANS_FILE_NAME, main.METRICS_FILE_NAME, main.IDEAS_FILE_NAME, main.IDEAS_FILE_NAME + "-wal", main.IDEAS_FILE_NAME + "-shm", main.QUEUE_FILE_NAME, "@-ledger.jsonl", "@-errors.txt", "cache.sqlite", "cache.sqlite-wal", "cache.sqlite-shm"})
+
+    # ru_maxrss is reported in kilobytes on Linux, children covers the node engine's workers
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {
+        "config": vars(args),
+        "output": out_dir,
+        "seconds": round(elapsed, 3),
+        "trees": len(input_list),
+        "nodes": nodes,
+        "calls": calls,
+        "failed calls": errors,
+        "prompt tokens": prompt_tokens,
+        "cached prompt tokens": cached_tokens,
+        "nodes/s": round(nodes / elapsed, 2),
+        "calls/s": round(calls / elapsed, 2),
+        "peak rss MB": round(peak_rss / 1024, 1),
+        "peak rss workers MB": round(peak_rss_children / 1024, 1),
+        "files written": files,
+        "bytes written": size,
+    }
+
+if __name__ == "__main__":
+    # Usage: python benchmark.py --trees 20 --engine async [--report results.jsonl]
+    parser = argparse.ArgumentParser(description="Measure end-to-end generation throughput against the mock LLM backend.")
+    parser.add_argument("--trees", type=int, default=10, help="number of synthetic trees")
+    parser.add_argument("--turns", type=int, default=4, help="turns per conversation")
+    parser.add_argument("--engine", choices=["sync", "async", "frontier", "nodes", "queue"], default="async", help="execution engine")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes of the nodes and queue engines")
+    parser.add_argument("--concurrency", type=int, help="requests in flight of the async engine, MAX_CONCURRENT_REQUESTS by default")
+    parser.add_argument("--priority", choices=["depth", "breadth", "oldest", "cheapest"], default="depth", help="order of the pending nodes of the frontier and nodes engines")
+    parser.add_argument("--max-open-trees", type=int, help="trees generated at once, MAX_OPEN_TREES by default")
+    parser.add_argument("--storage", choices=["leaf", "tree"], default="leaf", help="output layout")
+    parser.add_argument("--output-format", choices=["files", "shards"], default="files", help="one file per output, or compressed JSONL shards")
+    parser.add_argument("--compression", choices=["gzip", "zstd"], default="gzip", help="compression of the shards")
+    parser.add_argument("--latency", type=float, default=0.05, help="median mock call latency in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="spread of the log-normal latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of a mock 500 error")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="probability of a mock 429 error")
+    parser.add_argument("--retry-delay", type=float, default=0.1, help="backoff of the first retry in seconds, scaled down like the mock latency")
+    parser.add_argument("--endpoints", type=int, default=1, help="mock endpoints per model pool")
+    parser.add_argument("--rate-limit", action="store_true", help="apply RATE_LIMITS to the mock calls")
+    parser.add_argument("--prefix-cache", action="store_true", help="simulate a serving-side prefix cache in the mock backend")
+    parser.add_argument("--cache", action="store_true", help="enable the response cache in the output directory")
+    parser.add_argument("--context-turns", type=int, help="turns of history kept in the user and moderator prompts")
+    parser.add_argument("--context-tokens", type=int, help="tokens of history kept in the user and moderator prompts")
+    parser.add_argument("--dedupe", choices=["tree", "run", "off"], default="off", help="scope of the near-duplicate idea filter")
+    parser.add_argument("--run-tokens", type=int, help="token budget of the whole run")
+    parser.add_argument("--tree-tokens", type=int, help="token budget of each tree")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the inputs, sampling and mock outputs")
+    parser.add_argument("--out", help="output directory, a fresh temporary directory by default")
+    parser.add_argument("--report", help="append the results as one JSON line to this file")
+    args = parser.parse_args()
+
+    # Keep the generator's progress prints out of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        results = run(args)
+    finally:
+        sys.stdout = stdout
+    print(json.dumps(results, indent=4))
+    if args.report:
+        with open(args.report, "a") as file:
+            file.write(json.dumps(results) + "\n")
@@ -0,0 +1,298 @@
+# Import nessessary packages
+import os
+
+from ledger import token_cost
+from rate_limiter import update_locked_json
+
+#CONSTANTS
+# Estimates used until the first nodes of the run are observed
+DEFAULT_NODE_TOKENS = 1500      # Tokens of one node (user, assistant and moderator calls)
+DEFAULT_BRANCHING = 2.5         # Children sampled per expanded node
+
+# Budget of the current process, set by `open_budget`
+_BUDGET = None
+
+class Budget:
+    """
+    Token and dollar limits for a whole run and for each tree, shared between worker processes.
+    Every call is charged to its tree as it completes. Before a node's children are expanded, the cost
+    of each child subtree is estimated from the running averages of node cost and branching, and only
+    as many children are kept as the remaining budget can pay for. Their estimates stay reserved until
+    each child is expanded, so concurrent branches do not spend the same budget twice.
+    The state lives in a small JSON file guarded by an exclusive file lock, see `rate_limiter.update_locked_json`.
+
+    Attributes:
+        path (str): Path of the budget state file.
+        limits (dict): "run_tokens", "run_dollars", "tree_tokens" and "tree_dollars", None for no limit.
+    """
+    def __init__(self, path: str, limits: dict):
+        """
+        Initialize the Budget instance.
+
+        Args:
+            path (str): Path of the budget state file.
+            limits (dict): "run_tokens", "run_dollars", "tree_tokens" and "tree_dollars", None for no limit.
+        """
+        self.path = path
+        self.limits = limits
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def _update(self, change):
+        """
+        Apply a change to the budget state under the file lock.
+
+        Args:
+            change: Function taking the state dict, modifying it in place and returning a result.
+
+        Returns:
+            The result of `change`.
+        """
+        return update_locked_json(self.path, lambda: {
+            "run": {"tokens": 0, "dollars": 0.0, "reserved": 0.0},
+            "trees": {},            # Spend and reservations of the open trees
+            "reservations": {},     # Reserved estimate of every pending node, keyed "doc_id:node"
+            "open": {},             # Tokens charged to every node being expanded, keyed "doc_id:node"
+            "stats": {"nodes": 0, "node_tokens": 0, "parents": 0, "children": 0},
+        }, change)
+
+    def _available(self, spend: dict, prefix: str) -> float:
+        """
+        Get the tokens left under the token and dollar limits of a run or tree.
+        Dollar limits are converted to tokens at the price per token observed so far.
+
+        Args:
+            spend (dict): "tokens", "dollars" and "reserved" of the run or tree.
+            prefix (str): "run" or "tree".
+
+        Returns:
+            float: Tokens that can still be reserved, infinite without limits.
+        """
+        available = float("inf")
+        used = spend["tokens"] + spend["reserved"]
+        if self.limits.get(f"{prefix}_tokens") is not None:
+            available = min(available, self.limits[f"{prefix}_tokens"] - used)
+        if self.limits.get(f"{prefix}_dollars") is not None:
+            price = spend["dollars"] / spend["tokens"] if spend["tokens"] else token_cost(None, 1)
+            available = min(available, (self.limits[f"{prefix}_dollars"] - spend["dollars"]) / price - spend["reserved"])
+        return available
+
+    def _close(self, state: dict, doc_id, name: str) -> bool:
+        """
+        Release the reservation of a node and add its observed cost to the running averages.
+
+        Args:
+            state (dict): The budget state.
+            doc_id: Identifier for the conversation tree.
+            name (str): Name of the node.
+
+        Returns:
+            bool: Whether the node was still open.
+        """
+        node = f"{doc_id}:{name}"
+        if node not in state["reservations"] and node not in state["open"]:
+            return False
+        reserved = state["reservations"].pop(node, 0.0)
+        state["run"]["reserved"] -= reserved
+        if str(doc_id) in state["trees"]:
+            state["trees"][str(doc_id)]["reserved"] -= reserved
+        state["stats"]["nodes"] += 1
+        state["stats"]["node_tokens"] += state["open"].pop(node, 0)
+        return True
+
+    def charge(self, doc_id, name: str, model: str, tokens: int):
+        """
+        Charge the tokens of a completed call to its node, tree and the run.
+
+        Args:
+            doc_id: Identifier for the conversation tree.
+            name (str): Name of the node the call was made for.
+            model (str): The name of the language model.
+            tokens (int): Tokens used by the call.
+        """
+        dollars = token_cost(model, tokens)
+
+        def change(state):
+            for spend in (state["run"], state["trees"].setdefault(str(doc_id), {"tokens": 0, "dollars": 0.0, "reserved": 0.0})):
+                spend["tokens"] += tokens
+                spend["dollars"] += dollars
+            node = f"{doc_id}:{name}"
+            state["open"][node] = state["open"].get(node, 0) + tokens
+        self._update(change)
+
+    def allow_children(self, doc_id, name: str, sampled: int, levels: int) -> int:
+        """
+        Close an expanded node and decide how many of its sampled children the budget can pay for.
+        Each child subtree is estimated at the average node cost times its expected number of nodes,
+        1 + b + ... + b^(levels-1) for the average branching b. When not even one full subtree fits but
+        a single node does, one child is kept and its own children are pruned in turn.
+
+        Args:
+            doc_id: Identifier for the conversation tree.
+            name (str): Name of the expanded node.
+            sampled (int): Number of children sampled for the node.
+            levels (int): Turns left below the node, i.e. the depth of each child subtree.
+
+        Returns:
+            int: Number of children to keep, at most `sampled`.
+        """
+        def change(state):
+            self._close(state, doc_id, name)
+            stats = state["stats"]
+            node_tokens = stats["node_tokens"] / stats["nodes"] if stats["nodes"] else DEFAULT_NODE_TOKENS
+            branching = stats["children"] / stats["parents"] if stats["parents"] else DEFAULT_BRANCHING
+            subtree = node_tokens * sum(branching ** level for level in range(levels))
+
+            tree = state["trees"].setdefault(str(doc_id), {"tokens": 0, "dollars": 0.0, "reserved": 0.0})
+            available = min(self._available(state["run"], "run"), self._available(tree, "tree"))
+            if available == float("inf") or not subtree:
+                keep = sampled
+            else:
+                keep = min(sampled, max(0, int(available // subtree)))
+            if keep == 0 and sampled and available >= node_tokens:
+                keep = 1
+
+            # Sampled counts feed the branching average, before pruning so the estimate stays unbiased
+            stats["parents"] += 1
+            stats["children"] += sampled
+            if keep and available != float("inf"):
+                reserve = min(subtree, available / keep)
+                for index in range(1, keep + 1):
+                    state["reservations"][f"{doc_id}:{name}{index}-"] = reserve
+                state["run"]["reserved"] += reserve * keep
+                tree["reserved"] += reserve * keep
+            return keep
+        return self._update(change)
+
+    def close_node(self, doc_id, name: str):
+        """
+        Close a node that ended its branch, releasing its reservation.
+
+        Args:
+            doc_id: Identifier for the conversation tree.
+            name (str): Name of the node.
+        """
+        self._update(lambda state: self._close(state, doc_id, name))
+
+    def exhausted(self) -> bool:
+        """
+        Check whether the run budget is used up, so that no new tree should be started.
+
+        Returns:
+            bool: True when nothing is left under the run limits.
+        """
+        return self._update(lambda state: self._available(state["run"], "run") <= 0)
+
+    def finish_tree(self, doc_id):
+        """
+        Drop the state of a finished tree.
+
+        Args:
+            doc_id: Identifier for the conversation tree.
+        """
+        def change(state):
+            state["trees"].pop(str(doc_id), None)
+            for node in [node for node in state["open"] if node.startswith(f"{doc_id}:")]:
+                state["open"].pop(node)
+            for node in [node for node in state["reservations"] if node.startswith(f"{doc_id}:")]:
+                state["run"]["reserved"] -= state["reservations"].pop(node)
+        self._update(change)
+
+    def clear_reservations(self, doc_id=None):
+        """
+        Drop the reservations and open nodes left by an interrupted run, keeping what was spent.
+
+        Args:
+            doc_id (optional): Drop only those of this tree, e.g. a tree taken over from a lost queue worker. Defaults to None.
+        """
+        def change(state):
+            if doc_id is not None:
+                for node in [node for node in state["open"] if node.startswith(f"{doc_id}:")]:
+                    state["open"].pop(node)
+                for node in [node for node in state["reservations"] if node.startswith(f"{doc_id}:")]:
+                    state["run"]["reserved"] -= state["reservations"].pop(node)
+                if str(doc_id) in state["trees"]:
+                    state["trees"][str(doc_id)]["reserved"] = 0.0
+                return
+            state["reservations"], state["open"] = {}, {}
+            state["run"]["reserved"] = 0.0
+            for tree in state["trees"].values():
+                tree["reserved"] = 0.0
+        self._update(change)
+
+def open_budget(path: str, limits: dict):
+    """
+    Open the budget of the current process when any limit is set, reusing it when already open on the same path.
+
+    Args:
+        path (str): Path of the budget state file.
+        limits (dict): "run_tokens", "run_dollars", "tree_tokens" and "tree_dollars", None for no limit.
+
+    Returns:
+        Budget: The budget the module functions use, or None without limits.
+    """
+    global _BUDGET
+    if not any(limit is not None for limit in limits.values()):
+        return None
+    if _BUDGET is None or _BUDGET.path != path:
+        _BUDGET = Budget(path, limits)
+    return _BUDGET
+
+def charge_call(doc_id, name: str, model: str, tokens: int):
+    """
+    Charge a completed call to the budget of the current process, if one is open.
+
+    Args:
+        doc_id: Identifier for the conversation tree.
+        name (str): Name of the node the call was made for.
+        model (str): The name of the language model.
+        tokens (int): Tokens used by the call.
+    """
+    if _BUDGET is not None and tokens:
+        _BUDGET.charge(doc_id, name, model, tokens)
+
+def budget_children(doc_id, name: str, sampled: int, levels: int) -> int:
+    """
+    Get how many sampled children of a node the budget of the current process can pay for.
+
+    Args:
+        doc_id: Identifier for the conversation tree.
+        name (str): Name of the expanded node.
+        sampled (int): Number of children sampled for the node.
+        levels (int): Turns left below the node.
+
+    Returns:
+        int: Number of children to keep, `sampled` when no budget is open.
+    """
+    if _BUDGET is None:
+        return sampled
+    return _BUDGET.allow_children(doc_id, name, sampled, levels)
+
+def budget_close_node(doc_id, name: str):
+    """
+    Close a node that ended its branch in the budget of the current process, if one is open.
+
+    Args:
+        doc_id: Identifier for the conversation tree.
+        name (str): Name of the node.
+    """
+    if _BUDGET is not None:
+        _BUDGET.close_node(doc_id, name)
+
+def budget_exhausted() -> bool:
+    """
+    Check whether the run budget of the current process is used up.
+
+    Returns:
+        bool: True when a budget is open and nothing is left under its run limits.
+    """
+    return _BUDGET is not None and _BUDGET.exhausted()
+
+def budget_done(doc_id):
+    """
+    Drop the state of a finished tree from the budget of the current process, if one is open.
+
+    Args:
+        doc_id: Identifier for the conversation tree.
+    """
+    if _BUDGET is not None:
+        _BUDGET.finish_tree(doc_id)
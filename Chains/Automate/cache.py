@@ -0,0 +1,114 @@
+# Import nessessary packages
+import json
+import time
+import sqlite3
+import hashlib
+
+def cache_key(messages: list, model: str, temperature: float, seed=None) -> str:
+    """
+    Build the content address of a call from everything that determines its output.
+
+    Args:
+        messages (list): The fully rendered prompt as chat messages.
+        model (str): The name of the language model.
+        temperature (float): The sampling temperature of the call.
+        seed (optional): The sampling seed of the call, if any.
+
+    Returns:
+        str: Hex digest identifying the call.
+    """
+    payload = json.dumps({
+        "messages": [[message.type, message.content] for message in messages],
+        "model": model,
+        "temperature": temperature,
+        "seed": seed,
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    A persistent, content-addressed cache of LLM responses stored in SQLite.
+    The database runs in WAL mode so worker processes can share it, and the least recently used
+    entries are evicted once the stored responses exceed the size limit.
+
+    Attributes:
+        path (str): Path of the SQLite database.
+        max_bytes (int): Size limit of the stored responses.
+    """
+    # Number of writes between two size checks
+    EVICT_INTERVAL = 100
+
+    def __init__(self, path: str, max_bytes: int = 1 << 30):
+        """
+        Initialize the ResponseCache instance.
+
+        Args:
+            path (str): Path of the SQLite database.
+            max_bytes (int, optional): Size limit of the stored responses. Defaults to 1 GiB.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self._writes = 0
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, content TEXT, token_count INTEGER, size INTEGER, last_access REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+
+    def get(self, key: str):
+        """
+        Look up a cached response.
+
+        Args:
+            key (str): The content address of the call.
+
+        Returns:
+            tuple: (content, token_count) of the cached response, or None on a miss.
+        """
+        row = self.connection.execute("SELECT content, token_count FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        return row[0], row[1]
+
+    def put(self, key: str, content: str, token_count: int):
+        """
+        Store a response, evicting old entries every EVICT_INTERVAL writes when over the size limit.
+
+        Args:
+            key (str): The content address of the call.
+            content (str): The raw model output.
+            token_count (int): Tokens the call used.
+        """
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+            (key, content, token_count, len(content.encode("utf-8")), time.time()),
+        )
+        self._writes += 1
+        if self._writes % self.EVICT_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache is back under 90% of its size limit.
+        """
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        while total > target:
+            rows = self.connection.execute("SELECT key, size FROM responses ORDER BY last_access LIMIT 500").fetchall()
+            if not rows:
+                break
+            freed = 0
+            victims = []
+            for key, size in rows:
+                victims.append((key,))
+                freed += size
+                if total - freed <= target:
+                    break
+            self.connection.executemany("DELETE FROM responses WHERE key = ?", victims)
+            total -= freed
@@ -0,0 +1,136 @@
+# Import nessessary packages
+import os
+
+from ledger import Ledger, read_jsonl
+from storage import parent_id
+
+# Checkpoint of the current process, set by `open_checkpoint`
+_CHECKPOINT = None
+
+class Checkpoint:
+    """
+    The persistent frontier of a run, kept as an append-only JSONL file.
+    Every completed node is recorded once as a node row (see storage.NODE_COLUMNS) along with whether
+    it was saved as a leaf, and every finished tree is marked done. Children listed in the moderator
+    column of a recorded node but missing from the file, or recorded without a turn because their turn
+    failed, are the branches still pending.
+
+    Attributes:
+        path (str): Path of the checkpoint file.
+    """
+    def __init__(self, path: str):
+        """
+        Initialize the Checkpoint instance.
+
+        Args:
+            path (str): Path of the checkpoint file.
+        """
+        self.path = path
+        self.ledger = Ledger(path)
+
+    def record_node(self, doc_id, row: list, leaf: bool):
+        """
+        Record a completed node.
+
+        Args:
+            doc_id: Identifier for the conversation tree.
+            row (list): The node row in storage.NODE_COLUMNS order.
+            leaf (bool): Whether the node was saved as a leaf.
+        """
+        self.ledger.append({"doc_id": doc_id, "node": row, "leaf": leaf})
+
+    def record_done(self, doc_id):
+        """
+        Mark a tree as fully generated.
+
+        Args:
+            doc_id: Identifier for the conversation tree.
+        """
+        self.ledger.append({"doc_id": doc_id, "done": True})
+
+def open_checkpoint(path: str) -> Checkpoint:
+    """
+    Open the checkpoint of the current process, reusing it when already open on the same path.
+
+    Args:
+        path (str): Path of the checkpoint file.
+
+    Returns:
+        Checkpoint: The checkpoint that `checkpoint_node` and `checkpoint_done` write to.
+    """
+    global _CHECKPOINT
+    if _CHECKPOINT is None or _CHECKPOINT.path != path:
+        _CHECKPOINT = Checkpoint(path)
+    return _CHECKPOINT
+
+def checkpoint_node(doc_id, name: str, turn: tuple, ideas: list, leaf: bool):
+    """
+    Record a completed node in the checkpoint of the current process, if one is open.
+
+    Args:
+        doc_id: Identifier for the conversation tree.
+        name (str): Name produced for the conversation tree branch.
+        turn (tuple): (intent, user prompt, assistant response) of the node, or (intent, None, None) when its turn failed.
+        ideas (list): Sampled moderator ideas of the node, None when it has no children.
+        leaf (bool): Whether the node was saved as a leaf, False for a branch whose turn failed.
+    """
+    if _CHECKPOINT is not None:
+        _CHECKPOINT.record_node(doc_id, [name, parent_id(name), *turn, ideas], leaf)
+
+def checkpoint_done(doc_id):
+    """
+    Mark a tree as fully generated in the checkpoint of the current process, if one is open.
+
+    Args:
+        doc_id: Identifier for the conversation tree.
+    """
+    if _CHECKPOINT is not None:
+        _CHECKPOINT.record_done(doc_id)
+
+def load_checkpoint(path: str, doc_ids: set = None) -> tuple:
+    """
+    Load the frontier of a previous run. Records of finished trees are dropped as soon as their
+    done marker is read, so memory only holds the trees that were in progress.
+
+    Args:
+        path (str): Path of the checkpoint file.
+        doc_ids (set, optional): Load only these trees, e.g. a tree a queue worker resumes. Defaults to None for every tree.
+
+    Returns:
+        done (set): doc_ids of the fully generated trees.
+        pending (dict): For every unfinished tree, {"nodes": {node id: row}, "leaves": set of leaf node ids}.
+    """
+    done, pending = set(), {}
+    if not os.path.exists(path):
+        return done, pending
+    for entry in read_jsonl(path):
+        doc_id = entry["doc_id"]
+        if doc_ids is not None and doc_id not in doc_ids:
+            continue
+        if entry.get("done"):
+            done.add(doc_id)
+            pending.pop(doc_id, None)
+            continue
+        tree = pending.setdefault(doc_id, {"nodes": {}, "leaves": set()})
+        tree["nodes"][entry["node"][0]] = entry["node"]
+        if entry["leaf"]:
+            tree["leaves"].add(entry["node"][0])
+    return done, pending
+
+def pending_children(nodes: dict) -> list:
+    """
+    List the branches of a tree that were sampled but never expanded, or whose turn failed.
+
+    Args:
+        nodes (dict): Recorded node rows keyed by node id.
+
+    Returns:
+        list: (parent node id, child name, child intent) for every pending branch.
+    """
+    children = []
+    for node_id, row in nodes.items():
+        for index, idea in enumerate(row[5] or [], start=1):
+            child = node_id + str(index) + '-'
+            if child not in nodes or nodes[child][3] is None:
+                children.append((node_id, child, idea))
+    return children
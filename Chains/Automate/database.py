@@ -0,0 +1,39 @@
+# Import nessessary packages
+import os
+import sqlite3
+
+class ProcessConnection:
+    """
+    A SQLite connection opened once per process. A forked worker must not reuse the connection of its
+    parent, so a new one is opened and set up whenever the process id changed.
+
+    Attributes:
+        path (str): Path of the SQLite database.
+    """
+    def __init__(self, path: str, setup, **options):
+        """
+        Initialize the ProcessConnection instance.
+
+        Args:
+            path (str): Path of the SQLite database.
+            setup: Function taking a new connection, creating the tables and setting the pragmas it needs.
+            **options: Arguments of sqlite3.connect, e.g. timeout and isolation_level.
+        """
+        self.path = path
+        self.setup = setup
+        self.options = options
+        self._connection = None
+        self._pid = None
+
+    def get(self) -> sqlite3.Connection:
+        """
+        Get the connection of the current process.
+
+        Returns:
+            sqlite3.Connection: The database connection.
+        """
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, **self.options)
+            self.setup(self._connection)
+            self._pid = os.getpid()
+        return self._connection
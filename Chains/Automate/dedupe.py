@@ -0,0 +1,273 @@
+# Import nessessary packages
+import re
+import sqlite3
+import hashlib
+import struct
+
+from database import ProcessConnection
+
+#CONSTANTS
+# MinHash signature: NUM_PERMUTATIONS hashes split into BANDS bands of ROWS rows for the LSH lookup.
+# Ideas share a band with probability s^ROWS per band, so pairs above a Jaccard similarity of about
+# (1/BANDS)^(1/ROWS) = 0.5 are found as candidates, and their full signatures decide
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS = NUM_PERMUTATIONS // BANDS
+SHINGLE_SIZE = 4                    # Characters per shingle
+_PRIME = (1 << 61) - 1
+# Coefficients of the permutations, fixed so signatures stored by earlier runs stay comparable
+_PERMUTATIONS = [
+    (int.from_bytes(hashlib.blake2b(f"a{index}".encode(), digest_size=8).digest(), "big") % (_PRIME - 1) + 1,
+     int.from_bytes(hashlib.blake2b(f"b{index}".encode(), digest_size=8).digest(), "big") % _PRIME)
+    for index in range(NUM_PERMUTATIONS)
+]
+
+# Idea index of the current process, set by `open_idea_index`
+_INDEX = None
+
+def shingles(text: str) -> set:
+    """
+    Split an idea into overlapping character shingles, ignoring case, punctuation and spacing.
+
+    Args:
+        text (str): The idea.
+
+    Returns:
+        set: Hashes of the shingles.
+    """
+    normalized = " ".join(re.sub(r'[^\w\s]', ' ', text.lower()).split())
+    if len(normalized) <= SHINGLE_SIZE:
+        pieces = {normalized}
+    else:
+        pieces = {normalized[index:index + SHINGLE_SIZE] for index in range(len(normalized) - SHINGLE_SIZE + 1)}
+    return {int.from_bytes(hashlib.blake2b(piece.encode("utf-8"), digest_size=8).digest(), "big") for piece in pieces}
+
+def minhash(text: str) -> tuple:
+    """
+    Compute the MinHash signature of an idea.
+
+    Args:
+        text (str): The idea.
+
+    Returns:
+        tuple: NUM_PERMUTATIONS minimum hashes.
+    """
+    hashes = shingles(text)
+    return tuple(min((a * value + b) % _PRIME for value in hashes) for a, b in _PERMUTATIONS)
+
+def similarity(signature: tuple, other: tuple) -> float:
+    """
+    Estimate the Jaccard similarity of two ideas from their signatures.
+
+    Args:
+        signature (tuple): MinHash signature of the first idea.
+        other (tuple): MinHash signature of the second idea.
+
+    Returns:
+        float: Fraction of matching hashes.
+    """
+    return sum(a == b for a, b in zip(signature, other)) / NUM_PERMUTATIONS
+
+def band_keys(signature: tuple) -> list:
+    """
+    Get the LSH bucket of the signature in every band.
+
+    Args:
+        signature (tuple): MinHash signature of an idea.
+
+    Returns:
+        list: (band, bucket) pairs.
+    """
+    return [
+        (band, hashlib.blake2b(struct.pack(f"{ROWS}Q", *signature[band * ROWS:(band + 1) * ROWS]), digest_size=8).hexdigest())
+        for band in range(BANDS)
+    ]
+
+class IdeaIndex:
+    """
+    Index of the sub-intents already branched on, used to drop moderator ideas that paraphrase each other
+    or an idea explored elsewhere in the same tree before children are sampled, so no subtree of calls
+    is spent on a near-duplicate branch.
+    Ideas are compared by the MinHash of their character shingles and looked up through LSH bands,
+    so a lookup costs the same however many ideas are indexed. Ideas are indexed per tree, and with the
+    "run" scope they are also compared against every tree of the run. The index is stored in SQLite,
+    like the response cache, so the workers of the node engine share it.
+
+    Attributes:
+        path (str): Path of the SQLite database.
+        threshold (float): Estimated Jaccard similarity from which two ideas count as duplicates.
+        scope (str): "tree" to compare ideas within their tree, "run" to compare them across all trees.
+    """
+    def __init__(self, path: str, threshold: float = 0.5, scope: str = "tree"):
+        """
+        Initialize the IdeaIndex instance.
+
+        Args:
+            path (str): Path of the SQLite database.
+            threshold (float, optional): Similarity from which two ideas count as duplicates. Defaults to 0.5.
+            scope (str, optional): "tree" or "run". Defaults to "tree".
+        """
+        self.path = path
+        self.threshold = threshold
+        self.scope = scope
+        self._connection = ProcessConnection(path, self._setup, timeout=30, isolation_level=None, check_same_thread=False)
+
+    @staticmethod
+    def _setup(connection: sqlite3.Connection):
+        """
+        Set up a new connection to the index.
+
+        Args:
+            connection (sqlite3.Connection): The new connection.
+        """
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS ideas (id INTEGER PRIMARY KEY, doc_id TEXT, idea TEXT, signature BLOB)")
+        connection.execute("CREATE TABLE IF NOT EXISTS bands (band INTEGER, bucket TEXT, doc_id TEXT, idea_id INTEGER)")
+        connection.execute("CREATE INDEX IF NOT EXISTS bands_bucket ON bands(band, bucket)")
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        Get the connection of the current process.
+
+        Returns:
+            sqlite3.Connection: The database connection.
+        """
+        return self._connection.get()
+
+    def _candidates(self, doc_id, signature: tuple) -> list:
+        """
+        Get the signatures of indexed ideas sharing at least one band with a signature.
+
+        Args:
+            doc_id: Identifier for the conversation tree.
+            signature (tuple): MinHash signature of the idea.
+
+        Returns:
+            list: Signatures of the candidate ideas.
+        """
+        keys = band_keys(signature)
+        query = " OR ".join("(b.band = ? AND b.bucket = ?)" for _ in keys)
+        params = [value for key in keys for value in key]
+        if self.scope == "tree":
+            query = f"({query}) AND b.doc_id = ?"
+            params.append(str(doc_id))
+        rows = self.connection.execute(
+            f"SELECT DISTINCT i.id, i.signature FROM bands b JOIN ideas i ON i.id = b.idea_id WHERE {query}", params
+        ).fetchall()
+        return [struct.unpack(f"{NUM_PERMUTATIONS}Q", row[1]) for row in rows]
+
+    def distinct(self, doc_id, ideas: list) -> list:
+        """
+        Drop the ideas that duplicate an earlier idea of the list or an indexed idea.
+
+        Args:
+            doc_id: Identifier for the conversation tree.
+            ideas (list): The moderator ideas.
+
+        Returns:
+            list: The distinct ideas, in their original order.
+        """
+        kept, signatures = [], []
+        for idea in ideas:
+            signature = minhash(idea)
+            if any(similarity(signature, other) >= self.threshold for other in signatures + self._candidates(doc_id, signature)):
+                continue
+            kept.append(idea)
+            signatures.append(signature)
+        return kept
+
+    def add(self, doc_id, ideas: list):
+        """
+        Index the ideas a node branched on.
+
+        Args:
+            doc_id: Identifier for the conversation tree.
+            ideas (list): The sampled ideas.
+        """
+        connection = self.connection
+        connection.execute("BEGIN")
+        try:
+            for idea in ideas:
+                signature = minhash(idea)
+                idea_id = connection.execute(
+                    "INSERT INTO ideas (doc_id, idea, signature) VALUES (?, ?, ?)",
+                    (str(doc_id), idea, struct.pack(f"{NUM_PERMUTATIONS}Q", *signature)),
+                ).lastrowid
+                connection.executemany(
+                    "INSERT INTO bands VALUES (?, ?, ?, ?)",
+                    [(band, bucket, str(doc_id), idea_id) for band, bucket in band_keys(signature)],
+                )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def finish_tree(self, doc_id):
+        """
+        Drop the ideas of a finished tree, unless they are still compared across the run.
+
+        Args:
+            doc_id: Identifier for the conversation tree.
+        """
+        if self.scope == "tree":
+            self.connection.execute("DELETE FROM bands WHERE doc_id = ?", (str(doc_id),))
+            self.connection.execute("DELETE FROM ideas WHERE doc_id = ?", (str(doc_id),))
+
+def open_idea_index(path: str, threshold: float, scope: str):
+    """
+    Open the idea index of the current process when deduplication is on, reusing it when already open on the same path.
+
+    Args:
+        path (str): Path of the SQLite database.
+        threshold (float): Similarity from which two ideas count as duplicates.
+        scope (str): "tree", "run", or None to keep every idea.
+
+    Returns:
+        IdeaIndex: The index the module functions use, or None when deduplication is off.
+    """
+    global _INDEX
+    if scope is None:
+        _INDEX = None
+        return None
+    if _INDEX is None or _INDEX.path != path:
+        _INDEX = IdeaIndex(path, threshold, scope)
+    _INDEX.threshold, _INDEX.scope = threshold, scope
+    return _INDEX
+
+def distinct_ideas(doc_id, ideas: list) -> list:
+    """
+    Drop near-duplicate ideas with the idea index of the current process, if one is open.
+
+    Args:
+        doc_id: Identifier for the conversation tree.
+        ideas (list): The moderator ideas.
+
+    Returns:
+        list: The distinct ideas, `ideas` when no index is open.
+    """
+    if _INDEX is None:
+        return ideas
+    return _INDEX.distinct(doc_id, ideas)
+
+def index_ideas(doc_id, ideas: list):
+    """
+    Index the ideas a node branched on in the idea index of the current process, if one is open.
+
+    Args:
+        doc_id: Identifier for the conversation tree.
+        ideas (list): The sampled ideas.
+    """
+    if _INDEX is not None and ideas:
+        _INDEX.add(doc_id, ideas)
+
+def ideas_done(doc_id):
+    """
+    Drop the ideas of a finished tree from the idea index of the current process, if one is open.
+
+    Args:
+        doc_id: Identifier for the conversation tree.
+    """
+    if _INDEX is not None:
+        _INDEX.finish_tree(doc_id)
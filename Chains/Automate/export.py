@@ -0,0 +1,227 @@
+# Import nessessary packages
+import os
+import gzip
+import json
+import argparse
+from collections import OrderedDict
+
+from storage import load_tree, rebuild_conversations
+from writer import read_shards
+
+#CONSTANTS
+# Rows of a Parquet record batch, the memory bound of the Parquet export
+PARQUET_BATCH_ROWS = 10000
+# Trees whose exported nodes are remembered for prefix deduplication. Leaves of a tree are read
+# together in every output layout, so only the most recent trees need to be kept
+DEDUPE_TREES = 1024
+# Message roles of each format
+ROLES = {
+    "chatml": ("role", "content", {"system": "system", "user": "user", "assistant": "assistant"}),
+    "sharegpt": ("from", "value", {"system": "system", "user": "human", "assistant": "gpt"}),
+}
+
+def read_leaves(path: str):
+    """
+    Stream the leaf conversations of a run's output, whatever its layout: per-leaf JSON files,
+    {doc_id}.tree.json node tables, or "leaves" and "trees" shards. Only one tree is held in memory at a time.
+
+    Args:
+        path (str): Output directory of the run.
+
+    Yields:
+        tuple: (leaf name, conversation record) for every leaf.
+    """
+    for record in read_shards(path, "leaves"):
+        yield record["leaf"], record["conversation"]
+    for tree in read_shards(path, "trees"):
+        yield from rebuild_conversations(tree)
+
+    with os.scandir(path) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.name.startswith('@'):
+            continue
+        if entry.is_file() and entry.name.endswith(".tree.json"):
+            yield from rebuild_conversations(load_tree(entry.path))
+        elif entry.is_dir():
+            # Leaf files are named after their branch without the trailing '-'
+            for name in sorted(os.listdir(entry.path)):
+                if name.endswith(".json"):
+                    with open(os.path.join(entry.path, name), "r") as file:
+                        yield name[:-len(".json")] + '-', json.load(file)
+
+def conversation_fields(conversation: list) -> dict:
+    """
+    Merge a conversation record, a list of single-key dicts, into one dict.
+
+    Args:
+        conversation (list): The conversation record.
+
+    Returns:
+        dict: "id", "intent", "domain", "model list", "timestamp", "interactions" and "moderator".
+    """
+    fields = {}
+    for entry in conversation:
+        fields.update(entry)
+    return fields
+
+def export_record(leaf: str, conversation: list, style: str, system: str = None, seen: set = None) -> dict:
+    """
+    Convert a leaf conversation into a training record with its metadata.
+
+    Args:
+        leaf (str): Branch name of the leaf.
+        conversation (list): The conversation record.
+        style (str): "chatml" or "sharegpt".
+        system (str, optional): System message put first in every conversation. Defaults to None.
+        seen (set, optional): Node ids of the tree already exported. Their assistant turns get a weight
+            of 0, so a turn shared by several leaves is trained on once. Defaults to None.
+
+    Returns:
+        dict: The record, None when every turn was already exported or the leaf has no turn.
+    """
+    fields = conversation_fields(conversation)
+    role_key, content_key, roles = ROLES[style]
+    segments = leaf.split('-')[:-1]
+    messages = []
+    if system:
+        messages.append({role_key: roles["system"], content_key: system})
+    new_turns = 0
+    for depth, turn in enumerate(fields["interactions"]):
+        node_id = '-'.join(segments[:depth + 1]) + '-'
+        messages.append({role_key: roles["user"], content_key: turn["user"]})
+        messages.append({role_key: roles["assistant"], content_key: turn["assistant"]})
+        if seen is not None:
+            messages[-1]["weight"] = 0 if node_id in seen else 1
+            new_turns += node_id not in seen
+            seen.add(node_id)
+    if not fields["interactions"] or (seen is not None and not new_turns):
+        return None
+    return {
+        "messages" if style == "chatml" else "conversations": messages,
+        "id": fields["id"],
+        "intent": fields["intent"],
+        "domain": fields["domain"],
+        "branch": leaf,
+        "depth": len(fields["interactions"]) - 1,
+    }
+
+def export_records(path: str, style: str, system: str = None, dedupe_prefixes: bool = False):
+    """
+    Stream the training records of a run's output.
+
+    Args:
+        path (str): Output directory of the run.
+        style (str): "chatml" or "sharegpt".
+        system (str, optional): System message put first in every conversation. Defaults to None.
+        dedupe_prefixes (bool, optional): Weight turns already exported by another leaf of the tree 0,
+            and skip leaves exported twice. Defaults to False.
+
+    Yields:
+        dict: One record per leaf.
+    """
+    trees = OrderedDict()
+    for leaf, conversation in read_leaves(path):
+        seen = None
+        if dedupe_prefixes:
+            doc_id = conversation[0].get("id")
+            seen = trees.pop(doc_id, None) or set()
+            trees[doc_id] = seen
+            if len(trees) > DEDUPE_TREES:
+                trees.popitem(last=False)
+        record = export_record(leaf, conversation, style, system, seen)
+        if record is not None:
+            yield record
+
+def write_jsonl(records, out_path: str) -> int:
+    """
+    Write records as JSON lines, gzip-compressed when the path ends with ".gz".
+
+    Args:
+        records: Iterable of records.
+        out_path (str): Path of the output file.
+
+    Returns:
+        int: Number of records written.
+    """
+    count = 0
+    opener = gzip.open if out_path.endswith(".gz") else open
+    with opener(out_path, "wt", encoding="utf-8") as file:
+        for record in records:
+            file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+def write_parquet(records, out_path: str, batch_rows: int = PARQUET_BATCH_ROWS) -> int:
+    """
+    Write ChatML records to a Parquet file, one record batch of `batch_rows` rows at a time.
+    Needs the `pyarrow` package, imported only for Parquet exports.
+
+    Args:
+        records: Iterable of ChatML records.
+        out_path (str): Path of the output file.
+        batch_rows (int, optional): Rows of each record batch. Defaults to PARQUET_BATCH_ROWS.
+
+    Returns:
+        int: Number of records written.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    message = pa.struct([("role", pa.string()), ("content", pa.string()), ("weight", pa.int8())])
+    schema = pa.schema([
+        ("messages", pa.list_(message)),
+        ("id", pa.string()),
+        ("intent", pa.string()),
+        ("domain", pa.string()),
+        ("branch", pa.string()),
+        ("depth", pa.int32()),
+    ])
+
+    count = 0
+    batch = []
+    with pq.ParquetWriter(out_path, schema, compression="zstd") as writer:
+        for record in records:
+            # Ids are integers or strings depending on the input, stored as strings
+            batch.append(dict(record, id=str(record["id"])))
+            if len(batch) >= batch_rows:
+                writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+            count += len(batch)
+    return count
+
+def export(path: str, out_path: str, style: str = "chatml", system: str = None, dedupe_prefixes: bool = False) -> int:
+    """
+    Export a run's output to a training file.
+
+    Args:
+        path (str): Output directory of the run.
+        out_path (str): Path of the training file.
+        style (str, optional): "chatml", "sharegpt" or "parquet" (ChatML messages). Defaults to "chatml".
+        system (str, optional): System message put first in every conversation. Defaults to None.
+        dedupe_prefixes (bool, optional): Train every turn shared by several leaves once. Defaults to False.
+
+    Returns:
+        int: Number of records written.
+    """
+    records = export_records(path, "chatml" if style == "parquet" else style, system, dedupe_prefixes)
+    if style == "parquet":
+        return write_parquet(records, out_path)
+    return write_jsonl(records, out_path)
+
+if __name__ == "__main__":
+    # Usage: python export.py <output_dir> <train.jsonl[.gz]|train.parquet> [--format chatml|sharegpt|parquet] [--dedupe-prefixes]
+    parser = argparse.ArgumentParser(description="Export generated conversation trees to training data.")
+    parser.add_argument("path", help="output directory of a run")
+    parser.add_argument("out", help="training file to write, .gz for compressed JSONL")
+    parser.add_argument("--format", choices=["chatml", "sharegpt", "parquet"], help="record format, from the file extension by default")
+    parser.add_argument("--system", help="system message put first in every conversation")
+    parser.add_argument("--dedupe-prefixes", action="store_true", help="train every turn shared by several leaves once")
+    args = parser.parse_args()
+
+    style = args.format or ("parquet" if args.out.endswith(".parquet") else "chatml")
+    count = export(args.path, args.out, style, args.system, args.dedupe_prefixes)
+    print(f"Exported {count} conversations to {args.out}")
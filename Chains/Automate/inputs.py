@@ -0,0 +1,92 @@
+# Import nessessary packages
+import csv
+import hashlib
+
+#CONSTANTS
+# Hex digits of a doc_id: 64 bits keep collisions unlikely up to billions of rows
+DOC_ID_BYTES = 8
+# Most recent doc_ids remembered to skip repeated rows, so memory stays bounded on inputs of any size
+REPEAT_WINDOW = 100000
+
+def make_doc_id(intent: str, domain: str, variant: str = "") -> str:
+    """
+    Derive the identifier of a tree from its input row, so the same row gets the same id on every
+    machine and in every run, whatever its line number or the rows around it.
+
+    Args:
+        intent (str): The intent of the row.
+        domain (str): The domain of the row.
+        variant (str, optional): Distinguishes several trees of the same intent and domain. Defaults to "".
+
+    Returns:
+        str: The doc_id, 16 hex digits.
+    """
+    # The unit separator cannot occur in a CSV field, so ("a,b", "c") and ("a", "b,c") get different ids
+    key = "\x1f".join((intent, domain, variant))
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=DOC_ID_BYTES).hexdigest()
+
+def parse_shard(value: str) -> tuple:
+    """
+    Parse a "--shard i/N" value.
+
+    Args:
+        value (str): "i/N" with 0 <= i < N.
+
+    Returns:
+        tuple: (i, N).
+    """
+    index, _, count = value.partition('/')
+    index, count = int(index), int(count)
+    if not 0 <= index < count:
+        raise ValueError(f"Shard {value} is not of the form i/N with 0 <= i < N")
+    return index, count
+
+def in_shard(doc_id: str, shard: tuple) -> bool:
+    """
+    Decide whether a tree belongs to a shard. Shards are drawn from the doc_id, so every machine can
+    select its rows from the same file without coordination, and a row stays in its shard when the file
+    is reordered or extended.
+
+    Args:
+        doc_id (str): Identifier of the tree.
+        shard (tuple): (i, N), or None for every tree.
+
+    Returns:
+        bool: True when the tree is generated by this shard.
+    """
+    return shard is None or int(doc_id, 16) % shard[1] == shard[0]
+
+def read_inputs(path: str, shard: tuple = None):
+    """
+    Stream the rows of an input file as CSV: "intent, domain" with an optional third "variant" column.
+    Fields containing commas are quoted ("Compare lists, tuples and sets", Python). Rows are read one at
+    a time, so the file never has to fit in memory, and rows of other shards are skipped as they are read.
+    A row repeated within REPEAT_WINDOW rows of its shard is yielded once. A repeat further apart is yielded again:
+    it is skipped when the checkpoint already marks its tree done, or by the queue engine, which enqueues a doc_id once,
+    and is otherwise generated again with the same seed.
+
+    Args:
+        path (str): Path of the input file.
+        shard (tuple, optional): (i, N) to read only the i-th of N shards. Defaults to None.
+
+    Yields:
+        tuple: (doc_id, (intent, domain)) for every row of the shard.
+    """
+    # doc_ids of the last REPEAT_WINDOW rows yielded, oldest first
+    seen = {}
+    with open(path, 'r', newline='', encoding="utf-8") as file:
+        for line_number, row in enumerate(csv.reader(file, skipinitialspace=True), start=1):
+            fields = [field.strip() for field in row]
+            if not any(fields):
+                continue
+            if len(fields) not in (2, 3):
+                print(f"Skipping line {line_number} of {path}: expected 'intent, domain[, variant]', got {len(fields)} fields")
+                continue
+            intent, domain = fields[0], fields[1]
+            doc_id = make_doc_id(intent, domain, fields[2] if len(fields) == 3 else "")
+            if not in_shard(doc_id, shard) or doc_id in seen:
+                continue
+            seen[doc_id] = None
+            if len(seen) > REPEAT_WINDOW:
+                del seen[next(iter(seen))]
+            yield doc_id, (intent, domain)
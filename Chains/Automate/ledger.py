@@ -0,0 +1,178 @@
+# Import nessessary packages
+import os
+import sys
+import json
+import time
+import fcntl
+from contextvars import ContextVar
+
+#CONSTANTS
+# Price in dollars per million tokens, by model
+TOKEN_PRICES = {
+    "mistralai/Mixtral-8x7B-Instruct-v0.1": 0.50,
+}
+DEFAULT_TOKEN_PRICE = 0.50
+# Role names as they appear in the per-doc summary
+ROLE_TITLES = {"user": "User LLM", "assistant": "Assistant LLM", "moderator": "Moderator LLM"}
+
+# Fields describing where a call is made (doc_id, node, ...), added to every ledger entry
+_CALL_CONTEXT = ContextVar("call_context", default={})
+# Ledger of the current process, set by `open_ledger`
+_LEDGER = None
+
+class Ledger:
+    """
+    An append-only JSONL ledger safe to share between processes.
+    Each entry is written as one line with a single write on a file opened in append mode, under an
+    exclusive lock, so concurrent workers never interleave or lose entries.
+
+    Attributes:
+        path (str): Path of the ledger file.
+    """
+    def __init__(self, path: str):
+        """
+        Initialize the Ledger instance.
+
+        Args:
+            path (str): Path of the ledger file.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def append(self, entry: dict):
+        """
+        Append an entry to the ledger.
+
+        Args:
+            entry (dict): JSON serializable entry.
+        """
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            os.write(self.fd, line)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+def read_jsonl(path: str):
+    """
+    Read the entries of a JSONL file written by a Ledger, such as the call ledger, the spans or the checkpoint.
+    A worker killed mid-write can leave a partial last line, so lines that do not decode are skipped.
+
+    Args:
+        path (str): Path of the JSONL file.
+
+    Yields:
+        dict: One entry.
+    """
+    with open(path, "r") as file:
+        for line in file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+def token_cost(model: str, tokens: int) -> float:
+    """
+    Get the price of tokens used on a model.
+
+    Args:
+        model (str): The name of the language model.
+        tokens (int): Token count.
+
+    Returns:
+        float: Cost in dollars.
+    """
+    return (tokens / 1000000) * TOKEN_PRICES.get(model, DEFAULT_TOKEN_PRICE)
+
+def open_ledger(path: str) -> Ledger:
+    """
+    Open the ledger of the current process, reusing it when already open on the same path.
+
+    Args:
+        path (str): Path of the ledger file.
+
+    Returns:
+        Ledger: The ledger that `record_call` writes to.
+    """
+    global _LEDGER
+    if _LEDGER is None or _LEDGER.path != path:
+        _LEDGER = Ledger(path)
+    return _LEDGER
+
+def set_call_context(**fields):
+    """
+    Set fields added to the ledger entries of calls made in the current context, e.g. doc_id and node.
+    Asyncio tasks created afterwards inherit them without affecting their siblings.
+
+    Args:
+        **fields: Fields to add or replace.
+    """
+    _CALL_CONTEXT.set({**_CALL_CONTEXT.get(), **fields})
+
+def get_call_context() -> dict:
+    """
+    Get the fields describing where the current call is made.
+
+    Returns:
+        dict: The current call context.
+    """
+    return _CALL_CONTEXT.get()
+
+def record_call(**entry):
+    """
+    Record one LLM call in the ledger of the current process, if one is open.
+
+    Args:
+        **entry: Fields of the call, e.g. role, model, tokens, latency and retries.
+    """
+    if _LEDGER is None:
+        return
+    _LEDGER.append({"time": time.time(), **_CALL_CONTEXT.get(), **entry})
+
+def summarize(path: str) -> list:
+    """
+    Aggregate the per-call entries of a ledger into the per-doc token and cost summary.
+
+    Args:
+        path (str): Path of the ledger file.
+
+    Returns:
+        list: One summary dict per doc_id, in order of first appearance.
+    """
+    docs = {}
+    for entry in read_jsonl(path):
+        if "role" not in entry:
+            continue
+        doc = docs.setdefault(entry.get("doc_id"), {"roles": {}, "hits": 0, "misses": 0})
+        # Tokens are summed per model and priced once at the end
+        models = doc["roles"].setdefault(entry["role"], {})
+        models[entry.get("model")] = models.get(entry.get("model"), 0) + (entry.get("tokens") or 0)
+        if entry.get("cached") is True:
+            doc["hits"] += 1
+        elif entry.get("cached") is False:
+            doc["misses"] += 1
+
+    summary = []
+    for doc_id, doc in docs.items():
+        token_data = {"doc_id": doc_id}
+        for role, title in ROLE_TITLES.items():
+            models = doc["roles"].get(role, {})
+            token_data[title] = {
+                "token count": sum(models.values()),
+                "token cost": f'$ {sum(token_cost(model, tokens) for model, tokens in models.items())}'
+            }
+        if doc["hits"] or doc["misses"]:
+            token_data["Response cache"] = {"hits": doc["hits"], "misses": doc["misses"]}
+        summary.append(token_data)
+    return summary
+
+if __name__ == "__main__":
+    # Usage: python ledger.py <@-ledger.jsonl> [@-token_counts.json]
+    # Prints the per-doc cost summary, or writes it to the given file
+    summary = summarize(sys.argv[1])
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "w") as file:
+            json.dump(summary, file, indent=4)
+    else:
+        print(json.dumps(summary, indent=4))
@@ -1,262 +1,1074 @@
 # Import nessessary packages
-import time
 import json
 import os
 import random
+import asyncio
+import argparse
 from joblib import Parallel, delayed
 
 # Import nessessary Class objects and functions
-from models import UserLLM, AssistantLLM, ModeratorLLM
+import models
+from models import get_roles
+from ledger import open_ledger, set_call_context
+from storage import TreeRecorder, conversation_record, node_from_table
+from tree import TreeNode
+from checkpoint import open_checkpoint, checkpoint_node, checkpoint_done, load_checkpoint, pending_children
+from scheduler import NodeScheduler, Frontier
+from rate_limiter import estimate_tokens
+from budget import open_budget, budget_children, budget_close_node, budget_exhausted, budget_done
+from telemetry import open_tracer, span, metrics
+from dedupe import open_idea_index, distinct_ideas, index_ideas, ideas_done
+from writer import open_writer, write_record, after_writes, flush_writer, close_writer
+from inputs import read_inputs, parse_shard
+from planner import plan, load_profile
+from seeds import tree_seed, node_seed
+from workqueue import WorkQueue, worker_name
 
 #CONSTANTS
-# Cache model names
-MODEL_NAMES = {
-    "user": UserLLM().get_model_name(),
-    "assistant": AssistantLLM().get_model_name(),
-    "moderator": ModeratorLLM().get_model_name()
-}
-# File paths
+# File paths, overridden by the command line
+INPUT_FILE_PATH = "/home/varun/Varun/IFT/Chains/Automate/Files/Sample_Gen_1/input_re.txt"
 DATA_GEN_FILE_PATH = "/home/varun/Varun/IFT/Chains/Automate/@Gen/@@rev2/1"
+CHECKPOINT_FILE_NAME = "@-checkpoint.jsonl"    # Frontier of completed nodes, used to resume interrupted runs
+BUDGET_FILE_NAME = "@-budget.json"              # Spend and reservations shared by the workers when a budget is set
+SPANS_FILE_NAME = "@-spans.jsonl"               # Spans of role calls, parsing and writes, see telemetry.py
+METRICS_FILE_NAME = "@-metrics.prom"            # Prometheus metrics aggregated from the spans at the end of a run
+IDEAS_FILE_NAME = "@-ideas.sqlite"              # MinHash index of the sub-intents branched on, see dedupe.py
+QUEUE_FILE_NAME = "@-queue.sqlite"              # Trees of a multi-host run and their leases, see workqueue.py
+RATE_LIMITS_DIR_NAME = "@-rate_limits"          # Rate limiter state shared by the hosts of a "queue" run, see rate_limiter.py
+# Optional filter dropping moderator ideas that paraphrase each other or a branch already explored before sampling.
+# "tree" compares the ideas of each tree, "run" compares them across all trees, None (the default) keeps every idea
+DEDUPE_SCOPE = None
+DEDUPE_THRESHOLD = 0.5              # Estimated Jaccard similarity of character shingles from which ideas are duplicates
+# Token and dollar limits for the whole run and for each tree, None for no limit. Children are pruned
+# once the remaining budget cannot pay for their estimated subtrees, and no new tree starts once the run budget is spent
+BUDGET_LIMITS = {"run_tokens": None, "run_dollars": None, "tree_tokens": None, "tree_dollars": None}
+# Output layout: "leaf" writes {doc_id}/{name}.json per leaf, "tree" writes each tree once as a node table
+STORAGE_MODE = "leaf"
+# Trees being collected in "tree" storage mode, keyed by doc_id
+_OPEN_TREES = {}
+# Trees with branches whose turn failed, left unfinished in the checkpoint so a rerun regenerates those branches
+_FAILED_TREES = set()
+# Output files: "files" writes every leaf or tree and error to its own file on the generating thread,
+# "shards" hands them to a background writer batching them into a few compressed JSONL shards (see writer.py)
+OUTPUT_FORMAT = "files"
+SHARD_SETTINGS = {
+    "compression": "gzip",          # "gzip", or "zstd" with the zstandard package
+    "max_bytes": 256 << 20,         # Compressed size from which a shard is rotated
+    "max_seconds": 600.0,           # Age from which a shard is rotated
+    "fsync": "rotate",              # "never", "rotate" when a shard is closed, or "batch" after every written batch
+    "queue_size": 1024,             # Records waiting for the writer before the generator blocks
+}
+# Execution engine: "async" expands sibling branches concurrently in a single event loop, "frontier" expands the
+# pending nodes of all open trees from one priority queue in a single event loop, "nodes" schedules single node
+# expansions over N_JOBS worker processes, "joblib" runs one tree per joblib task, "queue" leases trees from
+# QUEUE_FILE_NAME in the output directory, shared by any number of workers on any number of hosts
+ENGINE = "async"
+N_JOBS = os.cpu_count()             # Worker processes of the "nodes" and "joblib" engines
+# Async engine settings
+MAX_CONCURRENT_REQUESTS = 16        # Global limit on LLM requests in flight across all trees
+MAX_OPEN_TREES = 64                 # Trees generated at once, the next input row is read when one finishes
+# Order of the pending nodes of the "frontier" and "nodes" engines: "depth" finishes a tree before opening the next,
+# "breadth" expands the shallowest nodes of all open trees first, "oldest" the nodes of the tree opened first,
+# and "cheapest" the nodes with the shortest history to send
+FRONTIER_PRIORITY = "depth"
+# Share of the input rows generated by this machine as (i, N), None for every row
+INPUT_SHARD = None
+# Only load the input rows into the queue of the "queue" engine, for workers started separately
+ENQUEUE = False
+QUEUE_SETTINGS = {
+    "lease_seconds": 600.0,         # Time a tree stays leased without a heartbeat before another worker takes it over
+    "heartbeat_seconds": 60.0,      # Interval at which a worker renews its leases, well below lease_seconds
+    "max_attempts": 3,              # Leases of a tree before it is left failed
+    "poll_seconds": 10.0,           # Wait of an idle worker while other workers still hold leases
+}
+# Only estimate the run with the capacity planner, without calling any model
+DRY_RUN = False
+# Seed of the run: every tree draws its branching and call seeds from it and its doc_id, so rerunning
+# an input with the same seed regenerates the same tree shape and hits the response cache
+RUN_SEED = 0
+TURNS = 4                           # Turns of every conversation
 
-def generate_prompt(is_first_prompt: bool, intent: str, domain: str, conv_turns: list) -> list:
+# Model names of the roles, filled on first use
+_MODEL_NAMES = {}
+
+def get_model_names() -> dict:
     """
-    Generate a user prompt and response prompt one turn of conversation.
+    Get the model names of the roles for the saved conversations, without building any client.
+
+    Returns:
+        dict: Model name by role.
+    """
+    if not _MODEL_NAMES:
+        _MODEL_NAMES.update({role: llm.get_model_name() for role, llm in get_roles().items()})
+    return _MODEL_NAMES
+
+def open_run_files():
+    """
+    Open the files the current process shares with the other workers of the run: the call ledger,
+    the checkpoint, the budget state, the span trace and the idea index, and the shard writer of this process.
+    """
+    open_ledger(f"{DATA_GEN_FILE_PATH}/@-ledger.jsonl")
+    open_checkpoint(f"{DATA_GEN_FILE_PATH}/{CHECKPOINT_FILE_NAME}")
+    open_budget(f"{DATA_GEN_FILE_PATH}/{BUDGET_FILE_NAME}", BUDGET_LIMITS)
+    open_tracer(f"{DATA_GEN_FILE_PATH}/{SPANS_FILE_NAME}")
+    open_idea_index(f"{DATA_GEN_FILE_PATH}/{IDEAS_FILE_NAME}", DEDUPE_THRESHOLD, DEDUPE_SCOPE)
+    if OUTPUT_FORMAT == "shards":
+        open_writer(DATA_GEN_FILE_PATH, SHARD_SETTINGS)
+
+def save_error(intent: str, domain: str, name: str, doc_id: str):
+    """
+    Record a branch that ended on an error, in @-errors.txt or in the "errors" shards.
+
+    Args:
+        intent (str): The intent of the conversation tree.
+        domain (str): The domain or topic of the conversation.
+        name (str): Name produced for the conversation tree branch.
+        doc_id (str): Identifier for the conversation tree.
+    """
+    if OUTPUT_FORMAT == "shards":
+        write_record("errors", {"id": doc_id, "intent": intent, "domain": domain, "node": name})
+        return
+    with open(f'{DATA_GEN_FILE_PATH}/@-errors.txt','a') as file:
+        file.write(f"{intent},{domain},{name}\n")
+
+def export_metrics():
+    """
+    Aggregate the spans of the run into Prometheus metrics in METRICS_FILE_NAME.
+    """
+    spans_path = f"{DATA_GEN_FILE_PATH}/{SPANS_FILE_NAME}"
+    if os.path.exists(spans_path):
+        with open(f"{DATA_GEN_FILE_PATH}/{METRICS_FILE_NAME}", "w") as file:
+            file.write(metrics(spans_path))
+
+def enter_node(doc_id: str, name: str) -> int:
+    """
+    Tag the ledger entries of a node's calls, and seed its calls and sampling from its tree and branch.
+    Every async branch runs in its own task context, so the tags of concurrent nodes do not mix.
+
+    Args:
+        doc_id (str): Identifier for the conversation tree.
+        name (str): Name produced for the conversation tree branch of the node.
+
+    Returns:
+        int: Seed of the node.
+    """
+    seed = node_seed(tree_seed(doc_id, RUN_SEED), name)
+    set_call_context(node=name, seed=seed)
+    return seed
+
+def branch_error(error: Exception, intent: str, domain: str, last: TreeNode, doc_id: str, name: str) -> tuple:
+    """
+    Record a branch that ended on an error. The branch is left pending rather than saved, so a rerun regenerates it.
+
+    Args:
+        error (Exception): The error of the failed call.
+        intent (str): The intent of the branch.
+        domain (str): The domain or topic of the conversation.
+        last (TreeNode): The last generated turn of the branch, None when the first turn of the tree failed.
+        doc_id (str): Identifier for the conversation tree.
+        name (str): Name produced for the conversation tree branch.
+
+    Returns:
+        tuple: (None, name, intent), the leaf of a failed branch for `save_conversation`.
+    """
+    print(f'Exception:\n{error}')
+    save_error(last.path()[0].intent if last else intent, domain, name, doc_id)
+    return None, name, intent
+
+def branch_children(turns: int, intent: str, node: TreeNode, doc_id: str, name: str, seed: int, mod_ideas: list) -> tuple:
+    """
+    Sample the children of a node among the moderator ideas: drop near-duplicates, draw the children from the
+    node's seed, keep those the budget can pay for, and checkpoint the node.
+
+    Args:
+        turns (int): The number of turns for the conversation.
+        intent (str): The intent of the node.
+        node (TreeNode): The generated turn of the node.
+        doc_id (str): Identifier for the conversation tree.
+        name (str): Name produced for the conversation tree branch of the node.
+        seed (int): Seed of the node, see `enter_node`.
+        mod_ideas (list): The sub-intents suggested by the moderator.
+
+    Returns:
+        children (list): (intent, parent, name) of every child branch to expand.
+        leaf (tuple): (node, name, intent) when no child is kept, otherwise None.
+    """
+    # Drop ideas that paraphrase each other or a branch explored elsewhere in the tree
+    low = 0 if node.depth >= 1 else 1
+    with span("dedupe", "filter", ideas=len(mod_ideas)) as fields:
+        mod_ideas = distinct_ideas(doc_id, mod_ideas) or mod_ideas[:low]
+        fields["kept"] = len(mod_ideas)
+    # Sample the children, at least one on the first turns, never more than the distinct ideas
+    rng = random.Random(seed)
+    mod_ideas = rng.sample(mod_ideas, min(len(mod_ideas), rng.randint(low, 5)))
+    # Keep only the children whose estimated subtrees the remaining budget can pay for
+    mod_ideas = mod_ideas[:budget_children(doc_id, name, len(mod_ideas), turns - node.depth - 1)]
+    if len(mod_ideas) == 0:
+        return [], (node, name, intent)
+    index_ideas(doc_id, mod_ideas)
+
+    # Keep the moderator ideas on the node for the output
+    node.ideas = mod_ideas
+    checkpoint_node(doc_id, name, node.turn(), mod_ideas, leaf=False)
+
+    # Every child branch continues from the node, sharing the turns above it
+    children = [(mod_idea, node, name + str(index) + '-') for index, mod_idea in enumerate(mod_ideas, start=1)]
+    return children, None
+
+def save_leaf(leaf: tuple, domain: str, doc_id: str):
+    """
+    Save the leaf a node expansion ended its branch with, if any.
+
+    Args:
+        leaf (tuple): (node, name, intent) returned by `expand_node`, or None.
+        domain (str): The domain or topic of the conversation.
+        doc_id (str): Identifier for the conversation tree.
+    """
+    if leaf is not None:
+        leaf_node, leaf_name, leaf_intent = leaf
+        save_conversation(leaf_node, domain, leaf_name, doc_id, intent=leaf_intent)
+
+def open_tree(intent: str, domain: str, doc_id: str) -> bool:
+    """
+    Prepare the current process to generate a tree: record its calls in the shared ledger and its completed
+    nodes in the checkpoint, unless the run budget is spent.
 
     Args:
-        is_first_prompt (bool): Indicates whether it's the first prompt in the conversation.
         intent (str): The intent of the conversation.
         domain (str): The domain or topic of the conversation.
-        conv_turns (list): List of tuples representing conversation turns.
+        doc_id (str): Identifier for the conversation tree.
 
     Returns:
-        list: Updated conversation turns.
+        bool: False when the tree is skipped on a spent budget.
     """
-    # dict to have token counts
-    conv_tokens = dict()
+    print(f"Staring {intent} and {domain}")
+    open_run_files()
+    set_call_context(doc_id=doc_id)
+    if budget_exhausted():
+        print(f"Budget spent, skipping {intent} and {domain}")
+        return False
+    return True
 
-    # Create a UserLLM instance to handle user prompt
-    user = UserLLM(conv_turns)
+def tree_branches(intent: str, domain: str, doc_id: str, resume_state: dict = None) -> list:
+    """
+    List the branches a tree starts from: its root, or the branches of a partially generated tree that
+    were sampled but never generated, once its saved leaves are replayed.
 
-    # Generate initiation prompt if it is the first prompt in the conversation, with retries
-    if is_first_prompt:
-        retry_count = 0
-        while retry_count < 3:
-            try:
-                prompt, token = user.generate_initiation_prompt(intent, domain)
-                conv_tokens["user"] = token
-                break
-            except Exception as e:
-                print(f'Error occurred: {e}. Retrying...')
-                retry_count += 1
-                continue
+    Args:
+        intent (str): The intent of the conversation.
+        domain (str): The domain or topic of the conversation.
+        doc_id (str): Identifier for the conversation tree.
+        resume_state (dict, optional): Checkpointed {"nodes", "leaves"} of the tree. Defaults to None.
+
+    Returns:
+        list: (intent, parent, name) of every branch to expand, empty when a resumed tree has none left.
+    """
+    # A root whose turn failed is generated again like a new tree
+    if not resume_state or resume_state["nodes"].get('C-', [None] * 4)[3] is None:
+        return [(intent, None, 'C-')]
+    replay_leaves(domain, doc_id, resume_state)
+    nodes = resume_state["nodes"]
+    return [(idea, node_from_table(nodes, parent), child) for parent, child, idea in pending_children(nodes)]
+
+def finish_tree(doc_id: str) -> bool:
+    """
+    Save a tree once all of its nodes are expanded, and release its budget and idea index state.
+    A tree with failed branches is not marked done, so a rerun or another queue lease regenerates them.
+
+    Args:
+        doc_id (str): Identifier for the conversation tree.
+
+    Returns:
+        bool: True when every branch of the tree was generated.
+    """
+    save_tree(doc_id)
+    budget_done(doc_id)
+    ideas_done(doc_id)
+    if doc_id in _FAILED_TREES:
+        _FAILED_TREES.discard(doc_id)
+        print(f"Done {doc_id} with failed branches")
+        return False
+    # Mark the tree done only once its output is written
+    after_writes(lambda: checkpoint_done(doc_id))
+    print(f"Done {doc_id}")
+    return True
+
+def generate_prompt(intent: str, domain: str, parent: TreeNode, name: str) -> TreeNode:
+    """
+    Generate a user prompt and response prompt one turn of conversation.
+
+    Args:
+        intent (str): The intent of the conversation.
+        domain (str): The domain or topic of the conversation.
+        parent (TreeNode): The previous turn of the conversation, None for the first prompt.
+        name (str): Name produced for the conversation tree branch of the turn.
+
+    Returns:
+        TreeNode: The new turn, linked to its parent.
+    """
+    # Reuse the long-lived role sessions of this worker
+    roles = get_roles()
+    user = roles["user"]
+
+    # Generate initiation prompt if it is the first prompt in the conversation, otherwise a continuation prompt.
+    # Transient errors are retried and malformed outputs repaired by the role itself
+    if parent is None:
+        prompt, _ = user.generate_initiation_prompt(intent, domain)
     else:
-        # If not the first prompt, attempt to generate a continuation prompt, with retries
-        retry_count = 0
-        while retry_count < 3:
-            try:
-                prompt, token = user.generate_continuation_prompt(intent, domain)
-                conv_tokens["user"] = token
-                break
-            except Exception as e:
-                print(f'Error occurred: {e}. Retrying...')
-                retry_count += 1
-                continue
-    
-    # Create a AssistantLLM instance to handle response generation
-    assistant = AssistantLLM(history=conv_turns)
+        prompt, _ = user.generate_continuation_prompt(intent, domain, parent)
 
     # Generate a response from the assistant based on the generated prompt
-    response, token = assistant.respond_to_user_prompt(prompt)
-    conv_tokens["assistant"] = token
+    response, _ = roles["assistant"].respond_to_user_prompt(prompt, parent)
 
-    # Append the conversation turn (intent, user prompt, assistant response) to the conversation turns list
-    conv_turns.append((intent, prompt, response))
-    return conv_turns, conv_tokens
+    # Link the conversation turn (intent, user prompt, assistant response) below the turns before it
+    return TreeNode(parent, name, intent, prompt, response)
 
-def conversation_loop(turns: int, intent: str, domain: str, conv_turns: list, doc_id: str, mod_out: list = [], name: str = 'C-', token_count: dict = {"user":0,"assistant":0,"moderator":0}):
+def expand_node(turns: int, intent: str, domain: str, parent: TreeNode, doc_id: str, name: str) -> tuple:
     """
-    Perform conversation loop recursively until the specified number of turns is reached.
+    Expand a single node: generate its conversation turn and sample the sub-intents of its children.
 
     Args:
         turns (int): The number of turns for the conversation.
-        intent (str): The intent of the conversation.
+        intent (str): The intent of the node.
         domain (str): The domain or topic of the conversation.
-        conv_turns (list): List of tuples representing conversation turns.
+        parent (TreeNode): The turn before the node, None for the root.
         doc_id (str): Identifier for the conversation tree.
-        mod_out (list, optional): List to store moderator outputs. Defaults to [].
-        name (str, optional): Naming convention for conversation tree branches. Defaults to '1'.
-        token_count (dict, optional): To keep track of token counts for each doc_id. Defaults to a dict template with all values being 0.
+        name (str): Name produced for the conversation tree branch of the node.
+
+    Returns:
+        children (list): (intent, parent, name) of every child branch to expand.
+        leaf (tuple): (node, name, intent) to save when the branch ends at this node, otherwise None. The node is
+            None when the branch failed.
     """
+    seed = enter_node(doc_id, name)
+
     # Generate a conversation turn
     try:
-        conv_turns, conv_token = generate_prompt(is_first_prompt=(len(conv_turns) == 0), intent=intent, domain=domain, conv_turns=conv_turns)
-        token_count["user"] += conv_token["user"]
-        token_count["assistant"] += conv_token["assistant"]
+        node = generate_prompt(intent=intent, domain=domain, parent=parent, name=name)
     except Exception as e:
-        print(f'Exception:\n{e}')
-        with open(f'{DATA_GEN_FILE_PATH}/@-errors.txt','a') as file:
-            file.write(f"{conv_turns[0][0]},{domain},{name}")
-        save_conversation(conv_turns, mod_out, domain, name, doc_id)
-        return token_count
-    
+        return [], branch_error(e, intent, domain, parent, doc_id, name)
+
     # Check if the conversation reached the input turns
-    if len(conv_turns) >= turns:
-        # Save the conversation
-        save_conversation(conv_turns, mod_out, domain, name, doc_id)
-        return token_count
+    if node.depth + 1 >= turns:
+        return [], (node, name, intent)
 
-    else:
-        # Attempt to generate a moderator ideas for next sub-intents, with retries
-        retry_count = 0
-        while retry_count < 3:
-            try:
-                mod_ideas, mod_token = ModeratorLLM(history=conv_turns).suggest_next_sub_intents(intent)
-                token_count["moderator"] += mod_token
-                if len(conv_turns) >= 2:
-                    mod_ideas = random.sample(mod_ideas,random.randint(0,5))
-                else:
-                    mod_ideas = random.sample(mod_ideas,random.randint(1,5))
-                break
-            except Exception as e:
-                print(f'Error occurred: {e}. Retrying...')
-                retry_count += 1
-                continue
-        if retry_count == 3:
-            with open(f'{DATA_GEN_FILE_PATH}/@-errors.txt','a') as file:
-                file.write(f"{conv_turns[0][0]},{domain},{name}\n")
-            save_conversation(conv_turns, mod_out, domain, name, doc_id)
-            return token_count
-        if len(mod_ideas) == 0:
-            save_conversation(conv_turns, mod_out, domain, name, doc_id)
-            return token_count
+    # Generate moderator ideas for next sub-intents
+    try:
+        mod_ideas, _ = get_roles()["moderator"].suggest_next_sub_intents(intent, node)
+    except Exception as e:
+        return [], branch_error(e, intent, domain, node, doc_id, name)
+    return branch_children(turns, intent, node, doc_id, name, seed, mod_ideas)
+
+def conversation_loop(turns: int, intent: str, domain: str, parent: TreeNode, doc_id: str, name: str = 'C-'):
+    """
+    Perform conversation loop recursively until the specified number of turns is reached.
 
-        # Append moderator ideas to the output
-        mod_out.append({f"Turn{len(conv_turns)-1}":mod_ideas})
+    Args:
+        turns (int): The number of turns for the conversation.
+        intent (str): The intent of the conversation.
+        domain (str): The domain or topic of the conversation.
+        parent (TreeNode): The turn before the branch, None for the root.
+        doc_id (str): Identifier for the conversation tree.
+        name (str, optional): Naming convention for conversation tree branches. Defaults to 'C-'.
+    """
+    children, leaf = expand_node(turns, intent, domain, parent, doc_id, name)
+    save_leaf(leaf, domain, doc_id)
 
-        # Loop through the moderator ideas and start new conversation branches
-        for index, mod_idea in enumerate(mod_ideas, start=1):
-            next_name = name + str(index) + '-'
-            token_count = conversation_loop(turns, mod_idea, domain, conv_turns.copy(), doc_id, mod_out.copy(), next_name, token_count)
-        
-        return token_count
+    # Loop through the moderator ideas and start new conversation branches
+    for next_intent, next_parent, next_name in children:
+        conversation_loop(turns, next_intent, domain, next_parent, doc_id, next_name)
 
-def save_conversation(conv_turns: list, mod_out: list, domain: str, name: str, doc_id: str):
+def save_conversation(node: TreeNode, domain: str, name: str, doc_id: str, checkpoint: bool = True, intent: str = None):
     """
-    Save conversation data to a JSON file.
+    Save conversation data to a JSON file or a shard, or add it to the tree of its doc_id when STORAGE_MODE is "tree".
+    The leaf is checkpointed once its output is written.
 
     Args:
-        conv_turns (list): List of tuples representing conversation turns.
-        mod_out (list): List containing moderator outputs.
+        node (TreeNode): The last turn of the conversation, None when the branch failed.
         domain (str): The domain or topic of the conversation.
         name (str): Name produced for the conversation tree branch.
         doc_id (str): Identifier for the conversation tree.
+        checkpoint (bool, optional): Record the leaf as completed in the checkpoint. Defaults to True.
+        intent (str, optional): The intent of the branch, kept in the checkpoint when it failed. Defaults to None.
     """
+    if checkpoint:
+        budget_close_node(doc_id, name)
+
+    # A failed branch writes no output. It is checkpointed as pending with its intent and its tree is
+    # not marked done, so a rerun regenerates it
+    if node is None:
+        if checkpoint:
+            _FAILED_TREES.add(doc_id)
+            checkpoint_node(doc_id, name, (intent, None, None), None, leaf=False)
+        return
+
+    def done():
+        if checkpoint:
+            checkpoint_node(doc_id, name, node.turn(), None, leaf=True)
+
+    # Materialise the path of the leaf only now that it is written
+    conv_turns, mod_out = node.turns(), node.mod_out()
+
+    if STORAGE_MODE == "tree":
+        if doc_id not in _OPEN_TREES:
+            _OPEN_TREES[doc_id] = TreeRecorder(doc_id, domain, get_model_names())
+        _OPEN_TREES[doc_id].add_leaf(conv_turns, mod_out, name)
+        done()
+        return
+
+    if OUTPUT_FORMAT == "shards":
+        # Serializing, compressing and writing happen on the writer thread
+        conversation = conversation_record(doc_id, domain, get_model_names(), conv_turns, mod_out)
+        write_record("leaves", {"leaf": name, "conversation": conversation}, done)
+        return
+
     # Define the file path
     filename = f"{DATA_GEN_FILE_PATH}/{doc_id}/{name[0:-1]}.json"
     # Create directories if they don't exist
     os.makedirs(os.path.dirname(filename), exist_ok=True)
 
     # Write conversation data to the JSON file
-    with open(filename, "w") as file:
-        conversation = []
-        # Add Conversation metadata
-        conversation.append({"id": doc_id})
-        conversation.append({"intent": conv_turns[0][0]})
-        conversation.append({"domain": domain})
-        model_list = MODEL_NAMES
-        conversation.append({"model list": model_list})
-        conversation.append({"timestamp": time.strftime("%d-%m-%Y %H:%M:%S", time.localtime(time.time()))})
-        # Add Conversation interactions
-        interactions = []
-        for intent, prompt, response in conv_turns:
-            turn = {
-                "intent": intent,
-                "user": prompt,
-                "assistant": response
-            }
-            interactions.append(turn)
-        conversation.append({"interactions": interactions})
-        # Add Moderator outputs
-        conversation.append({"moderator": mod_out})
+    with span("save", "io", tree=doc_id, node=name) as fields, open(filename, "w") as file:
+        conversation = conversation_record(doc_id, domain, get_model_names(), conv_turns, mod_out)
         json.dump(conversation, file, indent=4)
+        fields["bytes"] = file.tell()
+    done()
 
-def save_token_count(doc_id: str, token_count: dict):
+def save_tree(doc_id: str):
     """
-    Save token count data to a JSON file.
+    Write the collected tree of a doc_id to {doc_id}.tree.json, or to the "trees" shards, when STORAGE_MODE is "tree".
 
     Args:
         doc_id (str): Identifier for the conversation tree.
     """
-    # Define the file path
-    filename = f"{DATA_GEN_FILE_PATH}/@-token_counts.json"
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tree = _OPEN_TREES.pop(doc_id, None)
+    if tree is not None and OUTPUT_FORMAT == "shards":
+        write_record("trees", tree.to_dict())
+    elif tree is not None:
+        filename = f"{DATA_GEN_FILE_PATH}/{doc_id}.tree.json"
+        with span("save_tree", "io", tree=doc_id, node=None) as fields:
+            tree.save(filename)
+            fields["bytes"] = os.path.getsize(filename)
+
+def replay_leaves(domain: str, doc_id: str, resume_state: dict):
+    """
+    Add the leaves saved before an interruption back to the tree when STORAGE_MODE is "tree",
+    since that output is only written once the whole tree is done.
+
+    Args:
+        domain (str): The domain or topic of the conversation.
+        doc_id (str): Identifier for the conversation tree.
+        resume_state (dict): Checkpointed {"nodes", "leaves"} of the tree.
+    """
+    if STORAGE_MODE != "tree":
+        return
+    for leaf in resume_state["leaves"]:
+        save_conversation(node_from_table(resume_state["nodes"], leaf), domain, leaf, doc_id, checkpoint=False)
+
+def start(turns: int, intent: str, domain: str, doc_id: str, resume_state: dict = None) -> bool:
+    """
+    Start the conversation process, or resume the pending branches of a partially generated tree.
+
+    Args:
+        turns (int): The number of turns for the conversation.
+        intent (str): The intent of the conversation.
+        domain (str): The domain or topic of the conversation.
+        doc_id (str): Identifier for the conversation tree.
+        resume_state (dict, optional): Checkpointed {"nodes", "leaves"} of the tree. Defaults to None.
+
+    Returns:
+        bool: True when the tree was finished, False when it was skipped on a spent budget or has failed branches.
+    """
+    if not open_tree(intent, domain, doc_id):
+        return False
+    for branch_intent, parent, name in tree_branches(intent, domain, doc_id, resume_state):
+        conversation_loop(turns, branch_intent, domain, parent, doc_id, name)
+    return finish_tree(doc_id)
+
+async def agenerate_prompt(intent: str, domain: str, parent: TreeNode, name: str, semaphore: asyncio.Semaphore) -> TreeNode:
+    """
+    Asynchronously generate a user prompt and response prompt for one turn of conversation, see `generate_prompt`.
+
+    Args:
+        intent (str): The intent of the conversation.
+        domain (str): The domain or topic of the conversation.
+        parent (TreeNode): The previous turn of the conversation, None for the first prompt.
+        name (str): Name produced for the conversation tree branch of the turn.
+        semaphore (asyncio.Semaphore): Global limit on LLM requests in flight.
+
+    Returns:
+        TreeNode: The new turn, linked to its parent.
+    """
+    roles = get_roles()
+    user = roles["user"]
+    async with semaphore:
+        if parent is None:
+            prompt, _ = await user.agenerate_initiation_prompt(intent, domain)
+        else:
+            prompt, _ = await user.agenerate_continuation_prompt(intent, domain, parent)
+    async with semaphore:
+        response, _ = await roles["assistant"].arespond_to_user_prompt(prompt, parent)
+    return TreeNode(parent, name, intent, prompt, response)
 
-    # Read the existing data from the JSON file
+async def aexpand_node(turns: int, intent: str, domain: str, parent: TreeNode, doc_id: str, semaphore: asyncio.Semaphore, name: str) -> tuple:
+    """
+    Asynchronously expand a single node, see `expand_node`.
+
+    Args:
+        turns (int): The number of turns for the conversation.
+        intent (str): The intent of the node.
+        domain (str): The domain or topic of the conversation.
+        parent (TreeNode): The turn before the node, None for the root.
+        doc_id (str): Identifier for the conversation tree.
+        semaphore (asyncio.Semaphore): Global limit on LLM requests in flight.
+        name (str): Name produced for the conversation tree branch of the node.
+
+    Returns:
+        children (list): (intent, parent, name) of every child branch to expand.
+        leaf (tuple): (node, name, intent) to save when the branch ends at this node, otherwise None.
+    """
+    seed = enter_node(doc_id, name)
     try:
-        with open(filename, "r") as file:
-            data = json.load(file)
-    except:
-        data = []
-    
-    # Prepare token data structure
-    token_data = {
-        "doc_id": doc_id,
-        "User LLM": {
-            "token count": token_count["user"],
-            "token cost": f'$ {(token_count["user"] / 1000000) * 0.50}'
-        },
-        "Assistant LLM": {
-            "token count": token_count["assistant"],
-            "token cost": f'$ {(token_count["assistant"] / 1000000) * 0.50}'
-        },
-        "Moderator LLM": {
-            "token count": token_count["moderator"],
-            "token cost": f'$ {(token_count["moderator"] / 1000000) * 0.50}'
-        }
-    }
+        node = await agenerate_prompt(intent=intent, domain=domain, parent=parent, name=name, semaphore=semaphore)
+    except Exception as e:
+        return [], branch_error(e, intent, domain, parent, doc_id, name)
+    if node.depth + 1 >= turns:
+        return [], (node, name, intent)
+    try:
+        async with semaphore:
+            mod_ideas, _ = await get_roles()["moderator"].asuggest_next_sub_intents(intent, node)
+    except Exception as e:
+        return [], branch_error(e, intent, domain, node, doc_id, name)
+    return branch_children(turns, intent, node, doc_id, name, seed, mod_ideas)
 
-    # Append token data to existing data
-    data.append(token_data)
+async def aconversation_loop(turns: int, intent: str, domain: str, parent: TreeNode, doc_id: str, semaphore: asyncio.Semaphore, name: str = 'C-'):
+    """
+    Asynchronously perform conversation loop recursively until the specified number of turns is reached.
+    Once the moderator returns its sub-intents, all sibling branches are expanded concurrently.
+
+    Args:
+        turns (int): The number of turns for the conversation.
+        intent (str): The intent of the conversation.
+        domain (str): The domain or topic of the conversation.
+        parent (TreeNode): The turn before the branch, None for the root.
+        doc_id (str): Identifier for the conversation tree.
+        semaphore (asyncio.Semaphore): Global limit on LLM requests in flight.
+        name (str, optional): Naming convention for conversation tree branches. Defaults to 'C-'.
+    """
+    children, leaf = await aexpand_node(turns, intent, domain, parent, doc_id, semaphore, name)
+    save_leaf(leaf, domain, doc_id)
 
-    # Write updated data to JSON file
-    with open(filename, 'w') as file:
-        json.dump(data, file, indent=4)
+    # Expand all sibling branches concurrently
+    await asyncio.gather(*(
+        aconversation_loop(turns, next_intent, domain, next_parent, doc_id, semaphore, next_name)
+        for next_intent, next_parent, next_name in children
+    ))
 
-def start(turns: int, intent: str, domain: str, doc_id: str):
+async def astart(turns: int, intent: str, domain: str, doc_id: str, semaphore: asyncio.Semaphore, resume_state: dict = None) -> bool:
     """
-    Start the conversation process.
+    Asynchronously start the conversation process, or resume the pending branches of a partially generated tree.
 
     Args:
         turns (int): The number of turns for the conversation.
         intent (str): The intent of the conversation.
         domain (str): The domain or topic of the conversation.
         doc_id (str): Identifier for the conversation tree.
+        semaphore (asyncio.Semaphore): Global limit on LLM requests in flight.
+        resume_state (dict, optional): Checkpointed {"nodes", "leaves"} of the tree. Defaults to None.
+
+    Returns:
+        bool: True when the tree was finished, False when it was skipped on a spent budget, failed or has failed branches.
     """
-    print(f"Staring {intent} and {domain}")
-    # Start the conversation loop
-    token_count = conversation_loop(turns=turns, intent=intent, domain=domain, conv_turns=[], doc_id=doc_id)
+    if not open_tree(intent, domain, doc_id):
+        return False
+    try:
+        await asyncio.gather(*(
+            aconversation_loop(turns, branch_intent, domain, parent, doc_id, semaphore, name)
+            for branch_intent, parent, name in tree_branches(intent, domain, doc_id, resume_state)
+        ))
+    except Exception as e:
+        print(e)
+        return False
+    return finish_tree(doc_id)
+
+async def arun(input_list, turns: int, max_concurrent_requests: int = MAX_CONCURRENT_REQUESTS, pending: dict = None, max_open_trees: int = MAX_OPEN_TREES):
+    """
+    Generate conversation trees for all inputs in a single event loop. Inputs are consumed lazily,
+    at most `max_open_trees` trees at a time.
+
+    Args:
+        input_list: Iterable of (doc_id, (intent, domain)) tuples.
+        turns (int): The number of turns for the conversation.
+        max_concurrent_requests (int, optional): Global limit on LLM requests in flight. Defaults to MAX_CONCURRENT_REQUESTS.
+        pending (dict, optional): Checkpointed state of partially generated trees, keyed by doc_id. Defaults to None.
+        max_open_trees (int, optional): Trees generated at once. Defaults to MAX_OPEN_TREES.
+    """
+    pending = pending or {}
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+    inputs = iter(input_list)
+
+    async def tree_slot():
+        # Every slot takes the next input once its tree is done, the iterator is only advanced between awaits
+        for index, (intent, domain) in inputs:
+            await astart(turns=turns, intent=intent, domain=domain, doc_id=index, semaphore=semaphore, resume_state=pending.get(index))
+
+    await asyncio.gather(*(tree_slot() for _ in range(max_open_trees)))
+
+def node_result(task: dict, children: list, leaf: tuple) -> dict:
+    """
+    Build the result of a node task expanded by the node scheduler or the frontier.
+
+    Args:
+        task (dict): The expanded node, with "doc_id", "turns", "domain", "intent", "parent" and "name".
+        children (list): (intent, parent, name) of every child branch to expand.
+        leaf (tuple): (node, name, intent) to save, or None.
+
+    Returns:
+        dict: "doc_id", the "children" tasks to expand and the "leaf" to save, if any.
+    """
+    return {
+        "doc_id": task["doc_id"],
+        "domain": task["domain"],
+        "children": [dict(task, intent=intent, parent=parent, name=name) for intent, parent, name in children],
+        "leaf": leaf,
+    }
+
+def run_node_task(task: dict) -> dict:
+    """
+    Expand one node in a worker process of the node scheduler.
+
+    Args:
+        task (dict): The node to expand, with "doc_id", "turns", "domain", "intent", "parent" and "name".
+
+    Returns:
+        dict: "doc_id", the "children" tasks to expand and the "leaf" to save, if any.
+    """
+    open_run_files()
+    set_call_context(doc_id=task["doc_id"])
+    children, leaf = expand_node(task["turns"], task["intent"], task["domain"], task["parent"], task["doc_id"], task["name"])
+    return node_result(task, children, leaf)
+
+def save_node_result(result: dict):
+    """
+    Save the leaf of an expanded node in the coordinator of the node scheduler.
+
+    Args:
+        result (dict): Result of run_node_task.
+    """
+    save_leaf(result.get("leaf"), result.get("domain"), result["doc_id"])
+
+def tree_tasks(input_list: list, turns: int, pending: dict):
+    """
+    Yield the initial node tasks of every tree: its root, or its pending branches when resuming.
+    Resumed trees without pending branches are finished right away.
+
+    Args:
+        input_list: Iterable of (doc_id, (intent, domain)) tuples, consumed lazily.
+        turns (int): The number of turns for the conversation.
+        pending (dict): Checkpointed state of partially generated trees, keyed by doc_id.
+
+    Yields:
+        list: Node tasks of one tree.
+    """
+    for doc_id, (intent, domain) in input_list:
+        task = {"doc_id": doc_id, "turns": turns, "domain": domain, "intent": intent, "parent": None, "name": 'C-'}
+        if budget_exhausted():
+            print(f"Budget spent, skipping {intent} and {domain}")
+            continue
+        print(f"Staring {intent} and {domain}")
+        branches = tree_branches(intent, domain, doc_id, pending.get(doc_id))
+        tasks = [dict(task, intent=branch_intent, parent=parent, name=name) for branch_intent, parent, name in branches]
+        if tasks:
+            yield tasks
+        else:
+            finish_tree(doc_id)
+
+def run_nodes(input_list: list, turns: int, n_workers: int = N_JOBS, pending: dict = None, priority: str = "depth", max_open_trees: int = None):
+    """
+    Generate conversation trees for all inputs with node-level scheduling over worker processes.
+
+    Args:
+        input_list: Iterable of (doc_id, (intent, domain)) tuples, consumed lazily.
+        turns (int): The number of turns for the conversation.
+        n_workers (int, optional): Number of worker processes. Defaults to N_JOBS.
+        pending (dict, optional): Checkpointed state of partially generated trees, keyed by doc_id. Defaults to None.
+        priority (str, optional): Order of the pending nodes, a key of PRIORITY_KEYS. Defaults to "depth".
+        max_open_trees (int, optional): Trees in progress at once, None for no limit. Defaults to None.
+    """
+    pending = pending or {}
+    # Leaves are saved by the coordinator, so it writes the checkpoint records of leaves and finished trees
+    open_run_files()
+    scheduler = NodeScheduler(run_node_task, save_node_result, finish_tree, n_workers, key=PRIORITY_KEYS[priority], max_open_trees=max_open_trees)
+    scheduler.run(tree_tasks(input_list, turns, pending))
+
+def task_depth(task: dict) -> int:
+    """
+    Get the depth of the node a task expands.
+
+    Args:
+        task (dict): The node to expand.
+
+    Returns:
+        int: Number of turns above the node.
+    """
+    return task["parent"].depth + 1 if task["parent"] is not None else 0
+
+def breadth_first(task: dict, order: int) -> tuple:
+    """
+    Priority of the "breadth" order: shallowest nodes first, then the oldest trees.
+
+    Args:
+        task (dict): The node to expand.
+        order (int): Order in which the tree of the node was opened.
+
+    Returns:
+        tuple: Sort key, lowest first.
+    """
+    return (task_depth(task), order)
+
+def oldest_first(task: dict, order: int) -> tuple:
+    """
+    Priority of the "oldest" order: nodes of the tree opened first, deepest first so its branches end early.
+
+    Args:
+        task (dict): The node to expand.
+        order (int): Order in which the tree of the node was opened.
+
+    Returns:
+        tuple: Sort key, lowest first.
+    """
+    return (order, -task_depth(task))
+
+def cheapest_first(task: dict, order: int) -> tuple:
+    """
+    Priority of the "cheapest" order: nodes with the fewest estimated history tokens in their prompts first.
+
+    Args:
+        task (dict): The node to expand.
+        order (int): Order in which the tree of the node was opened.
+
+    Returns:
+        tuple: Sort key, lowest first.
+    """
+    return (estimate_tokens(models.format_history(task["parent"])),)
+
+# Priority keys of the frontier by name, None keeps the depth-first order of the recursive engines
+PRIORITY_KEYS = {"depth": None, "breadth": breadth_first, "oldest": oldest_first, "cheapest": cheapest_first}
+
+async def aexpand_task(task: dict, semaphore: asyncio.Semaphore) -> dict:
+    """
+    Asynchronously expand one node of the frontier.
+
+    Args:
+        task (dict): The node to expand, with "doc_id", "turns", "domain", "intent", "parent" and "name".
+        semaphore (asyncio.Semaphore): Global limit on LLM requests in flight.
+
+    Returns:
+        dict: "doc_id", the "children" tasks to expand and the "leaf" to save, if any.
+    """
+    set_call_context(doc_id=task["doc_id"])
+    children, leaf = await aexpand_node(task["turns"], task["intent"], task["domain"], task["parent"], task["doc_id"], semaphore, task["name"])
+    return node_result(task, children, leaf)
+
+async def arun_frontier(input_list, turns: int, max_concurrent_requests: int = MAX_CONCURRENT_REQUESTS, pending: dict = None,
+                        priority: str = FRONTIER_PRIORITY, max_open_trees: int = MAX_OPEN_TREES):
+    """
+    Generate conversation trees for all inputs from one global frontier of pending node expansions in a
+    single event loop. Every request slot takes the next node in the priority order, whatever its tree,
+    so the slots stay busy while at most `max_open_trees` partial trees are kept in memory.
+
+    Args:
+        input_list: Iterable of (doc_id, (intent, domain)) tuples, consumed lazily.
+        turns (int): The number of turns for the conversation.
+        max_concurrent_requests (int, optional): Global limit on LLM requests in flight. Defaults to MAX_CONCURRENT_REQUESTS.
+        pending (dict, optional): Checkpointed state of partially generated trees, keyed by doc_id. Defaults to None.
+        priority (str, optional): Order of the pending nodes, a key of PRIORITY_KEYS. Defaults to FRONTIER_PRIORITY.
+        max_open_trees (int, optional): Trees in progress at once, None for no limit. Defaults to MAX_OPEN_TREES.
+    """
+    pending = pending or {}
+    open_run_files()
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+    frontier = Frontier(tree_tasks(input_list, turns, pending), PRIORITY_KEYS[priority], max_open_trees)
+    changed = asyncio.Event()
+
+    async def slot():
+        while True:
+            task = frontier.pop()
+            if task is None:
+                # Nodes in flight elsewhere may still add children, or finish the last tree
+                if not frontier.in_flight:
+                    changed.set()
+                    return
+                changed.clear()
+                await changed.wait()
+                continue
+            try:
+                result = await aexpand_task(task, semaphore)
+            except Exception as e:
+                # A failing node ends its branch instead of stopping the slot
+                print(e)
+                result = {"doc_id": task["doc_id"], "children": []}
+            save_node_result(result)
+            if frontier.complete(result["doc_id"], result["children"]):
+                finish_tree(result["doc_id"])
+            changed.set()
+
+    await asyncio.gather(*(slot() for _ in range(max_concurrent_requests)))
+
+def open_queue() -> WorkQueue:
+    """
+    Open the work queue of the run in the output directory.
+
+    Returns:
+        WorkQueue: The queue of the "queue" engine.
+    """
+    return WorkQueue(f"{DATA_GEN_FILE_PATH}/{QUEUE_FILE_NAME}", QUEUE_SETTINGS["lease_seconds"], QUEUE_SETTINGS["max_attempts"])
+
+async def arun_queue_worker(work_queue: WorkQueue, turns: int, max_concurrent_requests: int = MAX_CONCURRENT_REQUESTS,
+                            max_open_trees: int = MAX_OPEN_TREES, settings: dict = QUEUE_SETTINGS):
+    """
+    Generate trees leased from the work queue of the run in a single event loop, at most `max_open_trees`
+    at a time, until no tree is queued or leased anymore. Leases are renewed by a heartbeat while the trees
+    are generated, and a tree is completed in the queue only once its output is written. A tree taken over
+    from a lost worker resumes from the checkpoint.
+
+    Args:
+        work_queue (WorkQueue): The queue of the run, see `open_queue`.
+        turns (int): The number of turns for the conversation.
+        max_concurrent_requests (int, optional): Limit on LLM requests in flight of this worker. Defaults to MAX_CONCURRENT_REQUESTS.
+        max_open_trees (int, optional): Trees generated at once by this worker. Defaults to MAX_OPEN_TREES.
+        settings (dict, optional): Heartbeat and poll intervals, see QUEUE_SETTINGS. Defaults to QUEUE_SETTINGS.
+    """
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+    owner = worker_name()
+    checkpoint_path = f"{DATA_GEN_FILE_PATH}/{CHECKPOINT_FILE_NAME}"
+    budget = open_budget(f"{DATA_GEN_FILE_PATH}/{BUDGET_FILE_NAME}", BUDGET_LIMITS)
+    # Trees whose output is written, appended by the writer thread and completed in the queue from the event loop
+    written = []
+    stopping = False
+
+    def complete_written():
+        while written:
+            if not work_queue.complete(written.pop(), owner):
+                print("Lease of a written tree was lost, another worker may regenerate it")
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(settings["heartbeat_seconds"])
+            complete_written()
+            work_queue.heartbeat(owner)
 
-    # Save token count data after conversation completion
-    save_token_count(doc_id, token_count)
+    async def tree_slot():
+        nonlocal stopping
+        while not stopping:
+            complete_written()
+            task = work_queue.lease(owner)
+            if task is None:
+                counts = work_queue.counts()
+                if not counts["queued"] and not counts["leased"]:
+                    return
+                # Trees leased by other workers come back to the queue if their lease expires
+                await asyncio.sleep(settings["poll_seconds"])
+                continue
+            doc_id, resume_state = task["doc_id"], None
+            if task["attempts"] > 1:
+                # Taken over from a worker that failed or stopped heartbeating
+                done, pending = load_checkpoint(checkpoint_path, {doc_id})
+                if doc_id in done:
+                    work_queue.complete(doc_id, owner)
+                    continue
+                resume_state = pending.get(doc_id)
+                if budget is not None:
+                    budget.clear_reservations(doc_id)
+            if await astart(turns=turns, intent=task["intent"], domain=task["domain"], doc_id=doc_id, semaphore=semaphore, resume_state=resume_state):
+                after_writes(lambda doc_id=doc_id: written.append(doc_id))
+            elif budget_exhausted():
+                # Leave the tree to a later run with a new budget
+                work_queue.release(doc_id, owner)
+                stopping = True
+            else:
+                work_queue.release(doc_id, owner, error="tree failed")
 
-    print(f"Done {intent} and {domain}")
+    open_run_files()
+    beat = asyncio.ensure_future(heartbeat())
+    try:
+        await asyncio.gather(*(tree_slot() for _ in range(max_open_trees)))
+    finally:
+        beat.cancel()
+    flush_writer()
+    complete_written()
+    print(json.dumps(work_queue.counts()))
 
-# start(turns=6, intent="General-purpose Coding Queries", domain="Loops", doc_id='GP_Code')
+def configure(settings: dict):
+    """
+    Apply run settings to this module and to models. Joblib workers import the modules afresh,
+    so the settings travel with every task and are applied again there.
+
+    Args:
+        settings (dict): {"main": {setting: value}, "models": {setting: value}} with module-level setting names.
+    """
+    globals().update(settings.get("main", {}))
+    for name, value in settings.get("models", {}).items():
+        setattr(models, name, value)
 
-with open("/home/varun/Varun/IFT/Chains/Automate/Files/Sample_Gen_1/input_re.txt",'r') as file:
-    lines = file.readlines()
+def process_input(index, inp, resume_state=None, settings=None):
+    """
+    Generate one tree in a joblib worker.
 
-def process_input(index, inp):
+    Args:
+        index: Identifier for the conversation tree.
+        inp (tuple): (intent, domain) of the tree.
+        resume_state (dict, optional): Checkpointed {"nodes", "leaves"} of the tree. Defaults to None.
+        settings (dict, optional): Run settings to apply first, see `configure`. Defaults to None.
+    """
+    if settings:
+        configure(settings)
     try:
-        start(turns=4, intent=inp[0], domain=inp[1], doc_id=index)
+        start(turns=TURNS, intent=inp[0], domain=inp[1], doc_id=index, resume_state=resume_state)
+        # Joblib may stop idle workers without running their exit handlers
+        flush_writer()
     except Exception as e:
         print(e)
         return
 
-input_list = []
+def parse_args(argv: list = None) -> dict:
+    """
+    Parse the command line into run settings.
+
+    Args:
+        argv (list, optional): Command line arguments. Defaults to sys.argv.
+
+    Returns:
+        dict: Run settings for `configure`.
+    """
+    parser = argparse.ArgumentParser(description="Generate synthetic conversation trees.")
+    parser.add_argument("--input", default=INPUT_FILE_PATH, help="CSV file of 'intent, domain[, variant]' rows")
+    parser.add_argument("--shard", type=parse_shard, default=INPUT_SHARD, help="generate only the i-th of N shards of the input, as i/N")
+    parser.add_argument("--output", default=DATA_GEN_FILE_PATH, help="output directory")
+    parser.add_argument("--turns", type=int, default=TURNS, help="turns of every conversation")
+    parser.add_argument("--engine", choices=["async", "frontier", "nodes", "joblib", "queue"], default=ENGINE, help="execution engine")
+    parser.add_argument("--enqueue", action="store_true", help="only load the input into the work queue of the queue engine")
+    parser.add_argument("--jobs", type=int, default=N_JOBS, help="worker processes of the nodes and joblib engines")
+    parser.add_argument("--max-concurrent-requests", type=int, default=MAX_CONCURRENT_REQUESTS, help="requests in flight of the async, frontier and queue engines")
+    parser.add_argument("--max-open-trees", type=int, default=MAX_OPEN_TREES, help="trees generated at once by the async, frontier, nodes and queue engines")
+    parser.add_argument("--rate-limit-dir", default=models.RATE_LIMIT_STATE_DIR,
+                        help="rate limiter state shared by every host of the run, in the output directory for the queue engine and per host otherwise")
+    parser.add_argument("--lease-seconds", type=float, default=QUEUE_SETTINGS["lease_seconds"], help="lease of a tree of the queue engine")
+    parser.add_argument("--priority", choices=list(PRIORITY_KEYS), default=FRONTIER_PRIORITY, help="order of the pending nodes of the frontier and nodes engines")
+    parser.add_argument("--storage", choices=["leaf", "tree"], default=STORAGE_MODE, help="output layout")
+    parser.add_argument("--output-format", choices=["files", "shards"], default=OUTPUT_FORMAT, help="one file per output, or compressed JSONL shards")
+    parser.add_argument("--compression", choices=["gzip", "zstd"], default=SHARD_SETTINGS["compression"], help="compression of the shards")
+    parser.add_argument("--fsync", choices=["never", "rotate", "batch"], default=SHARD_SETTINGS["fsync"], help="when shards are synced to disk")
+    parser.add_argument("--seed", type=int, default=RUN_SEED, help="seed of the run, the same seed regenerates the same trees")
+    parser.add_argument("--dry-run", action="store_true", help="only print the estimated calls, tokens, cost and wall time of the run")
+    parser.add_argument("--prompts", default=models.PROMPTS_FILE_PATH, help="prompts file")
+    parser.add_argument("--api-key", default=models.API_KEY_FILE_PATH, help="API key file")
+    parser.add_argument("--backend", choices=["live", "mock"], default=models.LLM_BACKEND, help="model backend")
+    parser.add_argument("--cache", default=models.RESPONSE_CACHE_PATH, help="response cache database, disabled by default")
+    parser.add_argument("--context-turns", type=int, help="turns of history kept in the user and moderator prompts")
+    parser.add_argument("--context-tokens", type=int, help="tokens of history kept in the user and moderator prompts")
+    parser.add_argument("--dedupe", choices=["tree", "run", "off"], default=DEDUPE_SCOPE or "off", help="scope of the near-duplicate idea filter")
+    parser.add_argument("--dedupe-threshold", type=float, default=DEDUPE_THRESHOLD, help="similarity from which ideas are duplicates")
+    for limit in BUDGET_LIMITS:
+        parser.add_argument("--" + limit.replace('_', '-'), type=float, default=BUDGET_LIMITS[limit], help=f"{limit.replace('_', ' ')} budget")
+    args = parser.parse_args(argv)
+
+    return {
+        "main": {
+            "INPUT_FILE_PATH": args.input,
+            "INPUT_SHARD": args.shard,
+            "ENQUEUE": args.enqueue,
+            "QUEUE_SETTINGS": {**QUEUE_SETTINGS, "lease_seconds": args.lease_seconds,
+                               "heartbeat_seconds": min(QUEUE_SETTINGS["heartbeat_seconds"], args.lease_seconds / 4)},
+            "DRY_RUN": args.dry_run,
+            "RUN_SEED": args.seed,
+            "DATA_GEN_FILE_PATH": args.output,
+            "TURNS": args.turns,
+            "ENGINE": args.engine,
+            "N_JOBS": args.jobs,
+            "MAX_CONCURRENT_REQUESTS": args.max_concurrent_requests,
+            "MAX_OPEN_TREES": args.max_open_trees,
+            "FRONTIER_PRIORITY": args.priority,
+            "STORAGE_MODE": args.storage,
+            "OUTPUT_FORMAT": args.output_format,
+            "SHARD_SETTINGS": {**SHARD_SETTINGS, "compression": args.compression, "fsync": args.fsync},
+            "BUDGET_LIMITS": {limit: getattr(args, limit) for limit in BUDGET_LIMITS},
+            "DEDUPE_SCOPE": None if args.dedupe == "off" else args.dedupe,
+            "DEDUPE_THRESHOLD": args.dedupe_threshold,
+        },
+        "models": {
+            "PROMPTS_FILE_PATH": args.prompts,
+            "API_KEY_FILE_PATH": args.api_key,
+            "LLM_BACKEND": args.backend,
+            "RESPONSE_CACHE_PATH": args.cache,
+            # The hosts of a queue run draw from the same provider limits
+            "RATE_LIMIT_STATE_DIR": args.rate_limit_dir or (f"{args.output}/{RATE_LIMITS_DIR_NAME}" if args.engine == "queue" else None),
+            "CONTEXT_POLICY": {**models.CONTEXT_POLICY, "max_turns": args.context_turns, "max_tokens": args.context_tokens},
+        },
+    }
+
+def dry_run(input_list) -> dict:
+    """
+    Estimate the calls, tokens, cost and wall time of the run with the capacity planner, calibrated from the
+    ledger of a previous run in the output directory when there is one.
+
+    Args:
+        input_list: Iterable of (doc_id, (intent, domain)) tuples of the trees left to generate.
+
+    Returns:
+        dict: The estimate, see `planner.plan`.
+    """
+    ledger_path = f"{DATA_GEN_FILE_PATH}/@-ledger.jsonl"
+    profile = load_profile(ledger_path if os.path.exists(ledger_path) else None)
+    # The async engines keep MAX_CONCURRENT_REQUESTS calls in flight, the process engines one per worker
+    concurrency = MAX_CONCURRENT_REQUESTS if ENGINE in ("async", "frontier", "queue") else N_JOBS
+    # The run is limited by the sum of the buckets its endpoints draw from, and is unlimited if one of them is
+    limits = [models.RATE_LIMITS.get(key, {}) for key in set().union(*(llm.limit_keys() for llm in get_roles().values()))]
+    rpm, tpm = (sum(limit[field] for limit in limits) if limits and all(limit.get(field) for limit in limits) else None for field in ("rpm", "tpm"))
+    return plan(sum(1 for _ in input_list), TURNS, concurrency, rpm, tpm, profile)
+
+def main(argv: list = None):
+    """
+    Command line entry point: generate the trees of the input file, resuming a previous run in the same output directory.
+
+    Args:
+        argv (list, optional): Command line arguments. Defaults to sys.argv.
+    """
+    settings = parse_args(argv)
+    configure(settings)
+
+    # Skip trees finished by a previous run and resume the partially generated ones. The input rows
+    # of this shard are streamed, keyed by the stable doc_id of their intent, domain and variant
+    done, pending = load_checkpoint(f"{DATA_GEN_FILE_PATH}/{CHECKPOINT_FILE_NAME}")
+    input_list = ((index, inp) for index, inp in read_inputs(INPUT_FILE_PATH, INPUT_SHARD) if index not in done)
+    if DRY_RUN:
+        print(json.dumps(dry_run(input_list), indent=4))
+        return
+    os.makedirs(DATA_GEN_FILE_PATH, exist_ok=True)
+    if ENQUEUE:
+        added = open_queue().enqueue(input_list)
+        print(json.dumps({"added": added, **open_queue().counts()}))
+        return
+    # Reservations of branches that were in flight when a previous run stopped are void. Queue workers
+    # join a run that others are generating, and void only the reservations of the trees they take over
+    budget = open_budget(f"{DATA_GEN_FILE_PATH}/{BUDGET_FILE_NAME}", BUDGET_LIMITS)
+    if budget is not None and ENGINE != "queue":
+        budget.clear_reservations()
 
-for line in lines:
-    intent, domain = line.strip().split(',')
-    input_list.append((intent.strip(),domain.strip()))
+    if ENGINE == "async":
+        asyncio.run(arun(input_list, turns=TURNS, max_concurrent_requests=MAX_CONCURRENT_REQUESTS, pending=pending, max_open_trees=MAX_OPEN_TREES))
+    elif ENGINE == "frontier":
+        asyncio.run(arun_frontier(input_list, turns=TURNS, max_concurrent_requests=MAX_CONCURRENT_REQUESTS, pending=pending, priority=FRONTIER_PRIORITY, max_open_trees=MAX_OPEN_TREES))
+    elif ENGINE == "nodes":
+        run_nodes(input_list, turns=TURNS, n_workers=N_JOBS, pending=pending, priority=FRONTIER_PRIORITY, max_open_trees=MAX_OPEN_TREES)
+    elif ENGINE == "queue":
+        asyncio.run(arun_queue_worker(open_queue(), turns=TURNS, max_concurrent_requests=MAX_CONCURRENT_REQUESTS, max_open_trees=MAX_OPEN_TREES, settings=QUEUE_SETTINGS))
+    else:
+        Parallel(n_jobs=N_JOBS)(delayed(process_input)(index, inp, pending.get(index), settings) for index, inp in input_list)
+    close_writer()
+    export_metrics()
 
-Parallel(n_jobs=2)(delayed(process_input)(index, inp) for index, inp in enumerate(input_list))
+if __name__ == "__main__":
+    # Usage: python main.py --input inputs.txt --output out_dir [--engine async] [--backend mock] [--shard i/N]
+    # Multi-host: python main.py --input inputs.txt --output shared_dir --enqueue, then python main.py --output shared_dir --engine queue on every host
+    main()
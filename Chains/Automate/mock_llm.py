@@ -0,0 +1,171 @@
+# Import nessessary packages
+import json
+import time
+import random
+import asyncio
+import hashlib
+from typing import Any, List, Optional
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.language_models.chat_models import BaseChatModel
+
+from rate_limiter import estimate_tokens
+
+#CONSTANTS
+# Vocabulary the fake outputs are drawn from
+WORDS = [
+    "loop", "array", "function", "index", "value", "list", "string", "error", "return", "variable",
+    "example", "output", "input", "condition", "range", "step", "result", "method", "class", "object",
+    "data", "table", "summary", "draft", "section", "detail", "reason", "option", "change", "check",
+]
+# Characters per block of the simulated prefix cache, and blocks it holds before starting over
+PREFIX_BLOCK = 256
+PREFIX_CACHE_BLOCKS = 1 << 20
+
+class MockAPIError(Exception):
+    """
+    An error raised by the mock model in place of a provider failure.
+
+    Attributes:
+        status_code (int): HTTP status the failure stands for, 429 for rate limiting or 500 for server errors.
+    """
+    def __init__(self, status_code: int):
+        """
+        Initialize the MockAPIError instance.
+
+        Args:
+            status_code (int): HTTP status the failure stands for.
+        """
+        super().__init__(f"Mock API error {status_code}")
+        self.status_code = status_code
+
+class MockChatModel(BaseChatModel):
+    """
+    A local stand-in for the provider chat models, so the generator can run without credentials or spending tokens.
+    Outputs are schema-valid for the role that asked: the prompt's format instructions decide between a
+    ModeratorPydantic JSON ("intents"), a UserPydantic JSON ("prompt") and free assistant text.
+    The content only depends on the prompt, the seed and the seed passed with the call, while latency and failures are drawn from the
+    model's own seeded random stream, so runs are reproducible.
+
+    Attributes:
+        model_name (str): Model name reported in the token usage.
+        temperature (float): Accepted for compatibility, it does not change the output.
+        latency (float): Median latency of a call in seconds.
+        latency_sigma (float): Spread of the log-normal latency distribution, 0 for a fixed latency.
+        response_words (tuple): Range of words in an assistant response.
+        error_rate (float): Probability of a call failing with a server error (500).
+        rate_limit_rate (float): Probability of a call failing with a rate limit error (429).
+        prefix_cache (bool): Simulate a serving-side prefix cache and report its hits like vLLM and OpenAI do.
+        seed (int): Seed of the outputs and of the latency and failure stream.
+    """
+    model_name: str = "mock"
+    temperature: float = 0.7
+    latency: float = 0.05
+    latency_sigma: float = 0.5
+    response_words: tuple = (50, 300)
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    prefix_cache: bool = False
+    seed: int = 0
+
+    def __init__(self, **kwargs):
+        """
+        Initialize the MockChatModel instance.
+
+        Args:
+            **kwargs: Values of the attributes above.
+        """
+        super().__init__(**kwargs)
+        object.__setattr__(self, "_random", random.Random(self.seed))
+        object.__setattr__(self, "_prefixes", set())
+
+    @property
+    def _llm_type(self) -> str:
+        return "mock-chat"
+
+    def _draw_call(self) -> float:
+        """
+        Draw the outcome of a call: raise the simulated failure, or return its latency.
+
+        Returns:
+            float: Latency of the call in seconds.
+        """
+        draw = self._random.random()
+        if draw < self.rate_limit_rate:
+            raise MockAPIError(429)
+        if draw < self.rate_limit_rate + self.error_rate:
+            raise MockAPIError(500)
+        if self.latency_sigma <= 0:
+            return self.latency
+        return self.latency * self._random.lognormvariate(0, self.latency_sigma)
+
+    def _cached_tokens(self, text: str) -> int:
+        """
+        Simulate a serving-side prefix cache: the prompt is split into blocks of PREFIX_BLOCK characters,
+        and the blocks of its longest prefix already sent by an earlier call are served from the cache.
+
+        Args:
+            text (str): The rendered prompt.
+
+        Returns:
+            int: Estimated tokens of the cached prefix.
+        """
+        if len(self._prefixes) > PREFIX_CACHE_BLOCKS:
+            self._prefixes.clear()
+        digest = hashlib.sha256()
+        cached, missed = 0, False
+        for end in range(PREFIX_BLOCK, len(text) + 1, PREFIX_BLOCK):
+            # A block is identified by the whole prefix ending with it
+            digest.update(text[end - PREFIX_BLOCK:end].encode("utf-8"))
+            key = digest.digest()
+            if not missed and key in self._prefixes:
+                cached = end
+            else:
+                missed = True
+                self._prefixes.add(key)
+        return estimate_tokens(text[:cached]) if cached else 0
+
+    def _respond(self, messages: List[BaseMessage], call_seed: int = None) -> ChatResult:
+        """
+        Build the deterministic response to a prompt, with its token usage.
+
+        Args:
+            messages (list): The rendered prompt.
+            call_seed (int, optional): Sampling seed passed with the call, like provider APIs accept. Defaults to None.
+
+        Returns:
+            ChatResult: The response message and the token usage read by the token callback.
+        """
+        text = "\n".join(message.content for message in messages)
+        key = f"{self.seed}:{text}" if call_seed is None else f"{self.seed}:{call_seed}:{text}"
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        rng = random.Random(int(digest[:16], 16))
+
+        def sentence(low, high):
+            return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high))).capitalize()
+
+        # The format instructions of the prompt carry the JSON schema the role parses
+        if '"intents"' in text:
+            content = json.dumps({"intents": [sentence(4, 10) for _ in range(5)]})
+        elif '"prompt"' in text:
+            content = json.dumps({"prompt": sentence(10, 40) + "?"})
+        else:
+            content = sentence(*self.response_words) + "."
+
+        prompt_tokens = estimate_tokens(text)
+        completion_tokens = estimate_tokens(content)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        if self.prefix_cache:
+            usage["prompt_tokens_details"] = {"cached_tokens": self._cached_tokens(text)}
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=content))],
+            llm_output={"token_usage": usage, "model_name": self.model_name},
+        )
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        time.sleep(self._draw_call())
+        return self._respond(messages, kwargs.get("seed"))
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self._draw_call())
+        return self._respond(messages, kwargs.get("seed"))
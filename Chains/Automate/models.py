@@ -1,54 +1,346 @@
 # Import nessessary packages
 import os
 import json
-import random
+import time
+import asyncio
+import hashlib
+from functools import lru_cache
 from typing import List
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
+from langchain_core.exceptions import OutputParserException
 from langchain.output_parsers import PydanticOutputParser
 from langchain_community.callbacks import get_openai_callback
 
-# Model Integrations imports
-from langchain_community.chat_models import ChatAnyscale
-from langchain_openai import AzureChatOpenAI
-from langchain_community.chat_models import ChatDeepInfra
+from rate_limiter import RateLimiter, estimate_tokens, RATE_LIMIT_STATE_DIR as HOST_RATE_LIMIT_STATE_DIR
+from cache import ResponseCache, cache_key
+from ledger import record_call, get_call_context
+from budget import charge_call
+from telemetry import span
+from mock_llm import MockChatModel
+from retry import RetryPolicy, classify_error, repair_json
+from tree import TreeNode
 
 
 #CONSTANTS
-# File paths for prompts and API key
-PROMPTS_FILE_PATH = '/home/varun/Varun/IFT/Chains/Automate/prompts.json'
-API_KEY_FILE_PATH = '/home/varun/Varun/IFT/Chains/Automate/api_key.json'
+# File paths for prompts and API key, read on first use. Default to the files next to this module
+PROMPTS_FILE_PATH = os.environ.get("SYN_TREES_PROMPTS", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prompts.json'))
+API_KEY_FILE_PATH = os.environ.get("SYN_TREES_API_KEY", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api_key.json'))
+# Model backend: "live" calls the providers of the key file, "mock" answers locally with MockChatModel
+LLM_BACKEND = os.environ.get("SYN_TREES_BACKEND", "live")
+# Settings of the mock backend, passed to every MockChatModel (latency, error rates, seed, ...)
+MOCK_LLM_SETTINGS = {}
+# Number of mock endpoints in each model pool
+MOCK_ENDPOINTS = 1
 
-# Load prompts from file
-with open(PROMPTS_FILE_PATH, 'r') as prompts_file:
-    prompts = json.load(prompts_file)
+# Provider limits shared by all worker processes on the host (requests and tokens per minute),
+# keyed by model name or by endpoint name (e.g. "anyscale:0") to limit a single provider key
+RATE_LIMITS = {
+    "mistralai/Mixtral-8x7B-Instruct-v0.1": {"rpm": 100, "tpm": 200000},
+}
+# Directory of the rate limiter's bucket state. None keeps it in the temporary directory of the host, shared by the
+# workers of that host only. Runs spread over several hosts set it on storage they all mount, so they share one budget
+RATE_LIMIT_STATE_DIR = None
+# Completion tokens reserved for a call before its real usage is known
+COMPLETION_TOKENS_ESTIMATE = 512
+# Backoff and attempts of a call on rate limits, server errors and timeouts
+RETRY_POLICY = RetryPolicy(max_attempts=5, base_delay=1.0, max_delay=30.0)
+# Short call fixing a structured output that could not be repaired locally
+REPAIR_PROMPT = "The text below was meant to follow these format instructions but does not parse.\n\n{format_instructions}\n\nText:\n{output}\n\nReturn only the corrected output."
+# Optional persistent response cache, disabled when the path is None
+RESPONSE_CACHE_PATH = None
+RESPONSE_CACHE_MAX_BYTES = 1 << 30
+# History kept in the User and Moderator prompts: at most the last "max_turns" turns and at most "max_tokens"
+# estimated tokens, None for no limit. With "summary", the intents of the dropped turns are listed ahead of the kept ones
+CONTEXT_POLICY = {"max_turns": None, "max_tokens": None, "summary": True}
+# Optional fixed system message opening the User and Moderator prompts, empty strings send none so the prompts
+# carry only the instructions of prompts.json. Prompts are laid out as this preamble, then the history, then the
+# instructions of the branch, so the children of a node share every byte of their prompts up to their own
+# instructions and are served from the provider's prefix cache
+SYSTEM_PREAMBLES = {"user": "", "moderator": ""}
 
-# Load API key from file
-with open(API_KEY_FILE_PATH, 'r') as api_key_file:
-    key = json.load(api_key_file)
+@lru_cache(maxsize=None)
+def get_prompts() -> dict:
+    """
+    Load the prompts file on first use.
+
+    Returns:
+        dict: Prompt templates by name.
+    """
+    with open(PROMPTS_FILE_PATH, 'r') as prompts_file:
+        return json.load(prompts_file)
+
+@lru_cache(maxsize=None)
+def get_api_key() -> dict:
+    """
+    Load the API key file on first use and set the common environment variables of the provider clients.
+
+    Returns:
+        dict: Provider keys by provider name.
+    """
+    with open(API_KEY_FILE_PATH, 'r') as api_key_file:
+        key = json.load(api_key_file)
+
+    # TODO: Set common environment variables for model
+    os.environ["OPENAI_BASE_URL"] = "https://api.endpoints.anyscale.com/v1"
+    anyscale_key = key.get("anyscale", "")
+    os.environ["ANYSCALE_API_KEY"] = anyscale_key[0] if isinstance(anyscale_key, list) else anyscale_key
+    return key
+
+class Endpoint:
+    """
+    A single provider and key serving a model, along with its observed health.
+
+    Attributes:
+        name (str): Identifier of the endpoint, e.g. "anyscale:0".
+        model: The chat model client of the endpoint.
+        latency (float): Moving average of successful call latency in seconds, None until observed.
+        error_rate (float): Moving average of failed calls between 0 and 1.
+        failures (int): Consecutive failed calls, counting only calls sent after the previous outcome was known.
+        outcome_at (float): Time of the last outcome counted in `failures`.
+        cooldown_until (float): Time until which the endpoint is ejected from routing.
+        tripped (bool): Whether the endpoint was ejected and has not served a call since, i.e. its circuit is half-open.
+        supports_seed (bool): Whether the client accepts a sampling seed with a call.
+    """
+    def __init__(self, name: str, model, supports_seed: bool = False):
+        """
+        Initialize the Endpoint instance.
+
+        Args:
+            name (str): Identifier of the endpoint.
+            model: The chat model client of the endpoint.
+            supports_seed (bool, optional): Whether the client accepts a sampling seed with a call. Defaults to False.
+        """
+        self.name = name
+        self.model = model
+        self.supports_seed = supports_seed
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.outcome_at = 0.0
+        self.cooldown_until = 0.0
+        self.tripped = False
+
+    def score(self) -> float:
+        """
+        Get the routing score of the endpoint, lower is better. Unobserved endpoints have no latency
+        term so they get tried, while recent errors add a penalty of up to 10 seconds.
+
+        Returns:
+            float: Latency weighted by error rate, plus the error penalty.
+        """
+        return (self.latency or 0.0) * (1 + 4 * self.error_rate) + 10 * self.error_rate
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a call finds every endpoint of its model pool ejected, instead of sending it to an endpoint known to fail.
 
-# TODO: Set common environment variables for model
-os.environ["OPENAI_BASE_URL"] = "https://api.endpoints.anyscale.com/v1"
-os.environ["ANYSCALE_API_KEY"] = key.get("anyscale", "")
+    Attributes:
+        retry_after (float): Seconds until the first endpoint's cool-down ends.
+    """
+    def __init__(self, retry_after: float):
+        """
+        Initialize the CircuitOpenError instance.
+
+        Args:
+            retry_after (float): Seconds until the first endpoint's cool-down ends.
+        """
+        super().__init__(f"Every endpoint of the model pool is ejected, the first one is tried again in {retry_after:.0f}s")
+        self.retry_after = retry_after
 
 class ModelPool():
-    def __init__(self, models):
-        self.models = models
-        random.shuffle(self.models)
-        self.current_index = 0
-    
-    def get_model(self):
-        model = self.models[self.current_index]
-        self.current_index = (self.current_index + 1) % len(self.models)
-        return model
+    """
+    A load balancer over several endpoints serving the same model.
+    Each call is routed to the healthy endpoint with the lowest observed latency and error rate, and a failing
+    call moves on to the next endpoint. Every endpoint has a circuit breaker: after repeated failures it is
+    ejected for a cool-down period, then gets trial calls, and a single failed trial ejects it again.
+    Failures count as consecutive only when each call was sent after the previous one failed, so calls that
+    were in flight together count once, and the last healthy endpoint of a pool is never ejected.
+
+    Attributes:
+        endpoints (list): The Endpoint instances of the pool.
+        cooldown (float): Seconds an unhealthy endpoint is ejected for.
+        max_failures (int): Consecutive failures after which an endpoint is ejected.
+        smoothing (float): Weight of the newest observation in the moving averages.
+    """
+    def __init__(self, endpoints: list, cooldown: float = 60.0, max_failures: int = 3, smoothing: float = 0.2):
+        """
+        Initialize the ModelPool instance.
+
+        Args:
+            endpoints (list): The Endpoint instances of the pool.
+            cooldown (float, optional): Seconds an unhealthy endpoint is ejected for. Defaults to 60.
+            max_failures (int, optional): Consecutive failures after which an endpoint is ejected. Defaults to 3.
+            smoothing (float, optional): Weight of the newest observation in the moving averages. Defaults to 0.2.
+        """
+        if not endpoints:
+            raise ValueError("ModelPool needs at least one endpoint")
+        self.endpoints = endpoints
+        self.cooldown = cooldown
+        self.max_failures = max_failures
+        self.smoothing = smoothing
+
+    def candidates(self, seed: int = None) -> list:
+        """
+        Get the healthy endpoints in the order a call should try them, by score. Ejected endpoints are left out
+        until their cool-down ends, so the list is empty while every circuit is open.
+        Endpoints of equal score are ordered by a hash of the call's seed, so seeded calls pick the same
+        endpoint on every rerun while different nodes, and the workers, spread over the endpoints.
+
+        Args:
+            seed (int, optional): Seed of the call, the process id when None. Defaults to None.
+
+        Returns:
+            list: Ordered Endpoint instances.
+        """
+        now = time.time()
+        salt = os.getpid() if seed is None else seed
+
+        def tiebreak(endpoint):
+            return hashlib.blake2b(f"{salt}:{endpoint.name}".encode("utf-8"), digest_size=8).digest()
+
+        return sorted((e for e in self.endpoints if e.cooldown_until <= now), key=lambda e: (e.score(), tiebreak(e)))
+
+    def route(self, seed: int = None) -> Endpoint:
+        """
+        Get the endpoint a call should try next.
+
+        Args:
+            seed (int, optional): Seed of the call, see `candidates`. Defaults to None.
+
+        Returns:
+            Endpoint: The best healthy endpoint.
+
+        Raises:
+            CircuitOpenError: When every endpoint is ejected.
+        """
+        candidates = self.candidates(seed)
+        if not candidates:
+            retry_after = min(e.cooldown_until for e in self.endpoints) - time.time()
+            raise CircuitOpenError(max(retry_after, 0.0))
+        return candidates[0]
+
+    def report_success(self, endpoint: Endpoint, latency: float):
+        """
+        Record a successful call on an endpoint.
+
+        Args:
+            endpoint (Endpoint): The endpoint that served the call.
+            latency (float): Latency of the call in seconds.
+        """
+        endpoint.latency = latency if endpoint.latency is None else (1 - self.smoothing) * endpoint.latency + self.smoothing * latency
+        endpoint.error_rate = (1 - self.smoothing) * endpoint.error_rate
+        endpoint.failures = 0
+        endpoint.outcome_at = time.time()
+        endpoint.tripped = False
+
+    def report_failure(self, endpoint: Endpoint, start_time: float):
+        """
+        Record a failed call on an endpoint and eject it once it fails repeatedly, or at once when it
+        fails its trial after a cool-down, unless no other endpoint of the pool is healthy.
+
+        Args:
+            endpoint (Endpoint): The endpoint that failed the call.
+            start_time (float): Time the call was sent.
+        """
+        endpoint.error_rate = (1 - self.smoothing) * endpoint.error_rate + self.smoothing
+        # A call sent before the last outcome was known failed alongside it, not after it
+        if start_time < endpoint.outcome_at:
+            return
+        now = time.time()
+        endpoint.failures += 1
+        endpoint.outcome_at = now
+        others = any(e is not endpoint and e.cooldown_until <= now for e in self.endpoints)
+        if (endpoint.failures >= self.max_failures or endpoint.tripped) and others:
+            endpoint.cooldown_until = now + self.cooldown
+            endpoint.failures = 0
+            endpoint.tripped = True
+
+def _as_list(value) -> list:
+    """
+    Normalize a key file entry that may hold a single value or a list of values.
+
+    Args:
+        value: The entry of the key file.
+
+    Returns:
+        list: The entry as a list, empty when missing.
+    """
+    if not value:
+        return []
+    return value if isinstance(value, list) else [value]
+
+def build_endpoints(model: str, temperature: float) -> list:
+    """
+    Build one endpoint per provider key listed in the key file. Supported entries are "anyscale" and
+    "deepinfra" (a key or a list of keys) and "azure" (a dict or a list of dicts with "endpoint",
+    "api_key", "deployment" and "api_version"). With the "mock" backend, MOCK_ENDPOINTS local mock models are used instead.
+    The OpenAI-compatible endpoints (Anyscale, Azure) and the mock models accept the sampling seed of a call, DeepInfra's client does not.
+
+    Args:
+        model (str): The name of the language model to use.
+        temperature (float): The sampling temperature for model responses.
+
+    Returns:
+        list: Endpoint instances for every configured provider key.
+    """
+    if LLM_BACKEND == "mock":
+        return [Endpoint(f"mock:{index}", MockChatModel(model_name=model, temperature=temperature, **MOCK_LLM_SETTINGS), supports_seed=True) for index in range(MOCK_ENDPOINTS)]
+
+    # Model Integrations imports, deferred since they are slow and only the live backend needs them
+    from langchain_community.chat_models import ChatAnyscale
+    from langchain_openai import AzureChatOpenAI
+    from langchain_community.chat_models import ChatDeepInfra
+
+    key = get_api_key()
+    endpoints = []
+    for index, api_key in enumerate(_as_list(key.get("anyscale"))):
+        endpoints.append(Endpoint(f"anyscale:{index}", ChatAnyscale(model_name=model, temperature=temperature, anyscale_api_key=api_key), supports_seed=True))
+    for index, api_key in enumerate(_as_list(key.get("deepinfra"))):
+        endpoints.append(Endpoint(f"deepinfra:{index}", ChatDeepInfra(model_name=model, temperature=temperature, deepinfra_api_token=api_key)))
+    for index, azure in enumerate(_as_list(key.get("azure"))):
+        endpoints.append(Endpoint(f"azure:{index}", AzureChatOpenAI(
+            azure_endpoint=azure["endpoint"],
+            openai_api_key=azure["api_key"],
+            azure_deployment=azure["deployment"],
+            openai_api_version=azure.get("api_version", "2024-02-01"),
+            temperature=temperature,
+        ), supports_seed=True))
+    return endpoints
+
+@lru_cache(maxsize=None)
+def get_model_pool(model: str, temperature: float) -> ModelPool:
+    """
+    Get the model pool of the current process for a model, so that all roles share endpoint health.
+
+    Args:
+        model (str): The name of the language model to use.
+        temperature (float): The sampling temperature for model responses.
+
+    Returns:
+        ModelPool: The pool over every configured endpoint of the model.
+    """
+    return ModelPool(build_endpoints(model, temperature))
+
+# Define a Pydantic model for user prompt
+class UserPydantic(BaseModel):
+    prompt: str = Field(description="content of the prompt generated")
+
+# Define a Pydantic model for moderator ideas
+class ModeratorPydantic(BaseModel):
+    intents: List[str] = Field(description="list of tasks")
 
 class Parser:
     """
-    This class contains static methods to generate parsers for different
+    This class contains static methods to generate parsers for different LLM roles.
+    Parsers are stateless, so each one is built once per process and shared.
     """
     
     @staticmethod
+    @lru_cache(maxsize=None)
     def user_parser() -> PydanticOutputParser:
         """
         Create a parser for User LLM
@@ -56,13 +348,10 @@ class Parser:
         Return:
             PydanticOutputParser: the parser configured to handle User LLM response
         """
-        # Define a Pydantic model for user prompt
-        class UserPydantic(BaseModel):
-            prompt: str = Field(description="content of the prompt generated")
-
         return PydanticOutputParser(pydantic_object=UserPydantic)
 
     @staticmethod
+    @lru_cache(maxsize=None)
     def assistant_parser() -> StrOutputParser:
         """
         Create a parser for Assistant LLM
@@ -73,6 +362,7 @@ class Parser:
         return StrOutputParser()
 
     @staticmethod
+    @lru_cache(maxsize=None)
     def moderator_parser() -> PydanticOutputParser:
         """
         Create a parser for Moderator LLM
@@ -80,62 +370,613 @@ class Parser:
         Return:
             PydanticOutputParser: the parser configured to handle Moderator LLM response
         """
-        # Define a Pydantic model for moderator ideas
-        class ModeratorPydantic(BaseModel):
-            intents: List[str] = Field(description="list of tasks")
-        
         return PydanticOutputParser(pydantic_object=ModeratorPydantic)
 
-class UserLLM:
+def canonical_text(text: str) -> str:
+    """
+    Normalise the text of a turn for the prompts, so a turn renders to the same bytes whether it was just
+    generated or loaded back from a checkpoint.
+
+    Args:
+        text (str): A user prompt or an assistant response.
+
+    Returns:
+        str: The text with Unix line endings and without surrounding whitespace.
+    """
+    return text.replace("\r\n", "\n").strip()
+
+def prompt_layout(preamble: str, template: str, format_instructions: str) -> ChatPromptTemplate:
+    """
+    Build a prompt in the layout shared by the User and Moderator roles: the fixed system preamble,
+    then a single human message holding the history and the instructions of the branch.
+
+    Args:
+        preamble (str): The system preamble of the role, empty for none.
+        template (str): The human message, "{history}" first when the prompt carries the conversation.
+        format_instructions (str): The format instructions of the role's parser.
+
+    Returns:
+        ChatPromptTemplate: The prompt template.
+    """
+    messages = [("system", preamble)] if preamble else []
+    messages.append(("human", template))
+    return ChatPromptTemplate.from_messages(messages).partial(format_instructions=format_instructions)
+
+def _turn_memo(node: TreeNode) -> dict:
+    """
+    Render the turn of a node for the prompts once. The rendering is kept on the node, so the nodes below it
+    reuse it and it is freed along with the tree.
+
+    Args:
+        node (TreeNode): The node of the turn.
+
+    Returns:
+        dict: "text" for the User and Moderator prompts, "messages" for the Assistant prompt and the estimated "tokens" of the text.
+    """
+    if node.memo is None:
+        prompt, response = canonical_text(node.prompt), canonical_text(node.response)
+        node.memo = {
+            "text": f"User: \"{prompt}\"\nAssistant: \"{response}\"\n",
+            "messages": (HumanMessage(content=prompt), AIMessage(content=response)),
+            "tokens": estimate_tokens(node.prompt) + estimate_tokens(node.response) + 4,
+        }
+    return node.memo
+
+def format_history(history: TreeNode, policy: dict = None) -> str:
+    """
+    Render conversation history into a single string for the User and Moderator prompts, keeping only
+    the most recent turns allowed by the context policy.
+
+    Args:
+        history (TreeNode): The last turn of the conversation.
+        policy (dict, optional): "max_turns", "max_tokens" and "summary". Defaults to CONTEXT_POLICY.
+
+    Returns:
+        str: The rendered conversation history.
+    """
+    policy = CONTEXT_POLICY if policy is None else policy
+
+    # Walk up from the latest turn while the window fits the policy, `cut` ends as the last dropped turn
+    kept, tokens, cut = [], 0, history
+    max_turns, max_tokens = policy.get("max_turns"), policy.get("max_tokens")
+    while cut is not None and (max_turns is None or len(kept) < max_turns):
+        memo = _turn_memo(cut)
+        tokens += memo["tokens"]
+        # The latest turn is always kept
+        if max_tokens is not None and tokens > max_tokens and kept:
+            break
+        kept.append(memo["text"])
+        cut = cut.parent
+
+    # Only the kept turns are rendered, oldest first
+    rendered = "".join(reversed(kept))
+    if cut is not None and policy.get("summary"):
+        rendered = f"Earlier in the conversation, the user covered: {'; '.join(node.intent for node in cut.path())}.\n" + rendered
+    return rendered
+
+def history_messages(history: TreeNode) -> list:
+    """
+    Convert conversation history into chat messages for the Assistant prompt.
+
+    Args:
+        history (TreeNode): The last turn of the conversation, None for an empty conversation.
+
+    Returns:
+        list: Alternating human and ai messages.
+    """
+    if history is None:
+        return []
+    return [message for node in history.path() for message in _turn_memo(node)["messages"]]
+
+def cached_prompt_tokens(usage: dict) -> int:
+    """
+    Read the prompt tokens served from the provider's prefix cache out of the token usage of a response.
+    OpenAI and vLLM report them as "prompt_tokens_details.cached_tokens", Anthropic as "cache_read_input_tokens".
+
+    Args:
+        usage (dict): The token usage reported by the backend.
+
+    Returns:
+        int: The cached prompt tokens, 0 when the backend reports none.
+    """
+    details = usage.get("prompt_tokens_details") or {}
+    return details.get("cached_tokens") or usage.get("cache_read_input_tokens") or usage.get("cached_tokens") or 0
+
+class PrefixCacheCallback(BaseCallbackHandler):
+    """
+    Callback counting the prompt tokens of a call served from the provider's prefix cache,
+    which the token callback does not report.
+
+    Attributes:
+        cached_tokens (int): Cached prompt tokens of the calls seen so far.
+    """
+    def __init__(self):
+        """
+        Initialize the PrefixCacheCallback instance.
+        """
+        self.cached_tokens = 0
+
+    def on_llm_end(self, response, **kwargs):
+        """
+        Add the cached prompt tokens of a finished call.
+
+        Args:
+            response (LLMResult): The result of the call.
+        """
+        self.cached_tokens += cached_prompt_tokens((response.llm_output or {}).get("token_usage") or {})
+
+# Rate limiter of the current process, built on first use
+_RATE_LIMITER = None
+
+def get_rate_limiter() -> RateLimiter:
+    """
+    Get the rate limiter of the current process. Its state is shared with the other worker processes through files.
+
+    Returns:
+        RateLimiter: The limiter configured with RATE_LIMITS.
+    """
+    global _RATE_LIMITER
+    state_dir = RATE_LIMIT_STATE_DIR or HOST_RATE_LIMIT_STATE_DIR
+    if _RATE_LIMITER is None or _RATE_LIMITER.state_dir != state_dir:
+        _RATE_LIMITER = RateLimiter(RATE_LIMITS, state_dir)
+    return _RATE_LIMITER
+
+# Response cache of the current process, built on first use
+_RESPONSE_CACHE = None
+
+def get_response_cache():
+    """
+    Get the response cache of the current process when RESPONSE_CACHE_PATH is set.
+
+    Returns:
+        ResponseCache: The cache shared by all roles, or None when caching is disabled.
+    """
+    global _RESPONSE_CACHE
+    if _RESPONSE_CACHE is None and RESPONSE_CACHE_PATH:
+        _RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_BYTES)
+    return _RESPONSE_CACHE
+
+class RoleLLM:
+    """
+    A base class for the roles in a conversational trees. Every call of a role goes through
+    `_invoke`/`_ainvoke`, which render the prompt, look it up in the response cache, route it
+    through the model pool, wait for the rate limiter, count tokens, record the call in the ledger and charge it to the budget.
+
+    Attributes:
+        model (str): The name of the language model to use.
+        temperature (float): The sampling temperature for model responses.
+        parser: The output parser of the role.
+        role (str): Name of the role in the ledger, set by each subclass.
+    """
+    role = None
+
+    def __init__(self, parser, model: str = "mistralai/Mixtral-8x7B-Instruct-v0.1", temperature: float = 0.7):
+        """
+        Initialize the RoleLLM instance.
+
+        Args:
+            parser: The output parser of the role.
+            model (str, optional): The name of the language model to use. Defaults to "mistralai/Mixtral-8x7B-Instruct-v0.1".
+            temperature (float, optional): The sampling temperature for model responses. Defaults to 0.7.
+        """
+        self.model_name = model
+        self.temperature = temperature
+        self.parser = parser
+
+        # Template of the repair call, for roles with structured output
+        self.template_repair = None
+        if hasattr(parser, "pydantic_object"):
+            self.template_repair = PromptTemplate(
+                template=REPAIR_PROMPT,
+                input_variables=["output"],
+                partial_variables={"format_instructions":parser.get_format_instructions()},
+            )
+
+    @property
+    def model_pool(self) -> ModelPool:
+        """
+        Get the model pool of the role, building its clients on the first call so that roles are cheap to create.
+
+        Returns:
+            ModelPool: The pool shared by all roles using the same model and temperature.
+        """
+        return get_model_pool(self.model_name, self.temperature)
+
+    def _limit_key(self, endpoint: Endpoint) -> str:
+        """
+        Get the rate limiter key of an endpoint: its own limits when configured, otherwise the model's.
+
+        Args:
+            endpoint (Endpoint): The endpoint serving the call.
+
+        Returns:
+            str: Key into RATE_LIMITS.
+        """
+        return endpoint.name if endpoint.name in RATE_LIMITS else self.model_name
+
+    def limit_keys(self) -> set:
+        """
+        Get the rate limiter keys of the configured endpoints of the role.
+
+        Returns:
+            set: Keys into RATE_LIMITS.
+        """
+        return {self._limit_key(endpoint) for endpoint in self.model_pool.endpoints}
+
+    def _route(self, seed: int, retries: int, call_start: float, fields: dict) -> tuple:
+        """
+        Pick the endpoint of the next attempt of a call. While every circuit is open the attempt waits for the
+        first cool-down to end, like a transient error, and the call fails once it has no attempt left.
+
+        Args:
+            seed (int): Seed of the call, see `ModelPool.candidates`.
+            retries (int): Number of the attempt, starting at 0.
+            call_start (float): Start of the call.
+            fields (dict): Extra ledger fields of the call.
+
+        Returns:
+            endpoint (Endpoint): The endpoint to try, None when every circuit is open.
+            delay (float): Seconds to wait before the next attempt when every circuit is open, otherwise 0.
+        """
+        try:
+            return self.model_pool.route(seed), 0.0
+        except CircuitOpenError as e:
+            if retries == RETRY_POLICY.max_attempts - 1:
+                self._record_call(call_start, error=e, **fields)
+                raise
+            return None, e.retry_after
+
+    def _after_failure(self, endpoint: Endpoint, error: Exception, retries: int, seed: int, start_time: float) -> float:
+        """
+        Decide what follows a failed attempt of a call, the same for the sync and async paths: move on to the best
+        endpoint left in the pool right away, back off before the same endpoint is tried again on transient errors
+        (rate limits, server errors, timeouts), or raise errors another attempt cannot fix. An endpoint error is
+        retried like a transient one when the pool has no other endpoint to fail over to.
+
+        Args:
+            endpoint (Endpoint): The endpoint that failed the attempt.
+            error (Exception): The error of the attempt.
+            retries (int): Number of the failed attempt, starting at 0.
+            seed (int): Seed of the call, see `ModelPool.candidates`.
+            start_time (float): Time the attempt was sent.
+
+        Returns:
+            float: Seconds to back off before the next attempt, 0 to try another endpoint right away.
+        """
+        kind = classify_error(error)
+        if kind == "fatal":
+            raise error
+        self.model_pool.report_failure(endpoint, start_time)
+        if retries == RETRY_POLICY.max_attempts - 1:
+            raise error
+        # Another endpoint is tried right away, the same one only after backing off
+        candidates = self.model_pool.candidates(seed)
+        if not candidates or candidates[0] is not endpoint:
+            return 0.0
+        if kind == "failover" and len(self.model_pool.endpoints) > 1:
+            raise error
+        return RETRY_POLICY.delay(retries)
+
+    def _after_success(self, endpoint: Endpoint, start_time: float, estimate: int, cb, prefix_cache: PrefixCacheCallback) -> dict:
+        """
+        Record a successful attempt on the endpoint's health and the rate limiter.
+
+        Args:
+            endpoint (Endpoint): The endpoint that served the call.
+            start_time (float): Start of the attempt.
+            estimate (int): Tokens taken from the rate limiter for the attempt.
+            cb: The token counting callback of the attempt.
+            prefix_cache (PrefixCacheCallback): The prefix cache callback of the attempt.
+
+        Returns:
+            dict: Token counts (with the prompt tokens served from the provider's prefix cache) and the serving endpoint.
+        """
+        self.model_pool.report_success(endpoint, time.time() - start_time)
+        get_rate_limiter().reconcile(self._limit_key(endpoint), estimate, cb.total_tokens)
+        return {"tokens": cb.total_tokens, "prompt_tokens": cb.prompt_tokens, "completion_tokens": cb.completion_tokens, "cached_tokens": prefix_cache.cached_tokens, "endpoint": endpoint.name}
+
+    def _record_call(self, start_time: float, usage: dict = None, error: Exception = None, **fields):
+        """
+        Record a call in the ledger and charge it to the budget of its tree, or record its error.
+
+        Args:
+            start_time (float): Start of the call.
+            usage (dict, optional): Usage of a successful call, see `_call_model`. Defaults to None.
+            error (Exception, optional): Error of a failed call. Defaults to None.
+            **fields: Extra ledger fields, e.g. repair=True or cached=False.
+        """
+        if error is not None:
+            record_call(role=self.role, model=self.model_name, tokens=0, latency=time.time() - start_time, error=repr(error), **fields)
+            return
+        record_call(role=self.role, model=self.model_name, latency=time.time() - start_time, **fields, **usage)
+        charge_call(get_call_context().get("doc_id"), get_call_context().get("node"), self.model_name, usage["tokens"])
+
+    def _call_model(self, prompt_value, **fields) -> tuple:
+        """
+        Call the model with a rendered prompt under RETRY_POLICY and record the call in the ledger.
+        Failed attempts are handled by `_after_failure`.
+
+        Args:
+            prompt_value: The rendered prompt.
+            **fields: Extra ledger fields of the call.
+
+        Returns:
+            message: The model output message.
+            usage (dict): Token counts (with the prompt tokens served from the provider's prefix cache), serving endpoint, whether the
+                seed was passed to it, number of failed attempts and seconds waited on the rate limiter and on backoff.
+        """
+        estimate = estimate_tokens(prompt_value.to_string()) + COMPLETION_TOKENS_ESTIMATE
+        # Calls made for a node carry its seed, passed on to the sampling of the backends that accept one
+        seed = get_call_context().get("seed")
+        queue_wait, backoff, call_start = 0.0, 0.0, time.time()
+        for retries in range(RETRY_POLICY.max_attempts):
+            endpoint, delay = self._route(seed, retries, call_start, fields)
+            if endpoint is None:
+                time.sleep(delay)
+                backoff += delay
+                continue
+            options = {"seed": seed} if seed is not None and endpoint.supports_seed else {}
+            queue_wait += get_rate_limiter().acquire(self._limit_key(endpoint), estimate)
+            start_time, prefix_cache = time.time(), PrefixCacheCallback()
+            try:
+                # Invoke the model along with callbacks for token counts and prefix cache hits
+                with get_openai_callback() as cb:
+                    message = endpoint.model.invoke(prompt_value, config={"callbacks": [prefix_cache]}, **options)
+            except Exception as e:
+                try:
+                    delay = self._after_failure(endpoint, e, retries, seed, start_time)
+                except Exception:
+                    self._record_call(call_start, error=e, **fields)
+                    raise
+                time.sleep(delay)
+                backoff += delay
+                continue
+            usage = dict(self._after_success(endpoint, start_time, estimate, cb, prefix_cache), seed_applied=bool(options), retries=retries, queue_wait=queue_wait, backoff=backoff)
+            self._record_call(call_start, usage, **fields)
+            return message, usage
+
+    async def _acall_model(self, prompt_value, **fields) -> tuple:
+        """
+        Asynchronously call the model with a rendered prompt, see `_call_model`.
+
+        Args:
+            prompt_value: The rendered prompt.
+            **fields: Extra ledger fields of the call.
+
+        Returns:
+            message: The model output message.
+            usage (dict): Token counts, serving endpoint, number of failed attempts and seconds waited, see `_call_model`.
+        """
+        estimate = estimate_tokens(prompt_value.to_string()) + COMPLETION_TOKENS_ESTIMATE
+        seed = get_call_context().get("seed")
+        queue_wait, backoff, call_start = 0.0, 0.0, time.time()
+        for retries in range(RETRY_POLICY.max_attempts):
+            endpoint, delay = self._route(seed, retries, call_start, fields)
+            if endpoint is None:
+                await asyncio.sleep(delay)
+                backoff += delay
+                continue
+            options = {"seed": seed} if seed is not None and endpoint.supports_seed else {}
+            queue_wait += await get_rate_limiter().aacquire(self._limit_key(endpoint), estimate)
+            start_time, prefix_cache = time.time(), PrefixCacheCallback()
+            try:
+                with get_openai_callback() as cb:
+                    message = await endpoint.model.ainvoke(prompt_value, config={"callbacks": [prefix_cache]}, **options)
+            except Exception as e:
+                try:
+                    delay = self._after_failure(endpoint, e, retries, seed, start_time)
+                except Exception:
+                    self._record_call(call_start, error=e, **fields)
+                    raise
+                await asyncio.sleep(delay)
+                backoff += delay
+                continue
+            usage = dict(self._after_success(endpoint, start_time, estimate, cb, prefix_cache), seed_applied=bool(options), retries=retries, queue_wait=queue_wait, backoff=backoff)
+            self._record_call(call_start, usage, **fields)
+            return message, usage
+
+    def _parse_local(self, message, fields: dict):
+        """
+        Parse a model output without calling the model: as it is, or repaired locally when it is a structured
+        output that does not parse (stray prose, trailing commas, plain lists).
+
+        Args:
+            message: The model output message.
+            fields (dict): Fields of the parse span.
+
+        Returns:
+            tuple: (result, content to cache), or None when only a repair call can fix the output.
+        """
+        try:
+            return self.parser.invoke(message), message.content
+        except OutputParserException:
+            if self.template_repair is None:
+                raise
+        fields["repair"] = "local"
+        result = repair_json(message.content, self.parser.pydantic_object)
+        if result is None:
+            fields["repair"] = "call"
+            return None
+        return result, result.json()
+
+    def _repaired(self, content: str, message):
+        """
+        Parse the output of a repair call.
+
+        Args:
+            content (str): The malformed model output that was sent for repair.
+            message: The output message of the repair call.
+
+        Returns:
+            The parsed model output.
+        """
+        result = repair_json(message.content, self.parser.pydantic_object)
+        if result is None:
+            raise OutputParserException(f"Could not repair output: {content[:200]}")
+        return result
+
+    def _parse(self, message) -> tuple:
+        """
+        Parse a model output. A structured output that does not parse is repaired locally when possible,
+        otherwise with one short repair call, instead of regenerating the whole turn.
+
+        Args:
+            message: The model output message.
+
+        Returns:
+            result: The parsed model output.
+            content (str): The output that parsed, to cache.
+            token_count (int): Count of tokens used by the repair call, 0 without one.
+        """
+        with span(self.role, "parse") as fields:
+            parsed = self._parse_local(message, fields)
+            if parsed is not None:
+                return (*parsed, 0)
+            repair, usage = self._call_model(self.template_repair.invoke({"output": message.content}), repair=True)
+            result = self._repaired(message.content, repair)
+            return result, result.json(), usage["tokens"]
+
+    async def _aparse(self, message) -> tuple:
+        """
+        Asynchronously parse a model output, see `_parse`.
+
+        Args:
+            message: The model output message.
+
+        Returns:
+            result: The parsed model output.
+            content (str): The output that parsed, to cache.
+            token_count (int): Count of tokens used by the repair call, 0 without one.
+        """
+        with span(self.role, "parse") as fields:
+            parsed = self._parse_local(message, fields)
+            if parsed is not None:
+                return (*parsed, 0)
+            repair, usage = await self._acall_model(self.template_repair.invoke({"output": message.content}), repair=True)
+            result = self._repaired(message.content, repair)
+            return result, result.json(), usage["tokens"]
+
+    def _lookup(self, template, inputs: dict, fields: dict) -> tuple:
+        """
+        Render the prompt of a call and look it up in the response cache.
+
+        Args:
+            template: The prompt template of the call.
+            inputs (dict): Input variables of the template.
+            fields (dict): Fields of the call span.
+
+        Returns:
+            prompt_value: The rendered prompt.
+            address (str): Cache key of the call, None when caching is disabled.
+            result: The parsed cached output, None on a miss.
+        """
+        prompt_value = template.invoke(inputs)
+        cache = get_response_cache()
+        if cache is None:
+            return prompt_value, None, None
+        address = cache_key(prompt_value.to_messages(), self.model_name, self.temperature, get_call_context().get("seed"))
+        cached = cache.get(address)
+        fields["cached"] = cached is not None
+        if cached is None:
+            return prompt_value, address, None
+        record_call(role=self.role, model=self.model_name, tokens=0, latency=0.0, retries=0, cached=True)
+        with span(self.role, "parse"):
+            return prompt_value, address, self.parser.invoke(AIMessage(content=cached[0]))
+
+    def _store(self, address: str, content: str, tokens: int):
+        """
+        Cache an output that parsed, so a hit never replays a broken response.
+
+        Args:
+            address (str): Cache key of the call, None when caching is disabled.
+            content (str): The output that parsed.
+            tokens (int): Tokens the call used.
+        """
+        if address is not None:
+            get_response_cache().put(address, content, tokens)
+
+    def _invoke(self, template, inputs: dict) -> tuple:
+        """
+        Render the template and invoke the model and parser, serving the call from the response cache when
+        possible. Every call is recorded in the ledger, and the call and its parsing are traced as spans.
+
+        Args:
+            template: The prompt template of the call.
+            inputs (dict): Input variables of the template.
+
+        Returns:
+            result: The parsed model output.
+            token_count (int): Count of tokens used for model to produce the output, 0 for cached calls.
+        """
+        with span(self.role, "llm") as fields:
+            prompt_value, address, result = self._lookup(template, inputs, fields)
+            if result is not None:
+                return result, 0
+            message, usage = self._call_model(prompt_value, cached=False if address is not None else None)
+            fields.update(usage)
+            result, content, repair_tokens = self._parse(message)
+            self._store(address, content, usage["tokens"])
+            return result, usage["tokens"] + repair_tokens
+
+    async def _ainvoke(self, template, inputs: dict) -> tuple:
+        """
+        Asynchronously render the template and invoke the model and parser, see `_invoke`.
+
+        Args:
+            template: The prompt template of the call.
+            inputs (dict): Input variables of the template.
+
+        Returns:
+            result: The parsed model output.
+            token_count (int): Count of tokens used for model to produce the output, 0 for cached calls.
+        """
+        with span(self.role, "llm") as fields:
+            prompt_value, address, result = self._lookup(template, inputs, fields)
+            if result is not None:
+                return result, 0
+            message, usage = await self._acall_model(prompt_value, cached=False if address is not None else None)
+            fields.update(usage)
+            result, content, repair_tokens = await self._aparse(message)
+            self._store(address, content, usage["tokens"])
+            return result, usage["tokens"] + repair_tokens
+
+    def get_model_name(self) -> str:
+        """
+        Get the name of the language model used by the role for logging.
+
+        Returns:
+            str: The name of the language model.
+        """
+        return self.model_name
+
+class UserLLM(RoleLLM):
     """
         A class representing a user in a conversational trees.
+        The instance is long-lived: the conversation history is passed on every call.
 
         Attributes:
-            history (list): A list of tuples representing the conversation history.
             model (str): The name of the language model to use.
             temperature (float): The sampling temperature for model responses.
 
     """
-    def __init__(self, history: list = [], model: str = "mistralai/Mixtral-8x7B-Instruct-v0.1", temperature: float = 0.7):
+    role = "user"
+
+    def __init__(self, model: str = "mistralai/Mixtral-8x7B-Instruct-v0.1", temperature: float = 0.7):
         """
-        Initialize the UserLLM instance. This class object has two chains: to initialize chat and to continue chat.
+        Initialize the UserLLM instance. This class object has two templates: to initialize chat and to continue chat.
 
         Args:
-            history (list, optional): A list of tuples representing the conversation history. Defaults to an empty list.
             model (str, optional): The name of the language model to use. Defaults to "mistralai/Mixtral-8x7B-Instruct-v0.1".
             temperature (float, optional): The sampling temperature for model responses. Defaults to 0.7.
         """
-        # TODO: Initialize the model pool by listing models to avoid limiting errors
-        self.model_pool = ModelPool([
-            ChatAnyscale(model_name=model, temperature=temperature, anyscale_api_key=key.get("anyscale", ""))
-        ])
-        #Initialize the language model and parser
-        self.model = self.model_pool.get_model()
-        self.parser = Parser.user_parser()
-
-        
-        # Initialize prompt template for User prompt initiation chain
-        self.template_init = PromptTemplate(
-            template=f"{prompts.get('User_first', '')}",
-            input_variables=["intent","domain"],
-            partial_variables={"format_instructions":self.parser.get_format_instructions()},
-        )
-
-        # Concatenate conversation history into a single string
-        chat_history = ''
-        for _, user_prompt, assis_prompt in history:
-            chat_history += f"User: \"{user_prompt}\"\nAssistant: \"{assis_prompt}\"\n"
-        
-        # Initialize prompt template for User prompt continuation chain from chat history
-        self.template_cont = PromptTemplate(
-            template= f"{chat_history + prompts.get('User_next', '')}",
-            input_variables=["intent","domain"],
-            partial_variables={"format_instructions":self.parser.get_format_instructions()},
-        )
-
-        # Define user chains using templates, model and parser
-        self.first_chain = self.template_init | self.model | self.parser    # Chain to initiate conversation as User
-        self.next_chain = self.template_cont | self.model | self.parser     # Chain to continue conversation as User
+        super().__init__(Parser.user_parser(), model, temperature)
+
+        # Initialize prompt template for User prompt initiation
+        self.template_init = prompt_layout(SYSTEM_PREAMBLES["user"], get_prompts().get('User_first', ''), self.parser.get_format_instructions())
+
+        # Initialize prompt template for User prompt continuation, the chat history is a runtime input
+        # that comes before the intent of the branch
+        self.template_cont = prompt_layout(SYSTEM_PREAMBLES["user"], "{history}" + get_prompts().get('User_next', ''), self.parser.get_format_instructions())
     
     def generate_initiation_prompt(self, intent: str ,domain: str) -> str:
         """
@@ -149,185 +990,180 @@ class UserLLM:
             prompt (str): The generated prompt for the user.
             token_count (int): Count of tokens used for model to produce prompts.
         """
+        result, user_token_count = self._invoke(self.template_init, {"intent":f"{intent}","domain":f"{domain}"})
+        return result.prompt, user_token_count
 
-        # Invoke the chain to generate the initiation prompt along with callback for token counts
-        with get_openai_callback() as cb:
-            result = self.first_chain.invoke({"intent":f"{intent}","domain":f"{domain}"})
-            user_token_count = cb.total_tokens
-        
-        # Console prints
-        # print('###User###')
-        # print(result)
+    async def agenerate_initiation_prompt(self, intent: str, domain: str) -> str:
+        """
+        Asynchronously generate a prompt as a User to initiate conversation with assistant.
+
+        Args:
+            intent (str): The user's intent for the conversation.
+            domain (str): The domain or topic of the conversation.
+
+        Returns:
+            prompt (str): The generated prompt for the user.
+            token_count (int): Count of tokens used for model to produce prompts.
+        """
+        result, user_token_count = await self._ainvoke(self.template_init, {"intent":f"{intent}","domain":f"{domain}"})
         return result.prompt, user_token_count
     
-    def generate_continuation_prompt(self, intent: str, domain: str) -> str:
+    def generate_continuation_prompt(self, intent: str, domain: str, history: TreeNode) -> str:
         """
         Generate a prompt as a User to continue conversation with assistant.
 
         Args:
             intent (str): The user's intent for the conversation.
             domain (str): The domain or topic of the conversation.
+            history (TreeNode): The last turn of the conversation, None before the first turn.
 
         Returns:
             prompt (str): The generated prompt for the user.
             token_count (int): Count of tokens used for model to produce prompts.
         """
-
-        # Invoke the chain to generate the continuation prompt along with callback for token counts
-        with get_openai_callback() as cb:
-            result = self.next_chain.invoke({"intent":f"{intent}", "domain":f"{domain}"})
-            user_token_count = cb.total_tokens
-        
-        # Console prints
-        # print('###User###')
-        # print(result)
+        result, user_token_count = self._invoke(self.template_cont, {"history":format_history(history), "intent":f"{intent}", "domain":f"{domain}"})
         return result.prompt, user_token_count
-    
-    def get_model_name(self) -> str:
+
+    async def agenerate_continuation_prompt(self, intent: str, domain: str, history: TreeNode) -> str:
         """
-        Get the name of the language model used by the user for logging.
+        Asynchronously generate a prompt as a User to continue conversation with assistant.
+
+        Args:
+            intent (str): The user's intent for the conversation.
+            domain (str): The domain or topic of the conversation.
+            history (TreeNode): The last turn of the conversation, None before the first turn.
 
         Returns:
-            str: The name of the language model.
+            prompt (str): The generated prompt for the user.
+            token_count (int): Count of tokens used for model to produce prompts.
         """
-        return self.model.model_name
+        result, user_token_count = await self._ainvoke(self.template_cont, {"history":format_history(history), "intent":f"{intent}", "domain":f"{domain}"})
+        return result.prompt, user_token_count
 
-class AssistantLLM():
+class AssistantLLM(RoleLLM):
     """
     A class representing an assistant in a conversational trees.
+    The instance is long-lived: the conversation history is passed on every call.
 
     Attributes:
-        history (list): A list of tuples representing the conversation history.
         model (str): The name of the language model to use.
         temperature (float): The sampling temperature for model responses.
     """
-    def __init__(self, history: list = [], model: str = "mistralai/Mixtral-8x7B-Instruct-v0.1", temperature: float = 0.7):
+    role = "assistant"
+
+    def __init__(self, model: str = "mistralai/Mixtral-8x7B-Instruct-v0.1", temperature: float = 0.7):
         """
         Initialize the AssistantLLM instance.
 
         Args:
-            history (list, optional): A list of tuples representing the conversation history. Defaults to an empty list.
             model (str, optional): The name of the language model to use. Defaults to "mistralai/Mixtral-8x7B-Instruct-v0.1".
             temperature (float, optional): The sampling temperature for model responses. Defaults to 0.7.
         """
-        # TODO: Initialize the model pool by listing models to avoid limiting errors
-        self.model_pool = ModelPool([
-            ChatAnyscale(model_name=model, temperature=temperature, anyscale_api_key=key.get("anyscale", ""))
+        super().__init__(Parser.assistant_parser(), model, temperature)
+
+        # Initialize prompt template for Assistant prompt, the chat history is a runtime input
+        self.template = ChatPromptTemplate.from_messages([
+            ("system", "You are a helpful and toxicless assistant."),
+            MessagesPlaceholder(variable_name="history"),
+            ("human","{prompt}"),
         ])
-        #Initialize the language model and parser
-        self.model = self.model_pool.get_model()
-        self.parser = Parser.assistant_parser()
-
-        # Initialize prompt template for Assistant prompt chain
-        pre_template_list = [("system", "You are a helpful and toxicless assistant.")]
-        for _, prompt, response in history:
-            pre_template_list.extend([("human",f"{prompt}")])
-            pre_template_list.extend([("ai",f"{response}")])
-        pre_template_list.extend([("human","{prompt}")])
-        self.template = ChatPromptTemplate.from_messages(pre_template_list)
-
-        # Define assistant chain using template, model and parser
-        self.chain = self.template | self.model | self.parser
     
-    def respond_to_user_prompt(self, user_prompt: str) -> str:
+    def respond_to_user_prompt(self, user_prompt: str, history: TreeNode) -> str:
         """
         Generate a response to a user's prompt.
 
         Args:
             user_prompt (str): The prompt provided by the user.
+            history (TreeNode): The last turn of the conversation, None before the first turn.
 
         Returns:
             response (str): The generated reponse for the user prompt.
             token_count (int): Count of tokens used for model to produce response.
         """
+        return self._invoke(self.template, {"history":history_messages(history), "prompt":user_prompt})
 
-        # Invoke the chain to generate the response prompt along with callback for token counts
-        with get_openai_callback() as cb:
-            result = self.chain.invoke({"prompt":user_prompt})
-            assistant_token_count = cb.total_tokens
-
-        # Console prints
-        # print('###Assistant###')
-        # print(result)
-        return result, assistant_token_count
-
-    def get_model_name(self) -> str:
+    async def arespond_to_user_prompt(self, user_prompt: str, history: TreeNode) -> str:
         """
-        Get the name of the language model used by the assistant for logging.
+        Asynchronously generate a response to a user's prompt.
+
+        Args:
+            user_prompt (str): The prompt provided by the user.
+            history (TreeNode): The last turn of the conversation, None before the first turn.
 
         Returns:
-            str: The name of the language model.
+            response (str): The generated reponse for the user prompt.
+            token_count (int): Count of tokens used for model to produce response.
         """
-        return self.model.model_name
+        return await self._ainvoke(self.template, {"history":history_messages(history), "prompt":user_prompt})
 
-class ModeratorLLM:
+class ModeratorLLM(RoleLLM):
     """
     A class representing a moderator in a conversational trees.
+    The instance is long-lived: the conversation history is passed on every call.
 
     Attributes:
-        history (list): A list of tuples representing the conversation history.
         model (str): The name of the language model to use.
         temperature (float): The sampling temperature for model responses.
     """
-    def __init__(self, history: list = [], model: str = "mistralai/Mixtral-8x7B-Instruct-v0.1", temperature: float = 0.7):
+    role = "moderator"
+
+    def __init__(self, model: str = "mistralai/Mixtral-8x7B-Instruct-v0.1", temperature: float = 0.7):
         """
         Initialize the ModeratorLLM instance.
 
         Args:
-            history (list, optional): A list of tuples representing the conversation history. Defaults to an empty list.
             model (str, optional): The name of the language model to use. Defaults to "mistralai/Mixtral-8x7B-Instruct-v0.1".
             temperature (float, optional): The sampling temperature for model responses. Defaults to 0.7.
         """
-        # TODO: Initialize the model pool by listing models to avoid limiting errors
-        self.model_pool = ModelPool([
-            ChatAnyscale(model_name=model, temperature=temperature, anyscale_api_key=key.get("anyscale", ""))
-        ])
-        #Initialize the language model and parser
-        self.model = self.model_pool.get_model()
-        self.parser = Parser.moderator_parser()
-
-        # Concatenate conversation history into a single string
-        history_temp = ''
-        for _, user_prompt, assis_prompt in history:
-            history_temp += f"User: \"{user_prompt}\"\nAssistant: \"{assis_prompt}\"\n"
-        
-        # Initialize prompt template for Moderator response chain from chat history
-        self.template = PromptTemplate(
-            template=f"{history_temp + prompts.get('Moderator', '')}",
-            input_variables=["intent"],
-            partial_variables={"format_instructions":self.parser.get_format_instructions()},
-        )
-        
-        # Create the conversation chain using the prompt template, model, and parser
-        self.chain = self.template | self.model | self.parser
+        super().__init__(Parser.moderator_parser(), model, temperature)
+
+        # Initialize prompt template for Moderator response, the chat history is a runtime input
+        # that comes before the intent of the branch
+        self.template = prompt_layout(SYSTEM_PREAMBLES["moderator"], "{history}" + get_prompts().get('Moderator', ''), self.parser.get_format_instructions())
     
-    def suggest_next_sub_intents(self ,intent: str) -> list:
+    def suggest_next_sub_intents(self ,intent: str, history: TreeNode) -> list:
         """
         Suggest next sub-intents based on the conversation history.
 
         Args:
             intent (str): The current intent.
+            history (TreeNode): The last turn of the conversation, None before the first turn.
 
         Returns:
             ideas (list): A list of suggested sub-intents.
             token_count (int): Count of tokens used for model to produce ideas.
         """
-
-        # Invoke the chain to generate the moderator response along with callback for token counts
-        with get_openai_callback() as cb:
-            ideas = self.chain.invoke({"intent":intent})
-            moderator_token_count = cb.total_tokens
-
-        # Console prints
-        # print('###Moderator###')
-        # print(ideas)
+        ideas, moderator_token_count = self._invoke(self.template, {"history":format_history(history), "intent":intent})
         return ideas.intents, moderator_token_count
 
-    def get_model_name(self) -> str:
+    async def asuggest_next_sub_intents(self, intent: str, history: TreeNode) -> list:
         """
-        Get the name of the language model used by the moderator for logging.
+        Asynchronously suggest next sub-intents based on the conversation history.
+
+        Args:
+            intent (str): The current intent.
+            history (TreeNode): The last turn of the conversation, None before the first turn.
 
         Returns:
-            str: The name of the language model.
+            ideas (list): A list of suggested sub-intents.
+            token_count (int): Count of tokens used for model to produce ideas.
         """
-        return self.model.model_name
+        ideas, moderator_token_count = await self._ainvoke(self.template, {"history":format_history(history), "intent":intent})
+        return ideas.intents, moderator_token_count
+
+# Role sessions built once per process and reused for every turn
+_ROLES = {}
+
+def get_roles() -> dict:
+    """
+    Get the long-lived role sessions of the current process, building them on first use.
+    Sharing one instance per role keeps the HTTP client, parsers and templates alive across turns.
+
+    Returns:
+        dict: The "user", "assistant" and "moderator" role instances.
+    """
+    if not _ROLES:
+        _ROLES["user"] = UserLLM()
+        _ROLES["assistant"] = AssistantLLM()
+        _ROLES["moderator"] = ModeratorLLM()
+    return _ROLES
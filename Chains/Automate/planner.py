@@ -0,0 +1,350 @@
+# Import nessessary packages
+import json
+import random
+import argparse
+
+from ledger import ROLE_TITLES, token_cost, read_jsonl
+from inputs import read_inputs, parse_shard
+
+#CONSTANTS
+ROLES = ("user", "assistant", "moderator")
+# Ideas suggested by the moderator, the children of a node are sampled among them like in `expand_node`
+MAX_CHILDREN = 5
+# Rough tokens of a call without history to calibrate from, as (first turn, added per turn of history above the node)
+DEFAULT_CALL_TOKENS = {"user": (350, 250), "assistant": (550, 300), "moderator": (350, 250)}
+# Rough seconds of a call without history to calibrate from
+DEFAULT_CALL_SECONDS = {"user": 2.0, "assistant": 6.0, "moderator": 2.5}
+# Trees simulated per run, totals of larger inputs are scaled up from them
+SIMULATED_TREES = 1000
+# Percentiles reported for every quantity
+PERCENTILES = (5, 50, 95)
+
+def branch_depth(name: str) -> int:
+    """
+    Get the depth of a node from its branch name, e.g. 2 for "C-1-3-".
+
+    Args:
+        name (str): Branch name of the node.
+
+    Returns:
+        int: Number of turns above the node.
+    """
+    return name.count('-') - 1
+
+class CallProfile:
+    """
+    Expected tokens and service seconds of one call of each role, by depth of the node it is made for,
+    since deeper nodes send a longer history. Profiles are calibrated from the ledger of a previous run,
+    from its per-tree token counts, or left at the rough defaults.
+
+    Attributes:
+        tokens (dict): role -> {depth: mean tokens of a call}.
+        seconds (dict): role -> {depth: mean seconds of a call, without rate-limiter waits and backoff}.
+        tree_tokens (dict): role -> mean tokens of a whole tree, when calibrated from token counts.
+    """
+    def __init__(self, tokens: dict = None, seconds: dict = None, tree_tokens: dict = None):
+        """
+        Initialize the CallProfile instance.
+
+        Args:
+            tokens (dict, optional): role -> {depth: mean tokens of a call}. Defaults to None.
+            seconds (dict, optional): role -> {depth: mean seconds of a call}. Defaults to None.
+            tree_tokens (dict, optional): role -> mean tokens of a whole tree. Defaults to None.
+        """
+        self.tokens = tokens or {}
+        self.seconds = seconds or {}
+        self.tree_tokens = tree_tokens
+
+    @staticmethod
+    def _lookup(table: dict, depth: int):
+        """
+        Get the value of a depth, or of the deepest calibrated depth above it.
+
+        Args:
+            table (dict): depth -> value.
+            depth (int): Depth of the node.
+
+        Returns:
+            The value, None when the table is empty.
+        """
+        known = [level for level in table if level <= depth] or list(table)
+        return table[max(known)] if known else None
+
+    def call_tokens(self, role: str, depth: int) -> float:
+        """
+        Get the expected tokens of a call.
+
+        Args:
+            role (str): "user", "assistant" or "moderator".
+            depth (int): Depth of the node.
+
+        Returns:
+            float: Mean tokens.
+        """
+        value = self._lookup(self.tokens.get(role, {}), depth)
+        if value is None:
+            first, per_turn = DEFAULT_CALL_TOKENS[role]
+            value = first + per_turn * depth
+        return value
+
+    def call_seconds(self, role: str, depth: int) -> float:
+        """
+        Get the expected service time of a call.
+
+        Args:
+            role (str): "user", "assistant" or "moderator".
+            depth (int): Depth of the node.
+
+        Returns:
+            float: Mean seconds.
+        """
+        value = self._lookup(self.seconds.get(role, {}), depth)
+        return DEFAULT_CALL_SECONDS[role] if value is None else value
+
+    @classmethod
+    def from_ledger(cls, path: str):
+        """
+        Calibrate a profile from the call ledger of a previous run. Failed and cached calls are left out.
+
+        Args:
+            path (str): Path of the @-ledger.jsonl file.
+
+        Returns:
+            CallProfile: The calibrated profile.
+        """
+        sums = {}       # (role, depth) -> [calls, tokens, seconds]
+        for entry in read_jsonl(path):
+            if entry.get("role") not in ROLES or "error" in entry or entry.get("cached") is True or not entry.get("node"):
+                continue
+            seconds = (entry.get("latency") or 0.0) - (entry.get("queue_wait") or 0.0) - (entry.get("backoff") or 0.0)
+            total = sums.setdefault((entry["role"], branch_depth(entry["node"])), [0, 0, 0.0])
+            total[0] += 1
+            total[1] += entry.get("tokens") or 0
+            total[2] += max(seconds, 0.0)
+        tokens, seconds = {}, {}
+        for (role, depth), (calls, role_tokens, role_seconds) in sums.items():
+            tokens.setdefault(role, {})[depth] = role_tokens / calls
+            seconds.setdefault(role, {})[depth] = role_seconds / calls
+        return cls(tokens, seconds)
+
+    @classmethod
+    def from_token_counts(cls, path: str):
+        """
+        Calibrate a profile from the per-tree token counts of a previous run. They carry no call counts,
+        so the tokens of a tree are spread over the calls the simulation expects per tree, see `plan`.
+
+        Args:
+            path (str): Path of the @-token_counts.json file.
+
+        Returns:
+            CallProfile: The calibrated profile.
+        """
+        with open(path, "r") as file:
+            summary = json.load(file)
+        tree_tokens = {}
+        for role, title in ROLE_TITLES.items():
+            counts = [doc[title]["token count"] for doc in summary if title in doc]
+            if counts:
+                tree_tokens[role] = sum(counts) / len(counts)
+        return cls(tree_tokens=tree_tokens)
+
+def load_profile(path: str = None) -> CallProfile:
+    """
+    Build the call profile from a ledger or token counts file, or the defaults without one.
+
+    Args:
+        path (str, optional): Path of an @-ledger.jsonl or @-token_counts.json file. Defaults to None.
+
+    Returns:
+        CallProfile: The profile.
+    """
+    if path is None:
+        return CallProfile()
+    if path.endswith(".jsonl"):
+        return CallProfile.from_ledger(path)
+    return CallProfile.from_token_counts(path)
+
+def simulate_tree(turns: int, rng: random.Random, ideas: int = MAX_CHILDREN) -> list:
+    """
+    Draw the shape of one tree with the branching rules of `expand_node`: every node below the last turn
+    asks the moderator for ideas, then samples between 1 (on the first turn) or 0 (after it) and 5 children
+    among its distinct ideas.
+
+    Args:
+        turns (int): Turns of every conversation.
+        rng (random.Random): Random stream of the simulation.
+        ideas (int, optional): Distinct ideas left per moderator call after deduplication. Defaults to MAX_CHILDREN.
+
+    Returns:
+        levels (list): Number of nodes at every depth, root first.
+        leaves (int): Number of nodes without children.
+    """
+    levels, leaves = [1], 0
+    while len(levels) < turns:
+        low = 1 if len(levels) == 1 else 0
+        children = [min(ideas, rng.randint(low, MAX_CHILDREN)) for _ in range(levels[-1])]
+        leaves += children.count(0)
+        if not sum(children):
+            return levels, leaves
+        levels.append(sum(children))
+    return levels, leaves + levels[-1]
+
+def tree_usage(levels: list, leaves: int, turns: int, profile: CallProfile) -> dict:
+    """
+    Count the calls, tokens and seconds of a simulated tree.
+
+    Args:
+        levels (list): Number of nodes at every depth.
+        leaves (int): Number of nodes without children.
+        turns (int): Turns of every conversation.
+        profile (CallProfile): Expected tokens and seconds of the calls.
+
+    Returns:
+        dict: "nodes", "leaves", "calls" and "tokens" by role, "call_seconds" summed over calls, and
+            "chain_seconds", the time of the deepest branch whose calls run one after the other.
+    """
+    calls = {role: 0 for role in ROLES}
+    tokens = {role: 0.0 for role in ROLES}
+    call_seconds, chain_seconds = 0.0, 0.0
+    for depth, count in enumerate(levels):
+        # Nodes of the last turn end their branch without asking the moderator
+        roles = ROLES if depth + 1 < turns else ("user", "assistant")
+        for role in roles:
+            calls[role] += count
+            tokens[role] += count * profile.call_tokens(role, depth)
+            call_seconds += count * profile.call_seconds(role, depth)
+            chain_seconds += profile.call_seconds(role, depth)
+    return {"nodes": sum(levels), "leaves": leaves, "calls": calls, "tokens": tokens, "call_seconds": call_seconds, "chain_seconds": chain_seconds}
+
+def distribution(values: list) -> dict:
+    """
+    Summarise the values of a quantity over the simulated runs.
+
+    Args:
+        values (list): One value per run.
+
+    Returns:
+        dict: "mean" and the PERCENTILES as "p5", "p50", ...
+    """
+    ordered = sorted(values)
+    summary = {"mean": round(sum(ordered) / len(ordered), 2)}
+    for percentile in PERCENTILES:
+        summary[f"p{percentile}"] = round(ordered[min(len(ordered) - 1, int(percentile / 100 * len(ordered)))], 2)
+    return summary
+
+def plan(n_trees: int, turns: int, concurrency: int, rpm: float = None, tpm: float = None, profile: CallProfile = None,
+         model: str = "mistralai/Mixtral-8x7B-Instruct-v0.1", ideas: int = MAX_CHILDREN, runs: int = 100, seed: int = 0) -> dict:
+    """
+    Estimate a run by Monte-Carlo simulation of its tree shapes. Every simulated run draws the trees of the
+    input (at most SIMULATED_TREES, scaled up for larger inputs, which widens the spread), counts their calls
+    and tokens, and bounds its wall time by the busiest of: the call time spread over the concurrent
+    requests, the requests and tokens per minute of the rate limits, and the deepest branch of a tree.
+
+    Args:
+        n_trees (int): Trees of the run.
+        turns (int): Turns of every conversation.
+        concurrency (int): Requests in flight.
+        rpm (float, optional): Requests per minute allowed, None for no limit. Defaults to None.
+        tpm (float, optional): Tokens per minute allowed, None for no limit. Defaults to None.
+        profile (CallProfile, optional): Expected tokens and seconds of the calls. Defaults to the rough defaults.
+        model (str, optional): Model the tokens are priced at. Defaults to "mistralai/Mixtral-8x7B-Instruct-v0.1".
+        ideas (int, optional): Distinct ideas left per moderator call. Defaults to MAX_CHILDREN.
+        runs (int, optional): Simulated runs. Defaults to 100.
+        seed (int, optional): Seed of the simulation. Defaults to 0.
+
+    Returns:
+        dict: The configuration and the distribution of every quantity over the runs.
+    """
+    profile = profile or CallProfile()
+    rng = random.Random(seed)
+    simulated = min(n_trees, SIMULATED_TREES)
+    scale = n_trees / simulated if simulated else 0
+
+    if profile.tree_tokens:
+        # Spread the tokens of a tree over the calls a pilot simulation expects per tree
+        pilot = [tree_usage(*simulate_tree(turns, rng, ideas), turns, CallProfile()) for _ in range(SIMULATED_TREES)]
+        profile.tokens = {
+            role: {0: profile.tree_tokens[role] * len(pilot) / max(1, sum(usage["calls"][role] for usage in pilot))}
+            for role in profile.tree_tokens
+        }
+
+    totals = {}
+    bottlenecks = {}
+    for _ in range(runs):
+        run = {"nodes": 0, "leaves": 0, "call_seconds": 0.0, "chain_seconds": 0.0,
+               "calls": {role: 0 for role in ROLES}, "tokens": {role: 0.0 for role in ROLES}}
+        for _ in range(simulated):
+            usage = tree_usage(*simulate_tree(turns, rng, ideas), turns, profile)
+            run["nodes"] += usage["nodes"]
+            run["leaves"] += usage["leaves"]
+            run["call_seconds"] += usage["call_seconds"]
+            run["chain_seconds"] = max(run["chain_seconds"], usage["chain_seconds"])
+            for role in ROLES:
+                run["calls"][role] += usage["calls"][role]
+                run["tokens"][role] += usage["tokens"][role]
+
+        calls = sum(run["calls"].values()) * scale
+        tokens = sum(run["tokens"].values()) * scale
+        bounds = {
+            "concurrency": run["call_seconds"] * scale / concurrency,
+            "requests per minute": calls / rpm * 60 if rpm else 0.0,
+            "tokens per minute": tokens / tpm * 60 if tpm else 0.0,
+            "deepest branch": run["chain_seconds"],
+        }
+        bottleneck = max(bounds, key=bounds.get)
+        bottlenecks[bottleneck] = bottlenecks.get(bottleneck, 0) + 1
+
+        samples = {
+            "nodes": run["nodes"] * scale,
+            "leaves": run["leaves"] * scale,
+            "calls": calls,
+            "tokens": tokens,
+            "cost ($)": token_cost(model, tokens),
+            "wall hours": bounds[bottleneck] / 3600,
+        }
+        for role in ROLES:
+            samples[f"{role} calls"] = run["calls"][role] * scale
+            samples[f"{role} tokens"] = run["tokens"][role] * scale
+        for name, value in samples.items():
+            totals.setdefault(name, []).append(value)
+
+    return {
+        "config": {"trees": n_trees, "turns": turns, "concurrency": concurrency, "rpm": rpm, "tpm": tpm, "model": model,
+                   "ideas": ideas, "runs": runs, "simulated trees per run": simulated},
+        "estimates": {name: distribution(values) for name, values in totals.items()},
+        "bottleneck": {name: count / runs for name, count in sorted(bottlenecks.items(), key=lambda item: -item[1])},
+    }
+
+def count_inputs(path: str, shard: tuple = None) -> int:
+    """
+    Count the trees an input file generates, streaming it like a run does.
+
+    Args:
+        path (str): Path of the input file.
+        shard (tuple, optional): (i, N) to count only the i-th of N shards. Defaults to None.
+
+    Returns:
+        int: Number of distinct rows of the shard.
+    """
+    return sum(1 for _ in read_inputs(path, shard))
+
+if __name__ == "__main__":
+    # Usage: python planner.py --input inputs.txt --turns 4 --concurrency 16 [--history @-ledger.jsonl] [--rpm 100 --tpm 200000]
+    parser = argparse.ArgumentParser(description="Estimate the calls, tokens, cost and wall time of a run without calling any model.")
+    parser.add_argument("--input", help="CSV input file of the run")
+    parser.add_argument("--trees", type=int, help="number of trees, instead of an input file")
+    parser.add_argument("--shard", type=parse_shard, help="count only the i-th of N shards of the input, as i/N")
+    parser.add_argument("--turns", type=int, default=4, help="turns of every conversation")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight")
+    parser.add_argument("--rpm", type=float, help="requests per minute allowed")
+    parser.add_argument("--tpm", type=float, help="tokens per minute allowed")
+    parser.add_argument("--history", help="@-ledger.jsonl or @-token_counts.json of a previous run to calibrate calls from")
+    parser.add_argument("--model", default="mistralai/Mixtral-8x7B-Instruct-v0.1", help="model the tokens are priced at")
+    parser.add_argument("--ideas", type=int, default=MAX_CHILDREN, help="distinct ideas left per moderator call")
+    parser.add_argument("--runs", type=int, default=100, help="simulated runs")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the simulation")
+    args = parser.parse_args()
+
+    n_trees = args.trees if args.trees is not None else count_inputs(args.input, args.shard)
+    estimate = plan(n_trees, args.turns, args.concurrency, args.rpm, args.tpm, load_profile(args.history), args.model, args.ideas, args.runs, args.seed)
+    print(json.dumps(estimate, indent=4))
@@ -0,0 +1,190 @@
+# Import nessessary packages
+import os
+import re
+import json
+import time
+import fcntl
+import asyncio
+import tempfile
+
+#CONSTANTS
+# Directory holding the shared bucket state, one file per model
+RATE_LIMIT_STATE_DIR = os.path.join(tempfile.gettempdir(), "syn_trees_rate_limits")
+
+def update_locked_json(path: str, initial, change):
+    """
+    Apply a change to a small JSON state file under an exclusive file lock, so every process sharing the file,
+    on one host or on storage several hosts mount, reads and writes it in turn.
+
+    Args:
+        path (str): Path of the state file, created when missing.
+        initial: Function returning the state of a missing or damaged file.
+        change: Function taking the state dict, modifying it in place and returning a result.
+
+    Returns:
+        The result of `change`.
+    """
+    with open(path, "a+") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            file.seek(0)
+            try:
+                state = json.loads(file.read())
+            except ValueError:
+                state = initial()
+            result = change(state)
+            file.seek(0)
+            file.truncate()
+            json.dump(state, file)
+            # Flush while still holding the lock, closing the file would write after the unlock
+            file.flush()
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+    return result
+
+class RateLimiter:
+    """
+    A token-bucket limiter for requests-per-minute and tokens-per-minute shared between worker processes.
+    The state of each model's buckets lives in a small file guarded by an exclusive file lock, so every
+    process using the same state directory draws from the same budget: the processes of a host with the
+    default directory, or the processes of every host when it is on storage they all mount.
+
+    Attributes:
+        limits (dict): Mapping of model name to {"rpm": int, "tpm": int}. Models without an entry are not limited.
+        state_dir (str): Directory holding the bucket state files.
+    """
+    def __init__(self, limits: dict, state_dir: str = RATE_LIMIT_STATE_DIR):
+        """
+        Initialize the RateLimiter instance.
+
+        Args:
+            limits (dict): Mapping of model name to {"rpm": int, "tpm": int}.
+            state_dir (str, optional): Directory holding the bucket state files. Defaults to RATE_LIMIT_STATE_DIR.
+        """
+        self.limits = limits
+        self.state_dir = state_dir
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    def _state_path(self, model: str) -> str:
+        """
+        Get the bucket state file of a model.
+
+        Args:
+            model (str): The name of the language model.
+
+        Returns:
+            str: Path of the state file.
+        """
+        return os.path.join(self.state_dir, re.sub(r'[^A-Za-z0-9_.-]', '_', model) + ".json")
+
+    def _update(self, model: str, tokens: int, take: bool) -> float:
+        """
+        Refill the buckets of a model under the file lock and take from them when possible.
+
+        Args:
+            model (str): The name of the language model.
+            tokens (int): Tokens to take from the token bucket, may be negative to give tokens back.
+            take (bool): Whether a request is being taken. When False, only the token bucket is adjusted.
+
+        Returns:
+            float: Seconds to wait before the request fits, 0 when it was taken.
+        """
+        limit = self.limits[model]
+        rpm, tpm = limit.get("rpm"), limit.get("tpm")
+
+        def change(state):
+            # Refill both buckets for the elapsed time, capped at one minute of capacity
+            now = time.time()
+            elapsed = max(0.0, now - state["updated"])
+            if rpm:
+                state["requests"] = min(rpm, state["requests"] + elapsed * rpm / 60)
+            if tpm:
+                state["tokens"] = min(tpm, state["tokens"] + elapsed * tpm / 60)
+            state["updated"] = now
+
+            wait = 0.0
+            if take:
+                # A single request larger than the whole bucket waits for a full bucket instead of forever
+                need = min(tokens, tpm) if tpm else 0
+                if rpm and state["requests"] < 1:
+                    wait = max(wait, (1 - state["requests"]) * 60 / rpm)
+                if tpm and state["tokens"] < need:
+                    wait = max(wait, (need - state["tokens"]) * 60 / tpm)
+                if wait == 0.0:
+                    if rpm:
+                        state["requests"] -= 1
+                    if tpm:
+                        state["tokens"] -= need
+            elif tpm:
+                state["tokens"] = min(tpm, state["tokens"] - tokens)
+            return wait
+
+        # A missing or damaged state file starts from full buckets
+        return update_locked_json(self._state_path(model), lambda: {"requests": rpm, "tokens": tpm, "updated": time.time()}, change)
+
+    def acquire(self, model: str, tokens: int) -> float:
+        """
+        Block until a request of the estimated size fits within the model's limits.
+
+        Args:
+            model (str): The name of the language model.
+            tokens (int): Estimated tokens of the request (prompt and completion).
+
+        Returns:
+            float: Total seconds spent waiting.
+        """
+        if model not in self.limits:
+            return 0.0
+        waited = 0.0
+        while True:
+            wait = self._update(model, tokens, take=True)
+            if wait == 0.0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    async def aacquire(self, model: str, tokens: int) -> float:
+        """
+        Asynchronously wait until a request of the estimated size fits within the model's limits.
+
+        Args:
+            model (str): The name of the language model.
+            tokens (int): Estimated tokens of the request (prompt and completion).
+
+        Returns:
+            float: Total seconds spent waiting.
+        """
+        if model not in self.limits:
+            return 0.0
+        waited = 0.0
+        while True:
+            wait = self._update(model, tokens, take=True)
+            if wait == 0.0:
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def reconcile(self, model: str, estimated: int, actual: int):
+        """
+        Correct the token bucket once the real usage of a request is known.
+
+        Args:
+            model (str): The name of the language model.
+            estimated (int): Tokens taken when the request was acquired.
+            actual (int): Tokens reported by the provider.
+        """
+        if model not in self.limits or not self.limits[model].get("tpm") or not actual:
+            return
+        self._update(model, actual - estimated, take=False)
+
+def estimate_tokens(text: str) -> int:
+    """
+    Roughly estimate the token count of a text without a tokenizer.
+
+    Args:
+        text (str): The text to estimate.
+
+    Returns:
+        int: Estimated number of tokens.
+    """
+    return len(text) // 4 + 1
@@ -0,0 +1,124 @@
+# Import nessessary packages
+import re
+import json
+import random
+
+#CONSTANTS
+# HTTP statuses worth retrying on the same endpoint after a pause
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+# HTTP statuses caused by the endpoint itself (bad key, unknown deployment), worth trying elsewhere
+FAILOVER_STATUSES = {401, 403, 404}
+
+def error_status(error: Exception):
+    """
+    Find the HTTP status of a provider error, from the client's exception or its message.
+
+    Args:
+        error (Exception): The error raised by a call.
+
+    Returns:
+        int: The HTTP status, or None when the error carries none.
+    """
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status is None:
+        # Some clients only mention the status in their message, e.g. "Error raised by inference API HTTP code: 503"
+        match = re.search(r'\b(?:status|code)\D{0,10}([45]\d\d)\b', str(error), re.IGNORECASE)
+        status = int(match.group(1)) if match else None
+    return status
+
+def classify_error(error: Exception) -> str:
+    """
+    Decide how a failed call should be handled.
+
+    Args:
+        error (Exception): The error raised by a call.
+
+    Returns:
+        str: "retry" for transient errors (rate limits, server errors, timeouts), "failover" for errors of the
+            endpoint itself, "fatal" for errors another attempt cannot fix (bad request, programming errors).
+    """
+    status = error_status(error)
+    if status in RETRY_STATUSES or (status is not None and status >= 500):
+        return "retry"
+    if status in FAILOVER_STATUSES:
+        return "failover"
+    if status is None and any(word in type(error).__name__ for word in ("Timeout", "Connection", "RateLimit", "ServerError")):
+        return "retry"
+    return "fatal"
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter for transient provider errors: attempt n waits a random time
+    between 0 and min(max_delay, base_delay * 2**n), so workers that failed together do not retry together.
+
+    Attributes:
+        max_attempts (int): Attempts of a call before giving up, including the first.
+        base_delay (float): Backoff of the first retry in seconds.
+        max_delay (float): Cap of the backoff in seconds.
+    """
+    def __init__(self, max_attempts: int = 5, base_delay: float = 1.0, max_delay: float = 30.0):
+        """
+        Initialize the RetryPolicy instance.
+
+        Args:
+            max_attempts (int, optional): Attempts of a call before giving up, including the first. Defaults to 5.
+            base_delay (float, optional): Backoff of the first retry in seconds. Defaults to 1.
+            max_delay (float, optional): Cap of the backoff in seconds. Defaults to 30.
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        """
+        Draw the pause before retrying.
+
+        Args:
+            attempt (int): Number of the failed attempt, starting at 0.
+
+        Returns:
+            float: Seconds to wait.
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+def repair_json(text: str, pydantic_object):
+    """
+    Repair a malformed structured output locally, without calling the model again.
+    Tries the outermost JSON object in the text (dropping code fences, surrounding prose and trailing commas),
+    then, for single-field schemas, builds the object from raw text without any "{" or "[": the whole text for a
+    string field, one item per line (without bullets or numbering) for a list field of several lines or bullets.
+    Text that tried to be JSON but does not parse (unescaped quotes, truncated output) is left to a repair call.
+
+    Args:
+        text (str): The raw model output.
+        pydantic_object: The Pydantic class the output should match.
+
+    Returns:
+        The parsed object, or None when the text cannot be repaired.
+    """
+    start, end = text.find('{'), text.rfind('}')
+    if start != -1 and end > start:
+        candidate = re.sub(r',\s*([}\]])', r'\1', text[start:end + 1])
+        try:
+            return pydantic_object.parse_obj(json.loads(candidate))
+        except ValueError:
+            pass
+
+    fields = list(pydantic_object.__fields__.values())
+    if len(fields) != 1:
+        return None
+    field = fields[0]
+    stripped = re.sub(r'^```\w*|```$', '', text.strip()).strip()
+    if not stripped or '{' in stripped or '[' in stripped:
+        return None
+    try:
+        if field.outer_type_ is str:
+            return pydantic_object.parse_obj({field.name: stripped.strip('"')})
+        lines = [line for line in stripped.splitlines() if line.strip()]
+        # A single sentence without a bullet is a reply about the list, not a list
+        if len(lines) == 1 and not re.match(r'^\s*(?:[-*•]|\d+[.)])\s', lines[0]):
+            return None
+        lines = [re.sub(r'^\s*(?:[-*•]|\d+[.)])\s*', '', line).strip().strip('"') for line in lines]
+        return pydantic_object.parse_obj({field.name: [line for line in lines if line]})
+    except ValueError:
+        return None
@@ -0,0 +1,225 @@
+# Import nessessary packages
+import os
+import heapq
+import queue
+import random
+import traceback
+import multiprocessing
+
+def _worker(expand, tasks, results):
+    """
+    Worker process loop: expand node tasks from the shared queue until a None sentinel arrives.
+
+    Args:
+        expand: Function expanding one task dict into a result dict.
+        tasks: Shared queue of tasks.
+        results: Shared queue of results.
+    """
+    # Forked workers inherit the coordinator's random state, reseed so their retries do not back off alike
+    random.seed()
+    coordinator = os.getppid()
+    while True:
+        try:
+            task = tasks.get(timeout=5)
+        except queue.Empty:
+            # Exit instead of lingering when the coordinator was killed
+            if os.getppid() != coordinator:
+                break
+            continue
+        if task is None:
+            break
+        try:
+            result = expand(task)
+        except Exception:
+            # A failing node ends its branch instead of taking the worker down
+            traceback.print_exc()
+            result = {"doc_id": task["doc_id"], "children": []}
+        results.put(result)
+
+class Frontier:
+    """
+    The pending node expansions of every open tree of a run, in one priority queue.
+    Without a priority key, the last pushed task comes first and a new tree is only opened when no task
+    is pending, so trees are generated depth-first one after the other. With a key, e.g. the depth of the
+    node for breadth-first generation, tasks of all open trees compete, and new trees are opened as long
+    as fewer than `max_open_trees` are in progress, which bounds the partial trees held in memory.
+
+    Tasks are dicts with a "doc_id" key. Every task popped must be completed with its children.
+
+    Attributes:
+        key: Function of (task, tree order) returning a sortable tuple, lowest first, or None for depth-first.
+        max_open_trees (int): Trees in progress at once, None for no limit.
+        in_flight (int): Tasks popped and not completed yet.
+    """
+    def __init__(self, trees, key=None, max_open_trees: int = None):
+        """
+        Initialize the Frontier instance.
+
+        Args:
+            trees: Iterable of task lists, one list per tree (its root, or its pending branches when resuming).
+                It is consumed lazily as trees are opened.
+            key (optional): Function of (task, tree order) returning a sortable tuple. Defaults to None.
+            max_open_trees (int, optional): Trees in progress at once. Defaults to None.
+        """
+        self.trees = iter(trees)
+        self.key = key
+        self.max_open_trees = max_open_trees
+        self.in_flight = 0
+        self._heap = []
+        self._open = {}         # doc_id -> [order the tree was opened in, tasks pending or in flight]
+        self._opened = 0
+        self._pushed = 0
+        self._exhausted = False
+
+    def _push(self, task: dict):
+        """
+        Add a task to the priority queue, ties are broken by push order.
+
+        Args:
+            task (dict): The node to expand.
+        """
+        self._pushed += 1
+        if self.key is None:
+            priority = (-self._pushed,)
+        else:
+            priority = tuple(self.key(task, self._open[task["doc_id"]][0])) + (self._pushed,)
+        heapq.heappush(self._heap, (priority, self._pushed, task))
+
+    def _open_tree(self) -> bool:
+        """
+        Open the next tree of the input.
+
+        Returns:
+            bool: False when every tree has been opened.
+        """
+        while not self._exhausted:
+            group = next(self.trees, None)
+            if group is None:
+                self._exhausted = True
+                return False
+            group = list(group)
+            if not group:
+                continue
+            doc_id = group[0]["doc_id"]
+            self._opened += 1
+            self._open[doc_id] = [self._opened, len(group)]
+            # Depth-first pops the last pushed task, so push in reverse to expand tasks in their given order
+            for task in (reversed(group) if self.key is None else group):
+                self._push(task)
+            return True
+        return False
+
+    def pop(self) -> dict:
+        """
+        Take the task with the highest priority, opening new trees first when allowed.
+
+        Returns:
+            dict: The task, or None when no task is pending.
+        """
+        while (not self._heap or self.key is not None) and (self.max_open_trees is None or len(self._open) < self.max_open_trees):
+            if not self._open_tree():
+                break
+        if not self._heap:
+            return None
+        self.in_flight += 1
+        return heapq.heappop(self._heap)[2]
+
+    def complete(self, doc_id, children: list) -> bool:
+        """
+        Record the expansion of a popped task and queue its children.
+
+        Args:
+            doc_id: Identifier of the tree of the task.
+            children (list): Tasks of the children of the node.
+
+        Returns:
+            bool: True when this was the last pending node of its tree.
+        """
+        self.in_flight -= 1
+        tree = self._open[doc_id]
+        tree[1] += len(children) - 1
+        for task in (reversed(children) if self.key is None else children):
+            self._push(task)
+        if tree[1] == 0:
+            del self._open[doc_id]
+            return True
+        return False
+
+class NodeScheduler:
+    """
+    Schedules single node expansions, rather than whole trees, over a pool of worker processes.
+    Any idle worker pulls the next node from one shared queue, so a large tree is spread over all
+    workers instead of keeping one of them busy long after the others are done.
+
+    Tasks and results are dicts with a "doc_id" key, results also list the "children" tasks to expand.
+    The coordinator keeps the ready nodes in a Frontier. By default it hands out children before new trees,
+    so trees finish early, and a priority key can order the nodes of all open trees instead. Only a bounded
+    number of nodes are queued to the workers at any time.
+
+    Attributes:
+        expand: Function run in the workers, expanding one task into a result.
+        on_result: Function run in the coordinator for every result.
+        on_tree_done: Function run in the coordinator once every node of a tree is expanded.
+        n_workers (int): Number of worker processes.
+        prefetch (int): Tasks queued per worker.
+        key: Priority key of the frontier, None for depth-first.
+        max_open_trees (int): Trees in progress at once, None for no limit.
+    """
+    def __init__(self, expand, on_result, on_tree_done, n_workers: int, prefetch: int = 2, key=None, max_open_trees: int = None):
+        """
+        Initialize the NodeScheduler instance.
+
+        Args:
+            expand: Function run in the workers, expanding one task into a result.
+            on_result: Function run in the coordinator for every result.
+            on_tree_done: Function run in the coordinator with the doc_id of every finished tree.
+            n_workers (int): Number of worker processes.
+            prefetch (int, optional): Tasks queued per worker. Defaults to 2.
+            key (optional): Priority key of the frontier, see Frontier. Defaults to None.
+            max_open_trees (int, optional): Trees in progress at once. Defaults to None.
+        """
+        self.expand = expand
+        self.on_result = on_result
+        self.on_tree_done = on_tree_done
+        self.n_workers = n_workers
+        self.prefetch = prefetch
+        self.key = key
+        self.max_open_trees = max_open_trees
+
+    def run(self, trees):
+        """
+        Expand every node of the given trees.
+
+        Args:
+            trees: Iterable of task lists, one list per tree (its root, or its pending branches when resuming).
+                It is consumed lazily as workers free up.
+        """
+        # Workers inherit the coordinator's state through fork
+        context = multiprocessing.get_context("fork")
+        tasks, results = context.Queue(), context.Queue()
+        workers = [context.Process(target=_worker, args=(self.expand, tasks, results), daemon=True) for _ in range(self.n_workers)]
+        for worker in workers:
+            worker.start()
+
+        frontier = Frontier(trees, self.key, self.max_open_trees)
+
+        def fill():
+            while frontier.in_flight < self.n_workers * self.prefetch:
+                task = frontier.pop()
+                if task is None:
+                    return
+                tasks.put(task)
+
+        try:
+            fill()
+            while frontier.in_flight:
+                result = results.get()
+                self.on_result(result)
+                if frontier.complete(result["doc_id"], result["children"]):
+                    self.on_tree_done(result["doc_id"])
+                fill()
+        finally:
+            for _ in workers:
+                tasks.put(None)
+            for worker in workers:
+                worker.join()
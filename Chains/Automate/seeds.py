@@ -0,0 +1,31 @@
+# Import nessessary packages
+import hashlib
+
+def tree_seed(doc_id, run_seed: int = 0) -> int:
+    """
+    Derive the seed of a tree from its doc_id and the seed of the run, so a tree gets the same seed
+    on every machine and in every rerun, whatever the worker or the order it is generated in.
+
+    Args:
+        doc_id: Identifier for the conversation tree.
+        run_seed (int, optional): Seed of the run. Defaults to 0.
+
+    Returns:
+        int: Seed of the tree.
+    """
+    return int.from_bytes(hashlib.blake2b(f"{run_seed}:{doc_id}".encode("utf-8"), digest_size=8).digest(), "big")
+
+def node_seed(seed: int, name: str) -> int:
+    """
+    Derive the seed of a node from the seed of its tree and its branch name. Every node draws from its
+    own stream, so concurrent branches never change each other's draws and any subtree can be regenerated
+    on its own. Seeds fit in 31 bits, the range provider APIs accept.
+
+    Args:
+        seed (int): Seed of the tree.
+        name (str): Branch name of the node, e.g. "C-1-2-".
+
+    Returns:
+        int: Seed of the node.
+    """
+    return int.from_bytes(hashlib.blake2b(f"{seed}:{name}".encode("utf-8"), digest_size=4).digest(), "big") & 0x7fffffff
@@ -0,0 +1,221 @@
+# Import nessessary packages
+import os
+import sys
+import json
+import time
+
+from tree import TreeNode
+
+#CONSTANTS
+# Columns of the node table of a stored tree
+NODE_COLUMNS = ["node id", "parent id", "intent", "user", "assistant", "moderator"]
+
+def conversation_record(doc_id: str, domain: str, model_list: dict, conv_turns: list, mod_out: list, timestamp: str = None) -> list:
+    """
+    Build the JSON record of a single conversation path, as written for every leaf.
+
+    Args:
+        doc_id (str): Identifier for the conversation tree.
+        domain (str): The domain or topic of the conversation.
+        model_list (dict): Names of the models used for each role.
+        conv_turns (list): List of tuples representing conversation turns.
+        mod_out (list): List containing moderator outputs.
+        timestamp (str, optional): Time of the conversation. Defaults to the current time.
+
+    Returns:
+        list: The conversation as a list of single-key dicts.
+    """
+    conversation = []
+    # Add Conversation metadata
+    conversation.append({"id": doc_id})
+    conversation.append({"intent": conv_turns[0][0]})
+    conversation.append({"domain": domain})
+    conversation.append({"model list": model_list})
+    conversation.append({"timestamp": timestamp or time.strftime("%d-%m-%Y %H:%M:%S", time.localtime(time.time()))})
+    # Add Conversation interactions
+    interactions = []
+    for intent, prompt, response in conv_turns:
+        turn = {
+            "intent": intent,
+            "user": prompt,
+            "assistant": response
+        }
+        interactions.append(turn)
+    conversation.append({"interactions": interactions})
+    # Add Moderator outputs
+    conversation.append({"moderator": mod_out})
+    return conversation
+
+def parent_id(node_id: str):
+    """
+    Get the parent of a node from its branch name, e.g. "C-1-2-" is the child of "C-1-".
+
+    Args:
+        node_id (str): Branch name of the node.
+
+    Returns:
+        str: Branch name of the parent, None for the root.
+    """
+    parts = node_id.split('-')[:-1]
+    return '-'.join(parts[:-1]) + '-' if len(parts) > 1 else None
+
+class TreeRecorder:
+    """
+    Collects the leaves of one conversation tree and stores every node once.
+    A leaf path named "C-1-2-" holds the turns of nodes "C-", "C-1-" and "C-1-2-", so nodes shared by
+    several leaves are only kept the first time they are seen.
+
+    Attributes:
+        doc_id (str): Identifier for the conversation tree.
+        domain (str): The domain or topic of the conversation.
+        model_list (dict): Names of the models used for each role.
+        nodes (dict): Node rows keyed by node id, in insertion order.
+        leaves (list): Branch names of the saved leaves.
+    """
+    def __init__(self, doc_id: str, domain: str, model_list: dict):
+        """
+        Initialize the TreeRecorder instance.
+
+        Args:
+            doc_id (str): Identifier for the conversation tree.
+            domain (str): The domain or topic of the conversation.
+            model_list (dict): Names of the models used for each role.
+        """
+        self.doc_id = doc_id
+        self.domain = domain
+        self.model_list = model_list
+        self.nodes = {}
+        self.leaves = []
+
+    def add_leaf(self, conv_turns: list, mod_out: list, name: str):
+        """
+        Add a leaf path to the tree.
+
+        Args:
+            conv_turns (list): List of tuples representing conversation turns.
+            mod_out (list): List containing moderator outputs.
+            name (str): Name produced for the conversation tree branch.
+        """
+        # Moderator outputs are keyed by the turn they were suggested after
+        suggestions = {}
+        for entry in mod_out:
+            suggestions.update(entry)
+
+        segments = name.split('-')[:-1]
+        for depth, (intent, prompt, response) in enumerate(conv_turns):
+            node_id = '-'.join(segments[:depth + 1]) + '-'
+            if node_id not in self.nodes:
+                self.nodes[node_id] = [node_id, parent_id(node_id), intent, prompt, response, suggestions.get(f"Turn{depth}")]
+            elif self.nodes[node_id][5] is None and f"Turn{depth}" in suggestions:
+                self.nodes[node_id][5] = suggestions[f"Turn{depth}"]
+        self.leaves.append(name)
+
+    def to_dict(self) -> dict:
+        """
+        Get the tree as a node table.
+
+        Returns:
+            dict: Tree metadata, the node table and the leaf branch names.
+        """
+        return {
+            "id": self.doc_id,
+            "domain": self.domain,
+            "model list": self.model_list,
+            "timestamp": time.strftime("%d-%m-%Y %H:%M:%S", time.localtime(time.time())),
+            "columns": NODE_COLUMNS,
+            "nodes": list(self.nodes.values()),
+            "leaves": self.leaves,
+        }
+
+    def save(self, filename: str):
+        """
+        Write the tree to a single compact JSON file.
+
+        Args:
+            filename (str): Path of the tree file.
+        """
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        with open(filename, "w") as file:
+            json.dump(self.to_dict(), file, separators=(',', ':'))
+
+def node_from_table(nodes: dict, node_id: str):
+    """
+    Rebuild the chain of tree nodes leading to a node from a node table.
+    Paths cut short by errors end above their branch name, so the chain ends at the deepest
+    stored node with a turn.
+
+    Args:
+        nodes (dict): Node rows (in NODE_COLUMNS order) keyed by node id.
+        node_id (str): Branch name of the node.
+
+    Returns:
+        TreeNode: The last node of the path, None when no node of the path has a turn.
+    """
+    while node_id is not None and (node_id not in nodes or nodes[node_id][3] is None):
+        node_id = parent_id(node_id)
+
+    # Walk up the parent pointers to collect the path of the node
+    path = []
+    while node_id is not None:
+        path.append(nodes[node_id])
+        node_id = nodes[node_id][1]
+
+    node = None
+    for name, _, intent, prompt, response, ideas in reversed(path):
+        node = TreeNode(node, name, intent, prompt, response, ideas)
+    return node
+
+def node_path(nodes: dict, node_id: str) -> tuple:
+    """
+    Rebuild the conversation turns and moderator outputs leading to a node from a node table.
+
+    Args:
+        nodes (dict): Node rows (in NODE_COLUMNS order) keyed by node id.
+        node_id (str): Branch name of the node.
+
+    Returns:
+        conv_turns (list): List of tuples representing conversation turns.
+        mod_out (list): List containing moderator outputs.
+    """
+    node = node_from_table(nodes, node_id)
+    if node is None:
+        return [], []
+    return node.turns(), node.mod_out()
+
+def load_tree(filename: str) -> dict:
+    """
+    Load a tree written by TreeRecorder.
+
+    Args:
+        filename (str): Path of the tree file.
+
+    Returns:
+        dict: The stored tree.
+    """
+    with open(filename, "r") as file:
+        return json.load(file)
+
+def rebuild_conversations(tree: dict):
+    """
+    Rebuild the leaf conversations of a stored tree in the per-leaf format.
+
+    Args:
+        tree (dict): The stored tree.
+
+    Yields:
+        tuple: (leaf name, conversation record) for every leaf.
+    """
+    nodes = {row[0]: row for row in tree["nodes"]}
+    for leaf in tree["leaves"]:
+        conv_turns, mod_out = node_path(nodes, leaf)
+        yield leaf, conversation_record(tree["id"], tree["domain"], tree["model list"], conv_turns, mod_out, tree["timestamp"])
+
+if __name__ == "__main__":
+    # Usage: python storage.py <tree.json> <output_dir>
+    # Expands a stored tree into the per-leaf {doc_id}/{name}.json files
+    tree = load_tree(sys.argv[1])
+    for leaf, conversation in rebuild_conversations(tree):
+        filename = os.path.join(sys.argv[2], str(tree["id"]), f"{leaf[0:-1]}.json")
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w") as file:
+            json.dump(conversation, file, indent=4)
@@ -0,0 +1,212 @@
+# Import nessessary packages
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+
+from ledger import Ledger, get_call_context, read_jsonl
+
+#CONSTANTS
+# Upper bounds of the latency histogram buckets in seconds
+SECONDS_BUCKETS = [0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Tracer of the current process, set by `open_tracer`
+_TRACER = None
+
+def _thread_id() -> int:
+    """
+    Get the lane a span is drawn on in the trace viewer: the asyncio task when running in one, otherwise the thread.
+    Spans on one lane must nest, which concurrent tasks of one thread do not.
+
+    Returns:
+        int: Identifier of the current task or thread.
+    """
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return id(task) % 1000000 if task is not None else threading.get_ident() % 1000000
+
+class Tracer:
+    """
+    Records spans of the hot path (role calls, parsing, writes) to an append-only JSONL file safe to share
+    between processes. Each line is a complete event ("ph": "X") of the Trace Event Format, with the tree id,
+    node and node depth of the current call context in its args, so `trace_file` turns the file into a
+    trace for chrome://tracing or Perfetto and `metrics` aggregates it into Prometheus metrics.
+
+    Attributes:
+        path (str): Path of the span file.
+    """
+    def __init__(self, path: str):
+        """
+        Initialize the Tracer instance.
+
+        Args:
+            path (str): Path of the span file.
+        """
+        self.path = path
+        self.ledger = Ledger(path)
+
+    def record(self, name: str, category: str, start: float, duration: float, fields: dict):
+        """
+        Record one finished span.
+
+        Args:
+            name (str): Name of the span, e.g. the role or "save".
+            category (str): Category of the span, e.g. "llm", "parse" or "io".
+            start (float): Start time in seconds since the epoch.
+            duration (float): Wall time in seconds.
+            fields (dict): Measurements of the span, e.g. tokens, retries and queue wait.
+        """
+        context = get_call_context()
+        args = {"tree": context.get("doc_id"), "node": context.get("node"), **fields}
+        if args["node"]:
+            args["depth"] = args["node"].count('-') - 1
+        self.ledger.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round(start * 1e6),
+            "dur": round(duration * 1e6),
+            "pid": os.getpid(),
+            "tid": _thread_id(),
+            "args": args,
+        })
+
+def open_tracer(path: str) -> Tracer:
+    """
+    Open the tracer of the current process, reusing it when already open on the same path.
+
+    Args:
+        path (str): Path of the span file.
+
+    Returns:
+        Tracer: The tracer that `span` records to.
+    """
+    global _TRACER
+    if _TRACER is None or _TRACER.path != path:
+        _TRACER = Tracer(path)
+    return _TRACER
+
+@contextmanager
+def span(name: str, category: str, **fields):
+    """
+    Time a block and record it as a span in the tracer of the current process, if one is open.
+    The block can add measurements to the yielded dict, and an exception is recorded in its "error" field.
+
+    Args:
+        name (str): Name of the span.
+        category (str): Category of the span.
+        **fields: Initial measurements of the span.
+
+    Yields:
+        dict: The measurements of the span.
+    """
+    start = time.time()
+    try:
+        yield fields
+    except Exception as e:
+        fields["error"] = type(e).__name__
+        raise
+    finally:
+        if _TRACER is not None:
+            _TRACER.record(name, category, start, time.time() - start, fields)
+
+def read_spans(path: str):
+    """
+    Read the spans of a span file.
+
+    Args:
+        path (str): Path of the span file.
+
+    Yields:
+        dict: One span event.
+    """
+    return read_jsonl(path)
+
+def trace_file(path: str, out_path: str):
+    """
+    Convert a span file into a Trace Event Format file for chrome://tracing or Perfetto.
+
+    Args:
+        path (str): Path of the span file.
+        out_path (str): Path of the trace file to write.
+    """
+    with open(out_path, "w") as file:
+        json.dump({"traceEvents": list(read_spans(path)), "displayTimeUnit": "ms"}, file)
+
+def metrics(path: str) -> str:
+    """
+    Aggregate a span file into metrics in the Prometheus text format.
+
+    Args:
+        path (str): Path of the span file.
+
+    Returns:
+        str: The metrics, ready to be written to a .prom file for the node exporter's textfile collector.
+    """
+    seconds = {}        # (category, name) -> [bucket counts, sum, count]
+    counters = {
+        "syn_trees_queue_wait_seconds_total": ("Seconds calls waited on the rate limiter.", {}),
+        "syn_trees_prompt_tokens_total": ("Prompt tokens of completed calls.", {}),
+        "syn_trees_completion_tokens_total": ("Completion tokens of completed calls.", {}),
+        "syn_trees_cached_prompt_tokens_total": ("Prompt tokens served from the provider's prefix cache.", {}),
+        "syn_trees_retries_total": ("Endpoint attempts that failed before a call completed.", {}),
+        "syn_trees_cache_hits_total": ("Calls served from the response cache.", {}),
+        "syn_trees_errors_total": ("Spans that ended with an exception.", {}),
+        "syn_trees_bytes_written_total": ("Bytes of output written.", {}),
+    }
+
+    def add(metric, labels, value):
+        if value:
+            values = counters[metric][1]
+            values[labels] = values.get(labels, 0) + value
+
+    for event in read_spans(path):
+        args = event.get("args", {})
+        labels = (("category", event["cat"]), ("name", event["name"]))
+        histogram = seconds.setdefault(labels, [[0] * len(SECONDS_BUCKETS), 0.0, 0])
+        duration = event["dur"] / 1e6
+        for index, bound in enumerate(SECONDS_BUCKETS):
+            if duration <= bound:
+                histogram[0][index] += 1
+        histogram[1] += duration
+        histogram[2] += 1
+
+        add("syn_trees_queue_wait_seconds_total", labels, args.get("queue_wait"))
+        add("syn_trees_prompt_tokens_total", labels, args.get("prompt_tokens"))
+        add("syn_trees_completion_tokens_total", labels, args.get("completion_tokens"))
+        add("syn_trees_cached_prompt_tokens_total", labels, args.get("cached_tokens"))
+        add("syn_trees_retries_total", labels, args.get("retries"))
+        add("syn_trees_cache_hits_total", labels, 1 if args.get("cached") is True else 0)
+        add("syn_trees_errors_total", labels + (("error", args["error"]),) if "error" in args else labels, 1 if "error" in args else 0)
+        add("syn_trees_bytes_written_total", labels, args.get("bytes"))
+
+    def render(labels, extra=()):
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels + tuple(extra)) + "}"
+
+    lines = ["# HELP syn_trees_span_seconds Wall time of the spans.", "# TYPE syn_trees_span_seconds histogram"]
+    for labels, (buckets, total, count) in seconds.items():
+        for bound, bucket in zip(SECONDS_BUCKETS, buckets):
+            lines.append(f"syn_trees_span_seconds_bucket{render(labels, [('le', bound)])} {bucket}")
+        lines.append(f"syn_trees_span_seconds_bucket{render(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"syn_trees_span_seconds_sum{render(labels)} {total}")
+        lines.append(f"syn_trees_span_seconds_count{render(labels)} {count}")
+    for metric, (description, values) in counters.items():
+        lines.extend([f"# HELP {metric} {description}", f"# TYPE {metric} counter"])
+        lines.extend(f"{metric}{render(labels)} {value}" for labels, value in values.items())
+    return "\n".join(lines) + "\n"
+
+if __name__ == "__main__":
+    # Usage: python telemetry.py trace <@-spans.jsonl> <trace.json>
+    #        python telemetry.py metrics <@-spans.jsonl> [metrics.prom]
+    if sys.argv[1] == "trace":
+        trace_file(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) > 3:
+        with open(sys.argv[3], "w") as file:
+            file.write(metrics(sys.argv[2]))
+    else:
+        print(metrics(sys.argv[2]), end="")
@@ -0,0 +1,101 @@
+class TreeNode:
+    """
+    One generated turn of a conversation tree, linked to the turn before it.
+    Branches in flight only hold their last node: the turns above it are shared with every sibling
+    through the parent pointers instead of being copied into each branch, and the path of a branch is
+    only materialised when a prompt needs it or its leaf is saved. Slots keep each node to its fields.
+
+    Attributes:
+        parent (TreeNode): The previous turn of the conversation, None for the root.
+        name (str): Branch name of the node, e.g. "C-1-2-".
+        intent (str): The intent of the turn.
+        prompt (str): The user prompt of the turn.
+        response (str): The assistant response of the turn.
+        ideas (list): The moderator ideas the node branched on, None when it has no children.
+        depth (int): Number of turns above the node.
+        memo (dict): Renderings of the turn for the prompts, see `models._turn_memo`, None until first rendered.
+    """
+    __slots__ = ("parent", "name", "intent", "prompt", "response", "ideas", "depth", "memo")
+
+    def __init__(self, parent, name: str, intent: str, prompt: str, response: str, ideas: list = None):
+        """
+        Initialize the TreeNode instance.
+
+        Args:
+            parent (TreeNode): The previous turn of the conversation, None for the root.
+            name (str): Branch name of the node.
+            intent (str): The intent of the turn.
+            prompt (str): The user prompt of the turn.
+            response (str): The assistant response of the turn.
+            ideas (list, optional): The moderator ideas the node branched on. Defaults to None.
+        """
+        self.parent = parent
+        self.name = name
+        self.intent = intent
+        self.prompt = prompt
+        self.response = response
+        self.ideas = ideas
+        self.depth = parent.depth + 1 if parent is not None else 0
+        self.memo = None
+
+    def __getstate__(self) -> dict:
+        """
+        Get the fields pickled when the node is sent to a worker process, without the memo, which is rebuilt where it is used.
+
+        Returns:
+            dict: The fields of the node by name.
+        """
+        return {slot: getattr(self, slot) for slot in self.__slots__ if slot != "memo"}
+
+    def __setstate__(self, state: dict):
+        """
+        Restore a node sent to a worker process.
+
+        Args:
+            state (dict): The fields of the node by name.
+        """
+        for slot, value in state.items():
+            setattr(self, slot, value)
+        self.memo = None
+
+    def turn(self) -> tuple:
+        """
+        Get the turn of the node.
+
+        Returns:
+            tuple: (intent, user prompt, assistant response).
+        """
+        return (self.intent, self.prompt, self.response)
+
+    def path(self) -> list:
+        """
+        Materialise the nodes from the root down to this node.
+
+        Returns:
+            list: The nodes of the path, root first.
+        """
+        path = []
+        node = self
+        while node is not None:
+            path.append(node)
+            node = node.parent
+        path.reverse()
+        return path
+
+    def turns(self) -> list:
+        """
+        Materialise the conversation turns leading to and including this node.
+
+        Returns:
+            list: Tuples of (intent, user prompt, assistant response), root first.
+        """
+        return [node.turn() for node in self.path()]
+
+    def mod_out(self) -> list:
+        """
+        Materialise the moderator outputs of the path, keyed by the turn they were suggested after.
+
+        Returns:
+            list: {"Turn{depth}": ideas} of every node of the path that branched.
+        """
+        return [{f"Turn{node.depth}": node.ideas} for node in self.path() if node.ideas is not None]
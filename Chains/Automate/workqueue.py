@@ -0,0 +1,217 @@
+# Import nessessary packages
+import os
+import time
+import socket
+import sqlite3
+
+from database import ProcessConnection
+
+#CONSTANTS
+# Rows inserted per transaction when loading the input into the queue
+ENQUEUE_BATCH = 1000
+
+def worker_name() -> str:
+    """
+    Get the name a worker process holds its leases under.
+
+    Returns:
+        str: "host:pid".
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class WorkQueue:
+    """
+    A queue of trees to generate shared by any number of worker processes on any number of hosts,
+    stored in a SQLite database on storage they all mount, so it needs no outside service.
+    A worker leases a tree for `lease_seconds` and renews the leases it holds with heartbeats while it
+    generates them. The tree of a worker that stops heartbeating (killed, host lost) is leased again by
+    another worker once its lease expires, which resumes it from the checkpoint. A tree that fails
+    `max_attempts` times is left failed instead of being retried forever.
+
+    The database uses the rollback journal rather than WAL, whose shared memory index does not work
+    across hosts on network filesystems.
+
+    Attributes:
+        path (str): Path of the SQLite database.
+        lease_seconds (float): Time a tree stays leased without a heartbeat.
+        max_attempts (int): Leases of a tree before it is left failed.
+    """
+    def __init__(self, path: str, lease_seconds: float = 600.0, max_attempts: int = 3):
+        """
+        Initialize the WorkQueue instance.
+
+        Args:
+            path (str): Path of the SQLite database.
+            lease_seconds (float, optional): Time a tree stays leased without a heartbeat. Defaults to 600.
+            max_attempts (int, optional): Leases of a tree before it is left failed. Defaults to 3.
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._connection = ProcessConnection(path, self._setup, timeout=60, isolation_level=None)
+
+    @staticmethod
+    def _setup(connection: sqlite3.Connection):
+        """
+        Set up a new connection to the queue.
+
+        Args:
+            connection (sqlite3.Connection): The new connection.
+        """
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS tasks (doc_id TEXT PRIMARY KEY, intent TEXT, domain TEXT, state TEXT DEFAULT 'queued', "
+            "owner TEXT, lease_until REAL, attempts INTEGER DEFAULT 0, error TEXT)"
+        )
+        # Expired leases are found on (state, lease_until), queued trees in input order on (state), whose entries end with the rowid
+        connection.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks(state, lease_until)")
+        connection.execute("CREATE INDEX IF NOT EXISTS tasks_queued ON tasks(state)")
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        Get the connection of the current process.
+
+        Returns:
+            sqlite3.Connection: The database connection.
+        """
+        return self._connection.get()
+
+    def enqueue(self, input_list, done: set = frozenset()) -> int:
+        """
+        Add trees to the queue, streaming the input in batches. Trees already queued are left as they are,
+        so loading the same input again, from any host, adds only the new rows.
+
+        Args:
+            input_list: Iterable of (doc_id, (intent, domain)) tuples.
+            done (set, optional): doc_ids already generated by a previous run, not queued. Defaults to frozenset().
+
+        Returns:
+            int: Number of trees added.
+        """
+        connection = self.connection
+        added, batch = 0, []
+
+        def insert():
+            nonlocal added
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                before = connection.total_changes
+                connection.executemany("INSERT OR IGNORE INTO tasks (doc_id, intent, domain) VALUES (?, ?, ?)", batch)
+                added += connection.total_changes - before
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+        for doc_id, (intent, domain) in input_list:
+            if doc_id in done:
+                continue
+            batch.append((str(doc_id), intent, domain))
+            if len(batch) >= ENQUEUE_BATCH:
+                insert()
+                batch = []
+        if batch:
+            insert()
+        return added
+
+    def lease(self, owner: str):
+        """
+        Lease the next queued tree, or a tree whose lease expired.
+
+        Args:
+            owner (str): Name of the worker, see `worker_name`.
+
+        Returns:
+            dict: "doc_id", "intent", "domain" and "attempts" (1 for a first lease), or None when no tree is available.
+        """
+        connection = self.connection
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Trees that expired too often are given up on
+            connection.execute(
+                "UPDATE tasks SET state = 'failed', owner = NULL, error = COALESCE(error, 'lease expired') "
+                "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?", (now, self.max_attempts)
+            )
+            # Two single index seeks: an OR of both states would sort every candidate row while holding the write lock
+            row = connection.execute(
+                "SELECT doc_id, intent, domain, attempts FROM tasks INDEXED BY tasks_state WHERE state = 'leased' AND lease_until < ? LIMIT 1", (now,)
+            ).fetchone()
+            if row is None:
+                row = connection.execute(
+                    "SELECT doc_id, intent, domain, attempts FROM tasks INDEXED BY tasks_queued WHERE state = 'queued' ORDER BY rowid LIMIT 1"
+                ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE tasks SET state = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1 WHERE doc_id = ?",
+                    (owner, now + self.lease_seconds, row[0]),
+                )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return {"doc_id": row[0], "intent": row[1], "domain": row[2], "attempts": row[3] + 1}
+
+    def heartbeat(self, owner: str) -> int:
+        """
+        Renew every lease a worker holds.
+
+        Args:
+            owner (str): Name of the worker.
+
+        Returns:
+            int: Number of leases renewed.
+        """
+        return self.connection.execute(
+            "UPDATE tasks SET lease_until = ? WHERE state = 'leased' AND owner = ?", (time.time() + self.lease_seconds, owner)
+        ).rowcount
+
+    def complete(self, doc_id, owner: str) -> bool:
+        """
+        Mark a leased tree as generated.
+
+        Args:
+            doc_id: Identifier for the conversation tree.
+            owner (str): Name of the worker.
+
+        Returns:
+            bool: False when the worker no longer held the lease, i.e. the tree was handed to another worker.
+        """
+        return self.connection.execute(
+            "UPDATE tasks SET state = 'done', owner = NULL, error = NULL WHERE doc_id = ? AND owner = ? AND state = 'leased'", (str(doc_id), owner)
+        ).rowcount == 1
+
+    def release(self, doc_id, owner: str, error: str = None):
+        """
+        Give a leased tree back. A failed tree is queued again until it used up its attempts, a tree
+        released without an error (e.g. a worker stopping on a spent budget) does not use up an attempt.
+
+        Args:
+            doc_id: Identifier for the conversation tree.
+            owner (str): Name of the worker.
+            error (str, optional): Why the tree failed, None when it was only released. Defaults to None.
+        """
+        if error is None:
+            self.connection.execute(
+                "UPDATE tasks SET state = 'queued', owner = NULL, attempts = attempts - 1 WHERE doc_id = ? AND owner = ? AND state = 'leased'",
+                (str(doc_id), owner),
+            )
+        else:
+            self.connection.execute(
+                "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, owner = NULL, error = ? "
+                "WHERE doc_id = ? AND owner = ? AND state = 'leased'",
+                (self.max_attempts, error, str(doc_id), owner),
+            )
+
+    def counts(self) -> dict:
+        """
+        Count the trees of the queue by state.
+
+        Returns:
+            dict: "queued", "leased", "done" and "failed" counts.
+        """
+        counts = {"queued": 0, "leased": 0, "done": 0, "failed": 0}
+        counts.update(self.connection.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall())
+        return counts
@@ -0,0 +1,320 @@
+# Import nessessary packages
+import io
+import os
+import glob
+import gzip
+import json
+import time
+import queue
+import socket
+import threading
+from multiprocessing import util
+
+from telemetry import span
+
+#CONSTANTS
+# File extension of the shards of every compression
+EXTENSIONS = {"gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+
+# Writer of the current process, set by `open_writer`
+_WRITER = None
+
+def _compressor(compression: str):
+    """
+    Get the function compressing one batch into a self-contained gzip member or zstd frame.
+    Members and frames can be appended to each other, so a shard stays readable after every batch.
+    zstd needs the `zstandard` package, imported only when it is selected.
+
+    Args:
+        compression (str): "gzip" or "zstd".
+
+    Returns:
+        Function taking and returning bytes.
+    """
+    if compression == "zstd":
+        import zstandard
+        compressor = zstandard.ZstdCompressor(level=3)
+        return compressor.compress
+    return lambda data: gzip.compress(data, compresslevel=5)
+
+class ShardWriter:
+    """
+    Write-behind output writer: records are handed over through a bounded queue and a background thread
+    batches them into compressed JSONL shards, so the generating threads never wait on the disk unless
+    the writer falls a whole queue behind. Each stream ("leaves", "trees", "errors") gets its own shards,
+    named after the writer's start time and process so that workers never share a file. A shard is
+    rotated once it holds `max_bytes` compressed bytes or has been open for `max_seconds`.
+
+    Every flushed batch is appended as a complete gzip member (or zstd frame), so shards are valid after
+    any flush and a crash loses at most the batch in memory. Callbacks passed with the records run once
+    their batch is written, e.g. to checkpoint a leaf only after it reached its shard.
+
+    Attributes:
+        directory (str): Directory of the shards.
+        compression (str): "gzip" or "zstd".
+        max_bytes (int): Compressed size from which a shard is rotated.
+        max_seconds (float): Age from which a shard is rotated.
+        fsync (str): "never", "rotate" to fsync shards when they are closed, "batch" to fsync after every batch.
+        flush_bytes (int): Uncompressed size of the records from which a batch is written.
+        flush_seconds (float): Longest time a record waits in memory.
+    """
+    def __init__(self, directory: str, compression: str = "gzip", max_bytes: int = 256 << 20, max_seconds: float = 600.0,
+                 fsync: str = "rotate", queue_size: int = 1024, flush_bytes: int = 1 << 20, flush_seconds: float = 1.0):
+        """
+        Initialize the ShardWriter instance and start its thread.
+
+        Args:
+            directory (str): Directory of the shards.
+            compression (str, optional): "gzip" or "zstd". Defaults to "gzip".
+            max_bytes (int, optional): Compressed size from which a shard is rotated. Defaults to 256 MiB.
+            max_seconds (float, optional): Age from which a shard is rotated. Defaults to 600.
+            fsync (str, optional): "never", "rotate" or "batch". Defaults to "rotate".
+            queue_size (int, optional): Records that can wait for the thread before `put` blocks. Defaults to 1024.
+            flush_bytes (int, optional): Uncompressed size of the records from which a batch is written. Defaults to 1 MiB.
+            flush_seconds (float, optional): Longest time a record waits in memory. Defaults to 1.
+        """
+        self.directory = directory
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.fsync = fsync
+        self.flush_bytes = flush_bytes
+        self.flush_seconds = flush_seconds
+        self.compress = _compressor(compression)
+        # Workers on other hosts can share the directory and a pid
+        self.prefix = f"{time.strftime('%Y%m%dT%H%M%S')}-{socket.gethostname()}-{os.getpid()}"
+        os.makedirs(directory, exist_ok=True)
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._streams = {}          # stream -> {"lines", "file", "bytes", "opened", "seq"}
+        self._callbacks = []        # Callbacks of the records in memory
+        self._pending_bytes = 0
+        self._first_pending = None
+        self._error = None
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="shard-writer", daemon=True)
+        self._thread.start()
+        # Flush on exit, including forked worker processes which skip atexit
+        util.Finalize(self, self.close, exitpriority=10)
+
+    def put(self, stream: str, record=None, done=None):
+        """
+        Hand a record over to the writer, blocking only while its queue is full.
+
+        Args:
+            stream (str): Name of the shard stream.
+            record (optional): JSON-serializable record, None to only queue the callback.
+            done (optional): Function run in the writer thread once the record and those before it are written.
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue.put((stream, record, done))
+
+    def flush(self):
+        """
+        Wait until every record handed over so far is written.
+        """
+        written = threading.Event()
+        self.put(None, None, written.set)
+        # A failed batch drops its callbacks, so also stop waiting on an error
+        while not written.wait(0.5) and self._error is None:
+            pass
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        """
+        Write the remaining records, close the shards and stop the thread.
+        """
+        # A forked worker inherits its parent's writer, but not its thread
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        """
+        Thread loop: collect records into batches and write them once large or old enough.
+        """
+        while True:
+            timeout = None if self._first_pending is None else max(0.0, self._first_pending + self.flush_seconds - time.time())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                self._guard(self._write_batch)
+                self._guard(self._close_shards)
+                return
+            if item:
+                stream, record, done = item
+                if record is not None:
+                    self._guard(self._add, stream, record)
+                if done is not None:
+                    self._callbacks.append(done)
+                if self._first_pending is None:
+                    self._first_pending = time.time()
+            if self._pending_bytes >= self.flush_bytes or (self._first_pending is not None and time.time() - self._first_pending >= self.flush_seconds):
+                self._guard(self._write_batch)
+
+    def _guard(self, function, *args):
+        """
+        Run a step of the thread, keeping its first error for `put` to raise instead of stopping the thread,
+        so producers are never left waiting on a full queue. The records and callbacks of a failed batch are
+        dropped, so nothing is checkpointed that did not reach its shard.
+
+        Args:
+            function: The step to run.
+            *args: Arguments of the step.
+        """
+        try:
+            function(*args)
+        except Exception as e:
+            if self._error is None:
+                self._error = e
+            if function == self._write_batch:
+                for state in self._streams.values():
+                    state["lines"] = []
+                self._pending_bytes, self._first_pending, self._callbacks = 0, None, []
+
+    def _add(self, stream: str, record):
+        """
+        Serialize a record into the batch of its stream.
+
+        Args:
+            stream (str): Name of the shard stream.
+            record: JSON-serializable record.
+        """
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        state = self._streams.setdefault(stream, {"lines": [], "file": None, "bytes": 0, "opened": 0.0, "seq": 0})
+        state["lines"].append(line)
+        self._pending_bytes += len(line)
+
+    def _write_batch(self):
+        """
+        Append the batch of every stream to its shard, rotate full or old shards, then run the callbacks.
+        """
+        for stream, state in self._streams.items():
+            if state["lines"]:
+                lines, state["lines"] = state["lines"], []
+                data = self.compress(b"".join(lines))
+                with span("flush", "io", stream=stream, records=len(lines)) as fields:
+                    if state["file"] is None:
+                        state["seq"] += 1
+                        path = os.path.join(self.directory, f"{stream}-{self.prefix}-{state['seq']:04d}{EXTENSIONS[self.compression]}")
+                        state["file"] = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                        state["bytes"], state["opened"] = 0, time.time()
+                    os.write(state["file"], data)
+                    if self.fsync == "batch":
+                        os.fsync(state["file"])
+                    fields["bytes"] = len(data)
+                state["bytes"] += len(data)
+            if state["file"] is not None and (state["bytes"] >= self.max_bytes or time.time() - state["opened"] >= self.max_seconds):
+                self._close_shard(state)
+        self._pending_bytes, self._first_pending = 0, None
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def _close_shard(self, state: dict):
+        """
+        Close the open shard of a stream, the next batch starts a new one.
+
+        Args:
+            state (dict): State of the stream.
+        """
+        if self.fsync != "never":
+            os.fsync(state["file"])
+        os.close(state["file"])
+        state["file"] = None
+
+    def _close_shards(self):
+        """
+        Close the open shards of every stream.
+        """
+        for state in self._streams.values():
+            if state["file"] is not None:
+                self._close_shard(state)
+
+def open_writer(directory: str, settings: dict) -> ShardWriter:
+    """
+    Open the writer of the current process, reusing it when already open on the same directory.
+
+    Args:
+        directory (str): Directory of the shards.
+        settings (dict): Keyword arguments of ShardWriter.
+
+    Returns:
+        ShardWriter: The writer the module functions use.
+    """
+    global _WRITER
+    if _WRITER is None or _WRITER.directory != directory or _WRITER._pid != os.getpid():
+        if _WRITER is not None:
+            _WRITER.close()
+        _WRITER = ShardWriter(directory, **settings)
+    return _WRITER
+
+def write_record(stream: str, record, done=None):
+    """
+    Hand a record over to the writer of the current process.
+
+    Args:
+        stream (str): Name of the shard stream.
+        record: JSON-serializable record.
+        done (optional): Function run once the record is written.
+    """
+    _WRITER.put(stream, record, done)
+
+def after_writes(callback):
+    """
+    Run a function once the records handed over so far are written, right away when no writer is open.
+
+    Args:
+        callback: Function taking no arguments.
+    """
+    if _WRITER is None or _WRITER._pid != os.getpid():
+        callback()
+    else:
+        _WRITER.put(None, None, callback)
+
+def flush_writer():
+    """
+    Wait until the records handed to the writer of the current process are written, if one is open.
+    """
+    if _WRITER is not None and _WRITER._pid == os.getpid():
+        _WRITER.flush()
+
+def close_writer():
+    """
+    Write the remaining records of the writer of the current process, if one is open, and close it.
+    """
+    global _WRITER
+    if _WRITER is not None:
+        _WRITER.close()
+        _WRITER = None
+
+def read_shards(directory: str, stream: str):
+    """
+    Read back the records of a stream, shard by shard in the order they were started.
+    A batch cut short by a crash ends its shard.
+
+    Args:
+        directory (str): Directory of the shards.
+        stream (str): Name of the shard stream.
+
+    Yields:
+        The records.
+    """
+    paths = sorted(path for extension in EXTENSIONS.values() for path in glob.glob(os.path.join(directory, f"{stream}-*{extension}")))
+    for path in paths:
+        if path.endswith(EXTENSIONS["zstd"]):
+            import zstandard
+            file = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True), encoding="utf-8")
+        else:
+            file = gzip.open(path, "rt", encoding="utf-8")
+        with file:
+            try:
+                for line in file:
+                    yield json.loads(line)
+            except (EOFError, OSError, ValueError):
+                continue